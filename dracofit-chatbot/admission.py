@@ -0,0 +1,237 @@
+"""
+Admission control for /chat: a limit on generations running at once, a bounded wait queue
+in front of it, and round-robin between users so one heavy user can't starve the others.
+
+Requests that can't be queued are rejected right away: 429 when the user already has too
+many requests waiting, 503 when the whole queue is full or a request waited too long. The
+rejection carries a Retry-After estimate from the recent time generations took.
+
+Each API worker process has its own controllers, so the limits apply per worker. /chat/batch
+jobs get a controller of their own: a job holds its slot for as long as it runs, which would
+otherwise take a /chat slot for minutes and inflate the hold times /chat's estimates use.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; status_code is the HTTP status to answer with."""
+    def __init__(self, status_code: int, reason: str, message: str, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason # user_queue_full, queue_full or queue_timeout
+        self.message = message
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"status": "error", "message": self.message, "reason": self.reason, "retry_after_seconds": round(self.retry_after, 1)}
+
+class AdmissionSlot:
+    """A running generation's place. Release it when the stream ends; releasing twice is fine."""
+    def __init__(self, controller: "AdmissionController", user_key: str, waited_seconds: float):
+        self.controller = controller
+        self.user_key = user_key
+        self.waited_seconds = waited_seconds
+        self.admitted_time = time.monotonic()
+        self.released = False
+
+    def release(self):
+        self.controller._release(self)
+
+class _Waiter:
+    __slots__ = ("user_key", "enqueued_time", "granted", "wake")
+
+    def __init__(self, user_key: str, wake):
+        self.user_key = user_key
+        self.enqueued_time = time.monotonic()
+        self.granted = False
+        self.wake = wake # Called (under the controller's lock) once the waiter is granted a slot
+
+class AdmissionController:
+    """
+    Grants at most max_in_flight slots, and at most max_in_flight_per_user to one user. Users
+    waiting for a slot are served round-robin, each user's requests in arrival order.
+    """
+    def __init__(self, max_in_flight=config.ADMISSION_MAX_IN_FLIGHT, max_in_flight_per_user=config.ADMISSION_MAX_IN_FLIGHT_PER_USER,
+                 max_queue=config.ADMISSION_MAX_QUEUE, max_queued_per_user=config.ADMISSION_MAX_QUEUED_PER_USER,
+                 queue_timeout=config.ADMISSION_QUEUE_TIMEOUT_SECONDS, initial_hold_seconds=config.ADMISSION_INITIAL_HOLD_SECONDS,
+                 admission_class="chat"):
+        self.admission_class = admission_class # Label of this controller's metrics
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_user = max_in_flight_per_user
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._user_in_flight: Dict[str, int] = {}
+        self._waiting: "OrderedDict[str, deque]" = OrderedDict() # user -> waiters, users in round-robin order
+        self._queued = 0
+        self._average_hold_seconds = initial_hold_seconds # Moving average of how long slots are held
+        self.admitted = 0
+        self.rejected = 0
+
+    # --- Acquiring ---
+    def acquire(self, user_key: str) -> AdmissionSlot:
+        """Returns a slot, waiting in the queue if needed. Raises AdmissionRejected."""
+        event = threading.Event()
+        waiter = self._enqueue(user_key, event.set)
+        if not waiter.granted and not event.wait(self.queue_timeout) and self._leave_queue(waiter):
+            self._reject_timeout()
+        return self._admitted(waiter)
+
+    async def acquire_async(self, user_key: str) -> AdmissionSlot:
+        """Like acquire, but waits on the event loop instead of blocking the thread."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(user_key, wake)
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(future, self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._leave_queue(waiter):
+                    self._reject_timeout()
+            except asyncio.CancelledError:
+                # The client went away while queued; give back a slot granted meanwhile
+                if not self._leave_queue(waiter):
+                    self._admitted(waiter).release()
+                raise
+        return self._admitted(waiter)
+
+    def _enqueue(self, user_key: str, wake) -> _Waiter:
+        with self._lock:
+            queued_for_user = len(self._waiting.get(user_key, ()))
+            if self._can_run(user_key) and not queued_for_user:
+                # Nobody eligible is waiting (_dispatch would have admitted them), so this doesn't jump the queue
+                waiter = _Waiter(user_key, wake)
+                self._grant(waiter)
+                return waiter
+            if queued_for_user >= self.max_queued_per_user:
+                self._reject(429, "user_queue_full", "Too many of your messages are waiting, please try again shortly.",
+                             self._average_hold_seconds)
+            if self._queued >= self.max_queue:
+                self._reject(503, "queue_full", "The chatbot is busy, please try again shortly.", self._estimate_wait(self._queued + 1))
+            waiter = _Waiter(user_key, wake)
+            self._waiting.setdefault(user_key, deque()).append(waiter)
+            self._queued += 1
+            self._update_gauges()
+            return waiter
+
+    def _leave_queue(self, waiter: _Waiter) -> bool:
+        """Takes a waiter out of the queue. Returns False if it was granted a slot meanwhile, which the caller then holds."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiters = self._waiting[waiter.user_key]
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiting[waiter.user_key]
+            self._queued -= 1
+            self._update_gauges()
+            return True
+
+    def _reject_timeout(self):
+        with self._lock:
+            self._reject(503, "queue_timeout", "The chatbot is busy, please try again shortly.", self._estimate_wait(self._queued + 1))
+
+    def _admitted(self, waiter: _Waiter) -> AdmissionSlot:
+        waited_seconds = time.monotonic() - waiter.enqueued_time
+        metrics.HTTP_ADMISSION_WAIT_SECONDS.observe(waited_seconds, admission_class=self.admission_class)
+        return AdmissionSlot(self, waiter.user_key, waited_seconds)
+
+    def _reject(self, status_code: int, reason: str, message: str, retry_after: float):
+        self.rejected += 1
+        metrics.HTTP_ADMISSION_REJECTIONS.inc(admission_class=self.admission_class, reason=reason)
+        logger.warning(f"{self.admission_class.capitalize()} admission rejected ({reason}): {self._in_flight} in flight, {self._queued} queued.")
+        raise AdmissionRejected(status_code, reason, message, retry_after)
+
+    # --- Scheduling ---
+    def _can_run(self, user_key: str) -> bool:
+        return self._in_flight < self.max_in_flight and self._user_in_flight.get(user_key, 0) < self.max_in_flight_per_user
+
+    def _grant(self, waiter: _Waiter):
+        self._in_flight += 1
+        self._user_in_flight[waiter.user_key] = self._user_in_flight.get(waiter.user_key, 0) + 1
+        self.admitted += 1
+        waiter.granted = True
+        waiter.wake()
+        self._update_gauges()
+
+    def _dispatch(self):
+        """Grants free slots to waiting users in round-robin order. Called with the lock held."""
+        while self._in_flight < self.max_in_flight:
+            for user_key, waiters in self._waiting.items():
+                if self._user_in_flight.get(user_key, 0) < self.max_in_flight_per_user:
+                    break
+            else:
+                return # Everyone waiting is at their per-user limit
+            waiter = waiters.popleft()
+            if waiters:
+                self._waiting.move_to_end(user_key)
+            else:
+                del self._waiting[user_key]
+            self._queued -= 1
+            self._grant(waiter)
+
+    def _release(self, slot: AdmissionSlot):
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            self._in_flight -= 1
+            remaining = self._user_in_flight[slot.user_key] - 1
+            if remaining:
+                self._user_in_flight[slot.user_key] = remaining
+            else:
+                del self._user_in_flight[slot.user_key]
+            hold_seconds = time.monotonic() - slot.admitted_time
+            self._average_hold_seconds += 0.2 * (hold_seconds - self._average_hold_seconds)
+            self._dispatch()
+            self._update_gauges()
+
+    def _estimate_wait(self, position: int) -> float:
+        """Seconds until the request at this queue position (1 = next) gets a slot, if slots keep turning over as recently."""
+        return math.ceil(position / self.max_in_flight) * self._average_hold_seconds
+
+    def _update_gauges(self):
+        metrics.HTTP_ADMISSION_IN_FLIGHT.set(self._in_flight, admission_class=self.admission_class)
+        metrics.HTTP_ADMISSION_QUEUE_DEPTH.set(self._queued, admission_class=self.admission_class)
+
+    def get_status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queued": self._queued,
+                "max_queue": self.max_queue,
+                "queued_users": len(self._waiting),
+                "estimated_wait_seconds": round(self._estimate_wait(self._queued + 1), 1) if self._in_flight >= self.max_in_flight else 0,
+                "average_generation_seconds": round(self._average_hold_seconds, 2),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+def create_batch_admission() -> AdmissionController:
+    """The controller for /chat/batch jobs: one job per caller, with its own queue and hold times."""
+    return AdmissionController(
+        max_in_flight=config.BATCH_ADMISSION_MAX_IN_FLIGHT, max_in_flight_per_user=1, max_queue=config.BATCH_ADMISSION_MAX_QUEUE,
+        max_queued_per_user=1, queue_timeout=config.BATCH_ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        initial_hold_seconds=config.BATCH_ADMISSION_INITIAL_HOLD_SECONDS, admission_class="batch",
+    )
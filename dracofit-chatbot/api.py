@@ -1,16 +1,27 @@
 import os
-import json
 from flask import Flask, request, jsonify, g, session, Response  # Import Response
 from flask_cors import CORS
 from werkzeug.exceptions import ClientDisconnected
 import threading
 import signal
+import time
 import uuid  # For request IDs
 
 # Import config
 import config
+import metrics
+from admission import AdmissionController, AdmissionRejected, create_batch_admission
+from batch_generate import format_line, parse_batch_request
+from compaction import ConversationCompactor
+from conversation_store import StoredMessage, create_conversation_store, messages_from_dicts, save_user_turn
+from sse import coalesce_stream, format_event
 # --- Step 2a: Import the STREAMING function ---
-from model import GemmaModelSingleton, get_chatbot_response_stream, get_health_check, logger
+from model import logger
+if config.MODEL_SERVER_ENABLED:
+    # Workers share the model loaded once by model_server.py instead of each loading a copy
+    from model_server import get_chatbot_response_stream, get_batch_response_stream, get_health_check, fit_conversation_to_context, get_readiness, get_metrics_text, compact_conversation, invalidate_conversation_cache
+else:
+    from model import get_chatbot_response_stream, get_batch_response_stream, get_health_check, fit_conversation_to_context, get_readiness, get_metrics_text, compact_conversation, invalidate_conversation_cache, start_background_load, start_idle_reaper
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -27,51 +38,103 @@ if not app.secret_key or app.secret_key == "a-default-development-secret-key":
 # Replace "http://localhost:5173" with your frontend's actual URL if different.
 CORS(app, supports_credentials=True, origins=["http://localhost:5173"])
 
+# Conversation history lives server-side; the session cookie only carries the conversation id
+conversation_store = create_conversation_store()
+# Summarizes the older turns of long conversations between their turns (see compaction.py)
+compactor = ConversationCompactor(conversation_store, compact_conversation, invalidate_conversation_cache) if config.COMPACTION_ENABLED else None
+
+# Bounds the generations this worker runs at once and queues the rest fairly per session
+admission = AdmissionController()
+# Batch jobs wait for slots of their own instead of holding a /chat one for their whole run
+batch_admission = create_batch_admission()
+
 # Track ongoing requests and their abort flags
 active_requests = {}
 request_lock = threading.Lock()
 
+# --- Background Model Loading ---
+# The server accepts connections right away; the model loads and warms up meanwhile.
+# /health/ready reports when it's done, and chat requests that arrive earlier wait for it.
+# (With a shared model server, the server process does both of these instead.)
+if not config.MODEL_SERVER_ENABLED:
+    if config.PRELOAD_MODEL_ON_STARTUP:
+        start_background_load()
+    # Unloads the model into warm standby after MAX_IDLE_TIME_SECONDS without requests
+    start_idle_reaper()
+
 # --- Health Check Route (No changes needed here) ---
 @app.route('/health', methods=['GET'])
 def health():
     logger.info("Health check requested.")
-    return jsonify(get_health_check())
+    health_status = get_health_check()
+    if health_status.get("status") == "success":
+        health_status["data"]["conversation_store"] = conversation_store.get_status()
+        health_status["data"]["admission"] = admission.get_status()
+        health_status["data"]["batch_admission"] = batch_admission.get_status()
+        if compactor:
+            health_status["data"]["compaction"] = compactor.get_status()
+    return jsonify(health_status)
+
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    """Liveness probe: the process is up and serving, whether or not the model is loaded."""
+    return jsonify({"status": "alive"})
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 with load progress until then."""
+    readiness = get_readiness()
+    return jsonify(readiness), 200 if readiness["ready"] else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape target: this worker's /chat metrics plus the model's (local or from the model server)."""
+    return Response(metrics.HTTP_METRICS.render() + get_metrics_text(), mimetype=metrics.CONTENT_TYPE)
 
 # --- Step 2b: Rewrite the /chat route for streaming ---
 @app.route('/chat', methods=['POST'])
 def chat():
     """Handles chatbot interaction using Server-Sent Events (SSE) for streaming."""
     request_id = str(uuid.uuid4())
+    start_time = time.perf_counter()
     logger.info(f"Received streaming chat request {request_id}")
 
     # --- Session Handling (Done BEFORE starting the stream response) ---
-    if 'conversation' not in session:
-        session['conversation'] = []
-        logger.info(f"Initialized new conversation history for session.")
-
-    current_history = session['conversation']
+    if 'conversation_id' not in session:
+        session['conversation_id'] = str(uuid.uuid4())
+        logger.info(f"Initialized new conversation for session.")
+    conversation_id = session['conversation_id']
+    if 'conversation' in session:
+        # Cookie from before the server-side store: move its history over once
+        conversation_store.save(conversation_id, messages_from_dicts(session.pop('conversation')))
 
+    slot = None
     try:
         data = request.get_json()
         if not data or 'message' not in data:
             logger.warning(f"Request {request_id}: Bad request - Missing 'message'.")
+            metrics.HTTP_REQUESTS.inc(status="bad_request")
             # Return a standard JSON error if setup fails
             return jsonify({'status': 'error', 'message': 'Missing message in request body'}), 400
 
         user_message = data['message']
         logger.debug(f"Request {request_id}: User message received.")
 
-        # Add user message and trim history
-        current_history.append({"role": "user", "content": user_message})
-        if len(current_history) > 10:  # Trim history
-            current_history = current_history[-10:]
-            logger.debug(f"Request {request_id}: Trimmed history.")
+        # --- Admission (before the history is touched, so a rejected message isn't stored) ---
+        try:
+            slot = admission.acquire(conversation_id)
+        except AdmissionRejected as rejection:
+            metrics.HTTP_REQUESTS.inc(status="rejected")
+            return jsonify(rejection.to_dict()), rejection.status_code, {"Retry-After": rejection.retry_after_header}
+        if slot.waited_seconds > 0.1:
+            logger.info(f"Request {request_id}: Admitted after waiting {slot.waited_seconds:.1f}s.")
 
-        # --- IMPORTANT: Save history to session BEFORE starting the stream ---
-        # We cannot reliably modify the session *after* the streaming response starts.
-        session['conversation'] = current_history
-        session.modified = True
-        logger.info(f"Request {request_id}: History updated in session, preparing stream.")
+        # Add user message and trim history to the context token budget (which invalidates the conversation's
+        # cached KV state if older turns were dropped), then save it unless a compaction replaced the history
+        # meanwhile, in which case it is redone on that; the reply is appended when the stream finishes
+        current_history = save_user_turn(conversation_store, conversation_id, user_message,
+                                         lambda history: fit_conversation_to_context(history, conversation_id))
+        logger.info(f"Request {request_id}: History updated in conversation store, preparing stream.")
 
         # --- Prepare Abort Event ---
         abort_event = threading.Event()
@@ -81,39 +144,55 @@ def chat():
         # --- Define the Streaming Generator Function for Flask ---
         def generate_sse():
             """This inner function yields SSE formatted strings."""
+            metrics.HTTP_ACTIVE_STREAMS.inc()
+            final_status = "incomplete" # Stream ended without a terminal status
+            first_chunk_sent = False
             try:
                 # Get the generator from the model function
                 # Pass the history *as it was before this request's bot response*
-                stream_generator = get_chatbot_response_stream(current_history, abort_event)
-
-                full_bot_response_for_log = ""  # Only for logging the final result
+                # Chunks decoded close together are merged into one frame (see sse.py)
+                stream_generator = coalesce_stream(get_chatbot_response_stream(current_history, abort_event, conversation_id))
 
                 for result in stream_generator:
                     status = result.get("status")
 
                     # Format data according to SSE specification: "data: json_payload\n\n"
-                    sse_data = f"data: {json.dumps(result)}\n\n"
-                    yield sse_data  # Send this chunk to the client
+                    yield format_event(result)  # Send this chunk to the client
+                    if not first_chunk_sent:
+                        metrics.HTTP_FIRST_CHUNK_SECONDS.observe(time.perf_counter() - start_time)
+                        first_chunk_sent = True
 
                     # Log and check for end conditions
-                    if status == "streaming":
-                        full_bot_response_for_log += result.get("chunk", "")
-                    elif status == "success":
+                    if status == "success":
+                        final_status = status
                         logger.info(f"Request {request_id}: Stream finished successfully.")
                         # Log the full response if needed
                         logger.debug(f"Request {request_id}: Full response: {result.get('full_response', '')[:100]}...")
-                        # NOTE: Cannot add bot response to session here easily.
+                        conversation_store.append(conversation_id, StoredMessage("model", result.get("full_response", "")))
+                        if compactor:
+                            compactor.schedule(conversation_id)
                         break  # Stop yielding
                     elif status == "error" or status == "aborted":
+                        final_status = status
                         logger.warning(f"Request {request_id}: Stream ended with status: {status} - {result.get('message')}")
                         break  # Stop yielding
 
+            except (GeneratorExit, ClientDisconnected):
+                # The client went away: stop generation instead of decoding for nobody
+                logger.warning(f"Request {request_id}: Client disconnected, aborting generation.")
+                final_status = "disconnected"
+                abort_event.set()
+                raise
             except Exception as e:
                 logger.exception(f"Request {request_id}: Error during SSE generation loop: {e}")
+                final_status = "error"
                 # Yield a final error message if something breaks mid-stream
                 error_payload = {"status": "error", "message": "Streaming failed internally"}
-                yield f"data: {json.dumps(error_payload)}\n\n"
+                yield format_event(error_payload)
             finally:
+                metrics.HTTP_ACTIVE_STREAMS.dec()
+                metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start_time)
+                metrics.HTTP_REQUESTS.inc(status=final_status)
                 # Clean up active request tracking
                 with request_lock:
                     if request_id in active_requests:
@@ -122,17 +201,68 @@ def chat():
 
         # --- Return the Streaming Response ---
         # mimetype 'text/event-stream' is crucial for SSE to work.
-        return Response(generate_sse(), mimetype='text/event-stream')
+        response = Response(generate_sse(), mimetype='text/event-stream')
+        # Runs when the stream ends for any reason, even if the generator never started
+        response.call_on_close(slot.release)
+        return response
 
     # --- Error Handling (For errors BEFORE stream starts) ---
     except Exception as e:
         logger.exception(f"Error setting up chat stream request {request_id}: {e}")
+        metrics.HTTP_REQUESTS.inc(status="setup_error")
+        if slot is not None:
+            slot.release()
         # Clean up just in case abort event was registered
         with request_lock:
             if request_id in active_requests:
                 del active_requests[request_id]
         return jsonify({'status': 'error', 'message': "Failed to initiate chat stream."}), 500
 
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """
+    Generates replies to many conversations for offline jobs, streamed back as JSON lines: one
+    {"status": "result", "index": ...} per conversation as it finishes, then a summary line.
+    """
+    request_id = str(uuid.uuid4())
+    logger.info(f"Received batch request {request_id}")
+    try:
+        batch = parse_batch_request(request.get_json(silent=True))
+    except ValueError as e:
+        logger.warning(f"Request {request_id}: Bad batch request - {e}.")
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    # A batch takes one batch admission slot for its whole run, under the caller's session
+    if 'conversation_id' not in session:
+        session['conversation_id'] = str(uuid.uuid4())
+    try:
+        slot = batch_admission.acquire(session['conversation_id'])
+    except AdmissionRejected as rejection:
+        return jsonify(rejection.to_dict()), rejection.status_code, {"Retry-After": rejection.retry_after_header}
+
+    abort_event = threading.Event()
+    with request_lock:
+        active_requests[request_id] = abort_event
+
+    def generate_lines():
+        try:
+            for result in get_batch_response_stream(batch["conversations"], batch["max_new_tokens"], abort_event):
+                yield format_line(result)
+                if result["status"] != "result":
+                    logger.info(f"Request {request_id}: Batch ended with status: {result['status']}")
+                    break
+        except (GeneratorExit, ClientDisconnected):
+            logger.warning(f"Request {request_id}: Client disconnected, aborting batch.")
+            abort_event.set()
+            raise
+        finally:
+            with request_lock:
+                active_requests.pop(request_id, None)
+
+    response = Response(generate_lines(), mimetype='application/x-ndjson')
+    response.call_on_close(slot.release)
+    return response
+
 # --- Shutdown Handling (No changes needed here) ---
 def handle_shutdown(signum, frame):
     logger.info("Shutdown signal received, aborting active requests...")
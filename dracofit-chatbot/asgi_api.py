@@ -0,0 +1,272 @@
+"""
+Async (ASGI) serving mode for the chatbot, with the same /chat and /health routes as api.py.
+
+In api.py every open /chat stream holds a Flask thread blocked on the token generator.
+Here a stream is a coroutine that awaits its tokens, so idle connections waiting on the
+model cost almost nothing. Run it with:
+
+    uvicorn asgi_api:app --host 0.0.0.0 --port 5000
+
+Requires `pip install starlette uvicorn itsdangerous`. Works with MODEL_SERVER_ENABLED too.
+"""
+import asyncio
+import contextlib
+import os
+import threading
+import time
+import uuid  # For request IDs
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Import config
+import config
+import metrics
+from admission import AdmissionController, AdmissionRejected, create_batch_admission
+from batch_generate import format_line, parse_batch_request
+from compaction import ConversationCompactor
+from conversation_store import StoredMessage, create_conversation_store, save_user_turn
+from sse import coalesce_stream_async, format_event
+from model import logger
+if config.MODEL_SERVER_ENABLED:
+    # Workers share the model loaded once by model_server.py instead of each loading a copy
+    from model_server import get_chatbot_response_stream_async, get_batch_response_stream, get_health_check, fit_conversation_to_context, get_readiness, get_metrics_text, compact_conversation, invalidate_conversation_cache
+else:
+    from model import get_chatbot_response_stream_async, get_batch_response_stream, get_health_check, fit_conversation_to_context, get_readiness, get_metrics_text, compact_conversation, invalidate_conversation_cache, start_background_load, start_idle_reaper
+
+if not config.SECRET_KEY or config.SECRET_KEY == "a-default-development-secret-key":
+    logger.warning("Using default or missing SECRET_KEY. Set a strong secret in config.py or environment variable for production.")
+
+# Conversation history lives server-side; the session cookie only carries the conversation id
+conversation_store = create_conversation_store()
+# Summarizes the older turns of long conversations between their turns (see compaction.py)
+compactor = ConversationCompactor(conversation_store, compact_conversation, invalidate_conversation_cache) if config.COMPACTION_ENABLED else None
+admission = AdmissionController()
+# Batch jobs wait for slots of their own instead of holding a /chat one for their whole run
+batch_admission = create_batch_admission()
+
+# Track ongoing requests and their abort flags
+active_requests = {}
+request_lock = threading.Lock()
+
+# --- Health Check Routes ---
+# The checks may call the model server or wait on the model's locks, so they run in the threadpool
+async def health(request: Request):
+    logger.info("Health check requested.")
+    health_status = await run_in_threadpool(get_health_check)
+    if health_status.get("status") == "success":
+        health_status["data"]["conversation_store"] = await run_in_threadpool(conversation_store.get_status)
+        if compactor:
+            health_status["data"]["compaction"] = compactor.get_status()
+        health_status["data"]["admission"] = admission.get_status()
+        health_status["data"]["batch_admission"] = batch_admission.get_status()
+    return JSONResponse(health_status)
+
+async def health_live(request: Request):
+    """Liveness probe: the process is up and serving, whether or not the model is loaded."""
+    return JSONResponse({"status": "alive"})
+
+async def health_ready(request: Request):
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 with load progress until then."""
+    readiness = await run_in_threadpool(get_readiness)
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
+
+async def metrics_endpoint(request: Request):
+    """Prometheus scrape target: this worker's /chat metrics plus the model's (local or from the model server)."""
+    model_metrics = await run_in_threadpool(get_metrics_text)
+    return Response(metrics.HTTP_METRICS.render() + model_metrics, media_type=metrics.CONTENT_TYPE)
+
+# --- Chat Route ---
+async def chat(request: Request):
+    """Handles chatbot interaction using Server-Sent Events (SSE) for streaming."""
+    request_id = str(uuid.uuid4())
+    start_time = time.perf_counter()
+    logger.info(f"Received streaming chat request {request_id}")
+
+    session = request.session
+    if 'conversation_id' not in session:
+        session['conversation_id'] = str(uuid.uuid4())
+        logger.info(f"Initialized new conversation for session.")
+    conversation_id = session['conversation_id']
+
+    slot = None
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data or 'message' not in data:
+            logger.warning(f"Request {request_id}: Bad request - Missing 'message'.")
+            metrics.HTTP_REQUESTS.inc(status="bad_request")
+            return JSONResponse({'status': 'error', 'message': 'Missing message in request body'}, status_code=400)
+
+        # Waits on the event loop; before the history is touched, so a rejected message isn't stored
+        try:
+            slot = await admission.acquire_async(conversation_id)
+        except AdmissionRejected as rejection:
+            metrics.HTTP_REQUESTS.inc(status="rejected")
+            return JSONResponse(rejection.to_dict(), status_code=rejection.status_code, headers={"Retry-After": rejection.retry_after_header})
+
+        # Saves the trimmed history with the new message unless a compaction replaced it meanwhile (then redone
+        # on that); the reply is appended when the stream finishes. Store I/O and tokenizing (or asking the
+        # model server) stay off the event loop
+        current_history = await run_in_threadpool(save_user_turn, conversation_store, conversation_id, data['message'],
+                                                  lambda history: fit_conversation_to_context(history, conversation_id))
+        logger.info(f"Request {request_id}: History updated in conversation store, preparing stream.")
+
+        abort_event = threading.Event()
+        with request_lock:
+            active_requests[request_id] = abort_event
+
+        async def generate_sse():
+            """Yields SSE formatted strings. Each one is sent before the next token is awaited."""
+            stream_generator = get_chatbot_response_stream_async(current_history, abort_event, conversation_id)
+            coalesced_stream = coalesce_stream_async(stream_generator)
+            metrics.HTTP_ACTIVE_STREAMS.inc()
+            final_status = "incomplete" # Stream ended without a terminal status
+            first_chunk_sent = False
+            try:
+                async for result in coalesced_stream:
+                    status = result.get("status")
+                    yield format_event(result)
+                    if not first_chunk_sent:
+                        metrics.HTTP_FIRST_CHUNK_SECONDS.observe(time.perf_counter() - start_time)
+                        first_chunk_sent = True
+
+                    if status == "success":
+                        final_status = status
+                        logger.info(f"Request {request_id}: Stream finished successfully.")
+                        logger.debug(f"Request {request_id}: Full response: {result.get('full_response', '')[:100]}...")
+                        await run_in_threadpool(conversation_store.append, conversation_id, StoredMessage("model", result.get("full_response", "")))
+                        if compactor:
+                            compactor.schedule(conversation_id)
+                        break
+                    elif status == "error" or status == "aborted":
+                        final_status = status
+                        logger.warning(f"Request {request_id}: Stream ended with status: {status} - {result.get('message')}")
+                        break
+            except (asyncio.CancelledError, GeneratorExit, OSError):
+                # Starlette cancels the stream as soon as the client disconnects, or the write fails:
+                # stop generation instead of decoding for nobody
+                logger.warning(f"Request {request_id}: Client disconnected, aborting generation.")
+                final_status = "disconnected"
+                abort_event.set()
+                raise
+            except Exception as e:
+                logger.exception(f"Request {request_id}: Error during SSE generation loop: {e}")
+                final_status = "error"
+                error_payload = {"status": "error", "message": "Streaming failed internally"}
+                yield format_event(error_payload)
+            finally:
+                await coalesced_stream.aclose()
+                await stream_generator.aclose()
+                metrics.HTTP_ACTIVE_STREAMS.dec()
+                metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start_time)
+                metrics.HTTP_REQUESTS.inc(status=final_status)
+                with request_lock:
+                    active_requests.pop(request_id, None)
+                slot.release()
+                logger.debug(f"Cleaned up streaming request {request_id}")
+
+        # The background task also releases the slot if the stream is cancelled before it starts
+        return StreamingResponse(generate_sse(), media_type='text/event-stream', background=BackgroundTask(slot.release))
+
+    except Exception as e:
+        logger.exception(f"Error setting up chat stream request {request_id}: {e}")
+        metrics.HTTP_REQUESTS.inc(status="setup_error")
+        if slot is not None:
+            slot.release()
+        with request_lock:
+            active_requests.pop(request_id, None)
+        return JSONResponse({'status': 'error', 'message': "Failed to initiate chat stream."}, status_code=500)
+
+async def chat_batch(request: Request):
+    """
+    Generates replies to many conversations for offline jobs, streamed back as JSON lines: one
+    {"status": "result", "index": ...} per conversation as it finishes, then a summary line.
+    """
+    request_id = str(uuid.uuid4())
+    logger.info(f"Received batch request {request_id}")
+    try:
+        batch = parse_batch_request(await request.json())
+    except ValueError as e:
+        logger.warning(f"Request {request_id}: Bad batch request - {e}.")
+        return JSONResponse({'status': 'error', 'message': str(e)}, status_code=400)
+
+    # A batch takes one batch admission slot for its whole run, under the caller's session
+    session = request.session
+    if 'conversation_id' not in session:
+        session['conversation_id'] = str(uuid.uuid4())
+    try:
+        slot = await batch_admission.acquire_async(session['conversation_id'])
+    except AdmissionRejected as rejection:
+        return JSONResponse(rejection.to_dict(), status_code=rejection.status_code, headers={"Retry-After": rejection.retry_after_header})
+
+    abort_event = threading.Event()
+    with request_lock:
+        active_requests[request_id] = abort_event
+
+    async def generate_lines():
+        # Results arrive only as whole conversations finish, so a thread waiting on them costs little
+        try:
+            async for result in iterate_in_threadpool(get_batch_response_stream(batch["conversations"], batch["max_new_tokens"], abort_event)):
+                yield format_line(result)
+                if result["status"] != "result":
+                    logger.info(f"Request {request_id}: Batch ended with status: {result['status']}")
+                    break
+        except (asyncio.CancelledError, GeneratorExit, OSError):
+            logger.warning(f"Request {request_id}: Client disconnected, aborting batch.")
+            abort_event.set()
+            raise
+        finally:
+            with request_lock:
+                active_requests.pop(request_id, None)
+            slot.release()
+
+    return StreamingResponse(generate_lines(), media_type='application/x-ndjson', background=BackgroundTask(slot.release))
+
+# --- Startup / Shutdown ---
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Same as api.py: load in the background, and the model server does both when enabled
+    if not config.MODEL_SERVER_ENABLED:
+        if config.PRELOAD_MODEL_ON_STARTUP:
+            start_background_load()
+        start_idle_reaper()
+    yield
+    logger.info("Shutdown signal received, aborting active requests...")
+    with request_lock:
+        for req_id, abort_event in active_requests.items():
+            logger.info(f"Signalling abort for request {req_id}")
+            abort_event.set()
+
+app = Starlette(
+    routes=[
+        Route('/health', health, methods=['GET']),
+        Route('/health/live', health_live, methods=['GET']),
+        Route('/health/ready', health_ready, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/chat', chat, methods=['POST']),
+        Route('/chat/batch', chat_batch, methods=['POST']),
+    ],
+    middleware=[
+        # Allow the frontend origin and let it send/receive the session cookie, as api.py does
+        Middleware(CORSMiddleware, allow_origins=["http://localhost:5173"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]),
+        Middleware(SessionMiddleware, secret_key=config.SECRET_KEY),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.environ.get('PORT', 5000))
+    logger.info(f"Starting ASGI server on port {port}...")
+    uvicorn.run(app, host='0.0.0.0', port=port)
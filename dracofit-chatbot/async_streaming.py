@@ -0,0 +1,44 @@
+"""
+Streaming generated text to asyncio consumers.
+
+The scheduler thread decodes for every request and pushes each request's text into its
+streamer. TextIteratorStreamer hands that text to a thread blocked on a queue; the
+AsyncTextStreamer here hands it to an event loop instead, so a waiting stream costs a
+suspended coroutine rather than an OS thread.
+"""
+import asyncio
+import logging
+
+from transformers import TextStreamer
+
+logger = logging.getLogger(__name__)
+
+class AsyncTextStreamer(TextStreamer):
+    """TextStreamer whose text chunks are awaited on `loop` with `async for`."""
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, skip_prompt=False, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.loop = loop
+        self.text_queue = asyncio.Queue()
+        self.stop_signal = None
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        # Called from the scheduler thread; asyncio.Queue may only be touched on its loop
+        self._put(text)
+        if stream_end:
+            self._put(self.stop_signal)
+
+    def _put(self, value):
+        try:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, value)
+        except RuntimeError:
+            # The loop was closed (server shutting down), nobody is left to read this
+            logger.debug("Dropping streamed text, event loop is closed.")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        value = await self.text_queue.get()
+        if value is self.stop_signal:
+            raise StopAsyncIteration
+        return value
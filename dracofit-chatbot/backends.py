@@ -0,0 +1,193 @@
+import logging
+import os
+import warnings
+from typing import Any, Dict, Optional
+
+import torch
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+import config
+from checkpoint_cache import quantization_settings
+
+logger = logging.getLogger(__name__)
+
+# --- Helper Functions ---
+def _cpu_flags() -> set:
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+def _physical_core_count() -> Optional[int]:
+    """Physical cores from /proc/cpuinfo; hyperthread siblings share a core's matmul units."""
+    cores = set()
+    physical_id = None
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("physical id"):
+                    physical_id = line.split(":", 1)[1].strip()
+                elif line.startswith("core id"):
+                    cores.add((physical_id, line.split(":", 1)[1].strip()))
+    except OSError:
+        return None
+    return len(cores) or None
+
+def cpu_supports_bf16() -> bool:
+    """bf16 matmuls are only fast with native support (AVX512-BF16 or AMX); elsewhere they're emulated."""
+    return bool(_cpu_flags() & {"avx512_bf16", "amx_bf16"})
+
+# --- Backends ---
+class InferenceBackend:
+    """
+    Loads the model the way one kind of device runs it best and sets up its runtime.
+
+    GemmaModel picks a backend from the device (see select_backend) and leaves weight
+    format, placement and thread settings to it.
+    """
+    name = None
+    static_kv_cache = False # Whether the scheduler decodes into a preallocated StaticKVCache
+    supports_checkpoint_cache = False # Whether loaded models can be saved to the quantized checkpoint cache
+    supports_torch_compile = True # Whether the loaded model traces into whole graphs, for compiled decoding
+
+    def __init__(self, device: str):
+        self.device = device
+
+    def configure_runtime(self):
+        """Process-wide settings to apply once before loading."""
+
+    def load(self, source: str):
+        raise NotImplementedError
+
+    def checkpoint_settings(self) -> Dict[str, Any]:
+        """Settings that determine the saved weights, used to key the quantized checkpoint cache."""
+        return {}
+
+    def get_status(self) -> Dict[str, Any]:
+        return {"name": self.name, "device": self.device, "static_kv_cache": self.static_kv_cache}
+
+class BitsAndBytesBackend(InferenceBackend):
+    """8-bit bitsandbytes weights placed with device_map="auto", offloading what doesn't fit on the GPU."""
+    name = "cuda_int8"
+    supports_checkpoint_cache = True
+
+    def configure_runtime(self):
+        os.environ['PYTORCH_CUDA_ALLOC_CONF'] = config.CUDA_ALLOC_CONF
+
+    def load(self, source: str):
+        logger.info("Configuring BitsAndBytes using settings from config...")
+        bnb_config = BitsAndBytesConfig(
+            load_in_8bit=config.BNB_LOAD_IN_8BIT,
+            llm_int8_enable_fp32_cpu_offload=config.BNB_LLM_INT8_ENABLE_FP32_CPU_OFFLOAD,
+            llm_int8_skip_modules=config.BNB_LLM_INT8_SKIP_MODULES,
+            llm_int8_threshold=config.BNB_LLM_INT8_THRESHOLD
+        )
+        logger.info("BitsAndBytes configured.")
+
+        # A cached checkpoint is already quantized, the config only supplies the offload settings
+        logger.info(f"Loading model from {source} with quantization_config and device_map='auto'...")
+        model = AutoModelForCausalLM.from_pretrained(
+            source,
+            quantization_config=bnb_config,
+            device_map="auto",
+            offload_folder=config.OFFLOAD_FOLDER,
+            trust_remote_code=True,
+            token=config.HF_TOKEN
+        )
+        logger.info("Model loaded successfully with quantization and potential offloading.")
+        return model
+
+    def checkpoint_settings(self) -> Dict[str, Any]:
+        return quantization_settings()
+
+class CpuBackend(InferenceBackend):
+    """
+    CPU-native weights (int8 dynamically quantized Linear layers, bf16 or fp32), explicit
+    intra-op threads and core affinity, and decoding into a preallocated KV cache.
+
+    bitsandbytes int8 is built for GPUs; on CPU it falls back to slow paths, so this
+    backend loads the original weights and quantizes them with PyTorch's CPU kernels.
+    """
+    name = "cpu"
+    static_kv_cache = True
+
+    def __init__(self, device: str, weight_dtype=None, num_threads=None, core_affinity=None):
+        super().__init__(device)
+        self.weight_dtype = weight_dtype or config.CPU_WEIGHT_DTYPE
+        self.num_threads = num_threads or config.CPU_NUM_THREADS
+        self.core_affinity = core_affinity if core_affinity is not None else config.CPU_CORE_AFFINITY
+        if self.weight_dtype == "bfloat16" and not cpu_supports_bf16():
+            logger.warning("CPU has no native bf16 support, loading float32 weights instead.")
+            self.weight_dtype = "float32"
+        if self.weight_dtype not in ("int8", "bfloat16", "float32"):
+            raise ValueError(f"Unknown CPU_WEIGHT_DTYPE: {self.weight_dtype}")
+
+    @property
+    def supports_torch_compile(self) -> bool:
+        # Dynamically quantized Linear layers are graph breaks, which leave dozens of small graphs per step
+        return self.weight_dtype != "int8"
+
+    def configure_runtime(self):
+        if self.core_affinity and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.core_affinity)
+            logger.info(f"Pinned process to cores {sorted(self.core_affinity)}.")
+        available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        # One thread per physical core: hyperthreads only contend for the same vector units
+        self.num_threads = self.num_threads or min(available_cpus, _physical_core_count() or available_cpus)
+        torch.set_num_threads(self.num_threads)
+        try:
+            torch.set_num_interop_threads(config.CPU_NUM_INTEROP_THREADS)
+        except RuntimeError:
+            pass # Can only be set before the first parallel op, e.g. on a reload
+        logger.info(f"CPU backend using {self.num_threads} intra-op threads.")
+
+    def load(self, source: str):
+        torch_dtype = torch.bfloat16 if self.weight_dtype == "bfloat16" else torch.float32
+        logger.info(f"Loading model from {source} with {self.weight_dtype} weights for CPU...")
+        model = AutoModelForCausalLM.from_pretrained(
+            source,
+            torch_dtype=torch_dtype,
+            trust_remote_code=True,
+            token=config.HF_TOKEN
+        )
+        model.eval()
+        if self.weight_dtype == "int8":
+            model = self._quantize(model)
+        logger.info("Model loaded successfully for CPU inference.")
+        return model
+
+    def _quantize(self, model):
+        from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+        qconfig_spec = {
+            name: default_dynamic_qconfig
+            for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear) and name.split(".")[-1] not in config.CPU_QUANTIZE_SKIP_MODULES
+        }
+        with warnings.catch_warnings():
+            # torch.ao.quantization and quantized tensors are slated to move to torchao
+            warnings.filterwarnings("ignore", message=".*deprecated.*")
+            return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+    def get_status(self) -> Dict[str, Any]:
+        status = super().get_status()
+        status["weight_dtype"] = self.weight_dtype
+        status["num_threads"] = torch.get_num_threads()
+        if hasattr(os, "sched_getaffinity"):
+            status["cpu_affinity"] = sorted(os.sched_getaffinity(0))
+        return status
+
+BACKENDS = {backend.name: backend for backend in (BitsAndBytesBackend, CpuBackend)}
+
+def select_backend(device: str, name=None) -> InferenceBackend:
+    """Returns the INFERENCE_BACKEND from config, or the one for `device` when it's "auto"."""
+    name = name or config.INFERENCE_BACKEND
+    if name == "auto":
+        name = "cpu" if device == "cpu" else "cuda_int8"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND: {name}")
+    return BACKENDS[name](device)
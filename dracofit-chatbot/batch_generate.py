@@ -0,0 +1,98 @@
+"""
+Offline batch generation: replies to many conversations at once, e.g. to pre-generate workout
+tips for the whole exercise library. Shared by the /chat/batch routes and this CLI.
+
+Each input line is a JSON object with a "message" (one user message) or "messages" (a
+conversation of {"role", "content"} dicts, ending with the user's turn). Any other fields,
+such as an "id", are copied to the line of its reply. Replies are written as JSON lines as
+they finish (not in input order), followed by a summary with prompts/s and tokens/s.
+
+Usage: python batch_generate.py INPUT.jsonl [-o OUTPUT.jsonl] [--max-new-tokens N]
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, List
+
+import config
+
+_encode_line = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+# --- Input ---
+def parse_conversation(item) -> List[Dict[str, str]]:
+    """
+    A conversation from a batch item: a message string, a list of messages, or an object with
+    "message" or "messages". Raises ValueError if it's none of those.
+    """
+    if isinstance(item, dict):
+        if "messages" in item:
+            item = item["messages"]
+        elif "message" in item:
+            item = item["message"]
+    if isinstance(item, str):
+        item = [{"role": "user", "content": item}]
+    if not isinstance(item, list) or not item:
+        raise ValueError("Each conversation must be a message or a non-empty list of messages.")
+    for message in item:
+        if not isinstance(message, dict) or not isinstance(message.get("role"), str) or not isinstance(message.get("content"), str):
+            raise ValueError("Each message must have a string role and content.")
+    return [{"role": message["role"], "content": message["content"]} for message in item]
+
+def parse_batch_request(data) -> Dict[str, Any]:
+    """The conversations and max_new_tokens of a /chat/batch request body. Raises ValueError if it's invalid."""
+    if not isinstance(data, dict) or not isinstance(data.get("conversations"), list) or not data["conversations"]:
+        raise ValueError("Missing conversations in request body")
+    if len(data["conversations"]) > config.BATCH_MAX_CONVERSATIONS:
+        raise ValueError(f"At most {config.BATCH_MAX_CONVERSATIONS} conversations per request")
+    max_new_tokens = data.get("max_new_tokens", config.MAX_OUTPUT_LENGTH)
+    if not isinstance(max_new_tokens, int) or isinstance(max_new_tokens, bool) or max_new_tokens < 1:
+        raise ValueError("max_new_tokens must be a positive integer")
+    return {
+        "conversations": [parse_conversation(item) for item in data["conversations"]],
+        "max_new_tokens": min(max_new_tokens, config.MAX_OUTPUT_LENGTH),
+    }
+
+# --- Output ---
+def format_line(result: Dict[str, Any]) -> str:
+    """A batch result as one line of JSON."""
+    return _encode_line(result) + "\n"
+
+# --- CLI ---
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="JSONL file of conversations, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL file the replies are written to, - for stdout")
+    parser.add_argument("--max-new-tokens", type=int, default=config.MAX_OUTPUT_LENGTH)
+    args = parser.parse_args()
+
+    if config.MODEL_SERVER_ENABLED:
+        # Runs on the shared model server's scheduler, next to the API's traffic
+        from model_server import get_batch_response_stream
+    else:
+        from model import get_batch_response_stream
+
+    input_file = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    with input_file:
+        items = [json.loads(line) for line in input_file if line.strip()]
+    try:
+        conversations = [parse_conversation(item) for item in items]
+    except ValueError as e:
+        parser.error(str(e))
+
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    status = "error"
+    with output_file:
+        for result in get_batch_response_stream(conversations, args.max_new_tokens):
+            status = result["status"]
+            if status != "result":
+                print(json.dumps(result), file=sys.stderr)
+                break
+            item = items[result["index"]]
+            # Carry the input line's own fields (e.g. its id) over to the reply
+            extra = {key: value for key, value in item.items() if key not in ("message", "messages")} if isinstance(item, dict) else {}
+            output_file.write(format_line({**extra, **result}))
+            output_file.flush()
+    sys.exit(0 if status == "success" else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import time
+from typing import Any, Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "dracofit_checkpoint.json"
+
+# --- Helper Functions ---
+def quantization_settings() -> Dict[str, Any]:
+    """The config values that determine the quantized weights; a change invalidates cached checkpoints."""
+    return {
+        "load_in_8bit": config.BNB_LOAD_IN_8BIT,
+        "llm_int8_enable_fp32_cpu_offload": config.BNB_LLM_INT8_ENABLE_FP32_CPU_OFFLOAD,
+        "llm_int8_skip_modules": config.BNB_LLM_INT8_SKIP_MODULES,
+        "llm_int8_threshold": config.BNB_LLM_INT8_THRESHOLD,
+    }
+
+def checkpoint_files(path: str) -> List[str]:
+    """The safetensors weight files of a saved checkpoint."""
+    return sorted(glob.glob(os.path.join(path, "*.safetensors")))
+
+# --- Quantized Checkpoint Cache ---
+class QuantizedCheckpointCache:
+    """
+    Keeps already-quantized copies of models on disk as safetensors.
+
+    Loading a cached copy skips re-quantizing the bf16 weights, and safetensors files
+    are memory-mapped on load, so a copy still in the OS page cache loads at close to
+    memory speed. Each copy has a manifest with the model name and quantization
+    settings it was built with and is only used while they still match.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or config.QUANTIZED_CHECKPOINT_DIR
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+
+    def path_for(self, model_name: str, settings: Dict[str, Any]) -> str:
+        digest = hashlib.sha256(json.dumps([model_name, settings], sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "--", model_name.strip("/"))
+        return os.path.join(self.cache_dir, f"{safe_name}-{digest}")
+
+    def lookup(self, model_name: str, settings: Dict[str, Any]) -> Optional[str]:
+        """Returns the directory of a valid cached copy, or None."""
+        path = self.path_for(model_name, settings)
+        try:
+            with open(os.path.join(path, MANIFEST_NAME)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if manifest.get("model_name") != model_name or manifest.get("quantization") != settings or not checkpoint_files(path):
+            logger.warning(f"Ignoring stale quantized checkpoint at {path}.")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def save(self, model, tokenizer, model_name: str, settings: Dict[str, Any]) -> Optional[str]:
+        """Saves a loaded quantized model and its tokenizer. Returns the directory, or None if it couldn't be saved."""
+        device_map = getattr(model, "hf_device_map", None) or {}
+        if "disk" in device_map.values():
+            # Disk-offloaded layers aren't materialized, so the saved copy would be incomplete
+            logger.warning("Not caching the quantized checkpoint: part of the model is offloaded to disk.")
+            return None
+
+        path = self.path_for(model_name, settings)
+        staging_path = f"{path}.partial-{os.getpid()}"
+        start_time = time.perf_counter()
+        try:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            model.save_pretrained(staging_path, safe_serialization=True)
+            tokenizer.save_pretrained(staging_path)
+            with open(os.path.join(staging_path, MANIFEST_NAME), "w") as manifest_file:
+                json.dump({"model_name": model_name, "quantization": settings, "created_time": time.time()}, manifest_file)
+            # Swap in the complete copy so a crash mid-save never leaves a half-written checkpoint
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(staging_path, path)
+        except Exception as e:
+            logger.warning(f"Could not cache the quantized checkpoint: {e}")
+            shutil.rmtree(staging_path, ignore_errors=True)
+            return None
+        self.saves += 1
+        logger.info(f"Cached quantized checkpoint at {path} in {time.perf_counter() - start_time:.1f}s.")
+        return path
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "cache_dir": self.cache_dir,
+            "hits": self.hits,
+            "misses": self.misses,
+            "saves": self.saves,
+        }
+
+# --- Memory-Mapped Standby ---
+class MappedCheckpoint:
+    """
+    Keeps a checkpoint's weight files memory-mapped while the model itself is unloaded.
+
+    The mapping pins no memory: the pages are plain page cache that the OS can reclaim
+    under pressure. While they stay resident, reloading from the checkpoint reads from
+    memory instead of disk.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._files = []
+        self._maps = []
+        self.nbytes = 0
+        for file_path in checkpoint_files(path):
+            checkpoint_file = open(file_path, "rb")
+            mapped = mmap.mmap(checkpoint_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+                mapped.madvise(mmap.MADV_WILLNEED) # Ask the kernel to read the pages in ahead of the reload
+            self._files.append(checkpoint_file)
+            self._maps.append(mapped)
+            self.nbytes += len(mapped)
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        for checkpoint_file in self._files:
+            checkpoint_file.close()
+        self._maps = []
+        self._files = []
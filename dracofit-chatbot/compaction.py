@@ -0,0 +1,110 @@
+"""
+Background compaction of long conversations.
+
+Every turn sends the whole stored history, so without compaction a long chat pays a
+longer prefill (and time to first token) on each turn until the context manager starts
+dropping its oldest turns. After a reply is stored, the API schedules the conversation
+here; a worker thread asks the model to summarize the older turns once the history passes
+COMPACTION_THRESHOLD_TOKENS, and replaces them in the store with one "memory" turn. The
+next prompt is then the summary plus the recent turns, so its size stays around the
+threshold however long the chat gets, and the summarizing happens between the user's
+messages instead of on the request path. The summary is generated as a background request,
+which the scheduler only starts while no live request is queued or decoding.
+
+The two sides never undo each other's writes: the compaction only replaces the turns it
+summarized if they are still there, and /chat saves a new turn only if the history's
+version is still the one it loaded (see conversation_store.save_user_turn), redoing it on
+the compacted history otherwise.
+"""
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+import config
+from conversation_store import ConversationStore, messages_from_dicts, messages_to_dicts
+
+logger = logging.getLogger(__name__)
+
+class ConversationCompactor:
+    """
+    Runs compactions one at a time on a daemon thread. compact_fn is model.compact_conversation
+    (or the model server's); invalidate_fn drops the conversation's cached KV state, whose
+    prompt no longer matches the history.
+    """
+    def __init__(self, store: ConversationStore, compact_fn: Callable[[List[Dict[str, str]]], Optional[Dict[str, Any]]],
+                 invalidate_fn: Optional[Callable[[str], None]] = None, max_pending=config.COMPACTION_MAX_PENDING):
+        self.store = store
+        self.compact_fn = compact_fn
+        self.invalidate_fn = invalidate_fn
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._pending_ids = set()
+        self._condition = threading.Condition()
+        self._thread = None
+        self.compactions = 0
+        self.messages_compacted = 0
+        self.conflicts = 0 # The history changed while it was being summarized
+        self.failures = 0
+        self.dropped = 0 # Not scheduled because the queue was full
+
+    def schedule(self, conversation_id: str):
+        """Queues a conversation to be checked, once however often it is scheduled meanwhile."""
+        with self._condition:
+            if conversation_id in self._pending_ids:
+                return
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(conversation_id)
+            self._pending_ids.add(conversation_id)
+            # Started on first use rather than at import, so it runs in each forked worker
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="conversation-compactor", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                conversation_id = self._pending.popleft()
+                self._pending_ids.discard(conversation_id)
+            try:
+                self.compact(conversation_id)
+            except Exception:
+                self.failures += 1
+                logger.exception(f"Compacting conversation {conversation_id} failed.")
+
+    def compact(self, conversation_id: str) -> bool:
+        """Summarizes the conversation's older turns if it is long enough. True if it was compacted."""
+        messages = self.store.load(conversation_id)
+        if not messages:
+            return False
+        result = self.compact_fn(messages_to_dicts(messages))
+        if not result:
+            return False
+        compacted = result["compacted_messages"]
+        if not self.store.replace_prefix(conversation_id, messages[:compacted], messages_from_dicts([result["memory"]])):
+            self.conflicts += 1
+            logger.info(f"Conversation {conversation_id} changed while it was summarized; compaction skipped.")
+            return False
+        if self.invalidate_fn:
+            self.invalidate_fn(conversation_id)
+        self.compactions += 1
+        self.messages_compacted += compacted
+        logger.info(f"Compacted {compacted} messages of conversation {conversation_id} into a summary.")
+        return True
+
+    def get_status(self) -> Dict[str, Any]:
+        with self._condition:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "compactions": self.compactions,
+            "messages_compacted": self.messages_compacted,
+            "conflicts": self.conflicts,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
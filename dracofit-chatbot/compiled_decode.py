@@ -0,0 +1,210 @@
+"""
+Fixed-shape KV cache and torch.compile'd decode step for the generation scheduler.
+
+The eager decode loop changes shape every step (the batch cache grows by a column, rows
+join and leave), so each step runs kernel by kernel and reallocates the cache. Here every
+sequence owns a slot (row) of a KV cache preallocated for `max_length` positions, and the
+decode step only ever sees a few shapes: the batch is padded to a batch-size bucket and
+attention reads the cache up to a length bucket. Every (batch, length) shape is compiled
+once, during warm-up at load time, so no request waits for a compile. With CUDA the steps
+are also captured as CUDA graphs ("reduce-overhead"); on CPU they are compiled with Inductor.
+
+Prefill stays eager: it is one large forward pass per request, so there is little launch
+overhead to save, and its cache is copied into the request's slot afterwards.
+"""
+import bisect
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import torch
+from transformers.cache_utils import Cache
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class SlotKVCache(Cache):
+    """
+    Per-layer [slots, kv heads, max_length, head dim] key/value buffers, allocated once.
+    A slot's token at position p is stored in column p, so the single-token update writes
+    each row at its own position (cache_position holds one position per row). Attention
+    reads the first `kv_length` columns, set by the caller for each step.
+    """
+    def __init__(self, num_layers: int, num_slots: int, num_kv_heads: int, max_length: int, head_dim: int, dtype, device):
+        super().__init__()
+        self.max_length = max_length
+        self.kv_length = max_length
+        shape = (num_slots, num_kv_heads, max_length, head_dim)
+        self.key_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        for buffer in self.key_cache + self.value_cache:
+            # The buffers never move, so compiled graphs (and CUDA graphs) don't have to guard on or copy them
+            torch._dynamo.mark_static_address(buffer)
+
+    def update(self, key_states, value_states, layer_idx: int, cache_kwargs=None):
+        batch_size = key_states.shape[0]
+        rows = torch.arange(batch_size, device=key_states.device)
+        positions = cache_kwargs["cache_position"]
+        keys = self.key_cache[layer_idx]
+        values = self.value_cache[layer_idx]
+        keys[rows, :, positions] = key_states[:, :, 0]
+        values[rows, :, positions] = value_states[:, :, 0]
+        return keys[:batch_size, :, :self.kv_length], values[:batch_size, :, :self.kv_length]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        # Slots have different lengths; attention masks are always passed in explicitly
+        return 0
+
+    def get_max_cache_shape(self) -> int:
+        return self.max_length
+
+    def nbytes(self) -> int:
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.key_cache + self.value_cache)
+
+class CompiledDecoder:
+    """
+    Holds up to `num_slots` sequences in a SlotKVCache and decodes them together.
+
+    Slots are handed out lowest first, so the running sequences stay packed at the front and
+    decode runs on the smallest batch bucket that covers them. Rows of free slots in that
+    bucket decode a dummy token that only attends to (and overwrites) their first column.
+    """
+    def __init__(self, model, device, max_length: int, num_slots=config.MAX_BATCH_SIZE,
+                 length_buckets: Sequence[int] = config.COMPILED_LENGTH_BUCKETS,
+                 batch_buckets: Sequence[int] = config.COMPILED_BATCH_BUCKETS, compile=True):
+        model_config = model.config
+        self.decoder = model.get_decoder()
+        self.lm_head = model.get_output_embeddings()
+        self.logit_softcapping = getattr(model_config, "final_logit_softcapping", None)
+        self.device = device
+        self.max_length = max_length
+        self.num_slots = num_slots
+        self.length_buckets = sorted({bucket for bucket in length_buckets if bucket < max_length} | {max_length})
+        self.batch_buckets = sorted({min(bucket, num_slots) for bucket in batch_buckets} | {num_slots})
+
+        num_heads = model_config.num_attention_heads
+        num_kv_heads = getattr(model_config, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(model_config, "head_dim", None) or model_config.hidden_size // num_heads
+        self.dtype = model.get_input_embeddings().weight.dtype
+        self.cache = SlotKVCache(model_config.num_hidden_layers, num_slots, num_kv_heads, max_length, head_dim, self.dtype, device)
+
+        self._min_value = torch.finfo(self.dtype).min
+        # Decode inputs live in fixed tensors that are updated in place, one row per slot
+        self._input_ids = torch.zeros((num_slots, 1), dtype=torch.long, device=device)
+        self._positions = torch.zeros((num_slots, 1), dtype=torch.long, device=device)
+        self._mask = torch.empty((num_slots, 1, 1, max_length), dtype=self.dtype, device=device)
+        self.reset()
+
+        self.compile = compile
+        self._decode = self._decode_forward
+        if compile:
+            mode = "reduce-overhead" if str(device).startswith("cuda") else None
+            self._decode = torch.compile(self._decode_forward, mode=mode, dynamic=False)
+        self.warmup_seconds = None
+
+    def _decode_forward(self, input_ids, position_ids, attention_mask, cache):
+        hidden_states = self.decoder(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+            past_key_values=cache,
+            cache_position=position_ids[:, 0],
+            use_cache=True,
+        ).last_hidden_state
+        logits = self.lm_head(hidden_states[:, -1])
+        if self.logit_softcapping:
+            logits = torch.tanh(logits / self.logit_softcapping) * self.logit_softcapping
+        return logits
+
+    # --- Slots ---
+    def insert(self, past_key_values) -> int:
+        """Copies a prefilled sequence's legacy cache (batch of one) into a free slot and returns the slot."""
+        length = past_key_values[0][0].shape[2]
+        if length >= self.max_length:
+            raise ValueError(f"Sequence of {length} tokens does not fit the {self.max_length} position KV cache.")
+        if not self._free_slots:
+            raise RuntimeError("No free KV cache slot.")
+        slot = self._free_slots.pop(0)
+        for layer, (key, value) in enumerate(past_key_values):
+            self.cache.key_cache[layer][slot, :, :length] = key[0]
+            self.cache.value_cache[layer][slot, :, :length] = value[0]
+        self._mask[slot] = self._min_value
+        self._mask[slot, :, :, :length] = 0
+        return slot
+
+    def decode(self, slots: List[int], token_ids: List[int], positions: List[int]) -> torch.Tensor:
+        """Feeds each slot's next token at its position. Returns logits [len(slots), vocab], in the order of `slots`."""
+        batch_size = self.batch_buckets[bisect.bisect_right(self.batch_buckets, max(slots))]
+        kv_length = self.length_buckets[bisect.bisect_right(self.length_buckets, max(positions))]
+        index = torch.tensor(slots, device=self.device)
+        position_index = torch.tensor(positions, device=self.device)
+        self._input_ids[index, 0] = torch.tensor(token_ids, device=self.device)
+        self._positions[index, 0] = position_index
+        self._mask[index, 0, 0, position_index] = 0
+        self.cache.kv_length = kv_length
+        logits = self._decode(self._input_ids[:batch_size], self._positions[:batch_size], self._mask[:batch_size, :, :, :kv_length], self.cache)
+        return logits.index_select(0, index)
+
+    def export(self, slot: int, length: int):
+        """The slot's first `length` positions as a legacy cache, e.g. for the session store."""
+        return tuple(
+            (key[slot:slot + 1, :, :length].clone(), value[slot:slot + 1, :, :length].clone())
+            for key, value in zip(self.cache.key_cache, self.cache.value_cache)
+        )
+
+    def release(self, slot: int):
+        self._clear(slot)
+        bisect.insort(self._free_slots, slot)
+
+    def reset(self):
+        """Frees every slot, e.g. after the scheduler dropped its batch on an error."""
+        for slot in range(self.num_slots):
+            self._clear(slot)
+        self._free_slots = list(range(self.num_slots))
+
+    def _clear(self, slot: int):
+        """Turns the slot's decode row back into a free one, which attends to its first column only (so it never produces NaNs)."""
+        self._input_ids[slot] = 0
+        self._positions[slot] = 0
+        self._mask[slot] = self._min_value
+        self._mask[slot, :, :, 0] = 0
+
+    # --- Warm-up ---
+    def warm_up(self):
+        """Runs every (batch, length) bucket once so all shapes are compiled before the first request."""
+        if len(self._free_slots) != self.num_slots:
+            raise RuntimeError("Warm-up needs every slot free.")
+        shapes = len(self.length_buckets) * len(self.batch_buckets)
+        if self.compile:
+            # One graph per shape; don't let dynamo fall back to eager after its default 8. Its config
+            # is per thread, so this is set on the thread that compiles (and later runs) the steps
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, shapes)
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            for kv_length in self.length_buckets:
+                for batch_size in self.batch_buckets:
+                    # Only the bucket's last (free) slot is fed, at the bucket's last position
+                    self.decode([batch_size - 1], [0], [kv_length - 1])
+                    self._clear(batch_size - 1)
+        self.warmup_seconds = time.perf_counter() - start_time
+        logger.info(f"Warmed up {shapes} decode shapes in {self.warmup_seconds:.1f}s.")
+
+    def close(self):
+        """Drops the compiled graphs (and their CUDA graph memory pools) along with the cache."""
+        if self.compile:
+            # The graphs hold on to the model's weights; dynamo's caches are process-wide
+            torch._dynamo.reset()
+        self._decode = None
+        self.cache = None
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "compiled": self.compile,
+            "max_length": self.max_length,
+            "slots_in_use": self.num_slots - len(self._free_slots),
+            "kv_cache_mb": round(self.cache.nbytes() / 1024**2, 2),
+            "length_buckets": self.length_buckets,
+            "batch_buckets": self.batch_buckets,
+            "warmup_seconds": round(self.warmup_seconds, 1) if self.warmup_seconds is not None else None,
+        }
@@ -0,0 +1,150 @@
+import os
+
+# --- Hugging Face ---
+# Use environment variable for the token for better security
+# Ensure HF_TOKEN environment variable is set in your deployment environment.
+HF_TOKEN = os.environ.get("HF_TOKEN")
+if HF_TOKEN is None:
+    print("Warning: HF_TOKEN environment variable not set. Model loading might fail.")
+    # Or raise an error:
+    # raise ValueError("HF_TOKEN environment variable not set.")
+
+# --- Model Configuration ---
+DEFAULT_MODEL_NAME = os.environ.get("DRACOBOT_MODEL", "google/gemma-2-2b-it") # Hub id or local path
+SYSTEM_PROMPT = (
+    "You are DracoBot, a fitness assistant for the DracoFit application. "
+    "You help users with workout recommendations, nutrition advice, and fitness goals. "
+    "You should provide accurate information and support users in their fitness journey. "
+    "Answer all questions directly, including questions about your identity as an AI assistant. "
+    "Keep responses concise, informative, and focused on fitness."
+)
+OFFLOAD_FOLDER = "offload" # Folder for offloaded layers
+
+# --- Inference Backend ---
+INFERENCE_BACKEND = "auto" # "auto" picks from the device: "cuda_int8" (bitsandbytes) on GPU, "cpu" otherwise
+CPU_WEIGHT_DTYPE = "int8" # "int8" (dynamically quantized Linear layers), "bfloat16" (needs native CPU support) or "float32"
+CPU_QUANTIZE_SKIP_MODULES = ["lm_head"] # Linear layers kept in full precision, as with BNB_LLM_INT8_SKIP_MODULES
+CPU_NUM_THREADS = None # Intra-op threads; None uses one per physical core available to the process
+CPU_NUM_INTEROP_THREADS = 1 # Decoding is one sequential graph, extra inter-op threads only contend
+CPU_CORE_AFFINITY = None # Cores to pin the process to, e.g. [0, 1, 2, 3]; None leaves affinity unchanged
+
+# --- Generation Parameters ---
+MAX_OUTPUT_LENGTH = 1024 # Max *new* tokens to generate
+TEMPERATURE = 0.3       # Controls randomness (lower = more deterministic)
+TOP_P = 0.85            # Nucleus sampling probability threshold
+TOP_K = 40              # Consider only top_k tokens for sampling
+DO_SAMPLE = True        # Whether to use sampling; False means greedy decoding
+REPETITION_PENALTY = 1.2 # Penalize repeated tokens
+NO_REPEAT_NGRAM_SIZE = 3 # Prevent repeating n-grams of this size
+EARLY_STOPPING = True   # Stop generation when EOS token is reached
+
+# --- Streaming Output ---
+STREAM_FLUSH_INTERVAL_MS = 50 # Chunks decoded within this window are sent as one SSE frame; 0 sends every chunk as it comes
+STREAM_FLUSH_MAX_BYTES = 256 # Pending text is sent early once it reaches this size
+
+# --- Startup ---
+PRELOAD_MODEL_ON_STARTUP = True # Start loading the model in the background when the API boots
+WARMUP_ON_LOAD = True # Run one short generation after loading so the first request isn't slowed by lazy initialization
+WARMUP_PROMPT = "Hi"
+WARMUP_MAX_NEW_TOKENS = 8
+
+# --- Generation Scheduler ---
+MAX_BATCH_SIZE = 8 # Max sequences decoded together in one continuous batch
+SESSION_KV_CACHE_MAX_MB = 512 # Memory budget for per-conversation KV caches (LRU evicted)
+STATIC_KV_CACHE_BLOCK_SIZE = 256 # Positions a preallocated batch KV cache grows by when it runs out of room
+
+# --- Compiled Decoding ---
+COMPILED_DECODE = False # Decode into a KV cache preallocated for MAX_BATCH_SIZE full-length sequences, with fixed-shape steps
+COMPILED_DECODE_TORCH_COMPILE = True # torch.compile the steps (CUDA graphs on GPU); False runs the same fixed shapes eagerly
+COMPILED_MAX_CACHE_LENGTH = None # Positions per sequence (prompt + new tokens); None uses the context budget. Also caps the context budget
+COMPILED_LENGTH_BUCKETS = (512, 1024, 2048, 4096) # KV lengths decode attends over (the max length is always added)
+COMPILED_BATCH_BUCKETS = (1, 2, 4, 8) # Batch sizes decode runs at (MAX_BATCH_SIZE is always added); one compile per length x batch bucket
+
+# --- Batch Generation ---
+BATCH_BUCKET_SIZE = MAX_BATCH_SIZE # Prompts of similar length an offline batch job submits (and prefills) together
+BATCH_MAX_BUCKETS_IN_FLIGHT = 2 # Buckets queued on the scheduler at once; the rest wait, so /chat requests aren't stuck behind a whole job
+BATCH_MAX_CONVERSATIONS = 1000 # Largest /chat/batch request
+
+# --- Admission Control ---
+ADMISSION_MAX_IN_FLIGHT = MAX_BATCH_SIZE # /chat generations running at once per API worker; more wait in the queue
+ADMISSION_MAX_IN_FLIGHT_PER_USER = 2 # Generations one session may run at once
+ADMISSION_MAX_QUEUE = 32 # Requests waiting for a slot; beyond this new requests get a 503
+ADMISSION_MAX_QUEUED_PER_USER = 2 # Requests one session may have waiting; beyond this it gets a 429
+ADMISSION_QUEUE_TIMEOUT_SECONDS = 30 # A request still waiting after this gets a 503
+ADMISSION_INITIAL_HOLD_SECONDS = 10 # Assumed generation time for Retry-After estimates until some have finished
+# /chat/batch jobs have their own slots, so a long job neither takes a /chat slot nor skews /chat's Retry-After estimates
+BATCH_ADMISSION_MAX_IN_FLIGHT = 1 # Batch jobs running at once per API worker
+BATCH_ADMISSION_MAX_QUEUE = 4 # Batch jobs waiting for a slot; beyond this new jobs get a 503
+BATCH_ADMISSION_QUEUE_TIMEOUT_SECONDS = 30 # A job still waiting after this gets a 503
+BATCH_ADMISSION_INITIAL_HOLD_SECONDS = 300 # Assumed job run time for Retry-After estimates until some have finished
+
+# --- Speculative Decoding ---
+SPECULATIVE_DECODING = None # None (off), "prompt_lookup" (n-gram drafts from the context) or "draft_model"
+SPECULATIVE_NUM_DRAFT_TOKENS = 5 # Tokens drafted and verified per step
+PROMPT_LOOKUP_MAX_NGRAM_SIZE = 3 # Longest n-gram matched against the context when drafting by prompt lookup
+SPECULATIVE_DRAFT_MODEL_NAME = None # Small model sharing the main model's tokenizer, used with "draft_model"
+
+# --- Response Cache ---
+RESPONSE_CACHE_ENABLED = True # Replay stored answers to repeated questions instead of generating
+RESPONSE_CACHE_MAX_ENTRIES = 1024 # Least recently used answers are evicted beyond this
+RESPONSE_CACHE_TTL_SECONDS = 86400 # 1 day (time before a cached answer expires)
+RESPONSE_CACHE_SEMANTIC = False # Also match similarly worded questions (requires sentence-transformers)
+RESPONSE_CACHE_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = 0.92 # Min cosine similarity for a semantic hit
+
+# --- Conversation Store ---
+CONVERSATION_STORE = "auto" # "memory" (per process, LRU bounded), "sqlite" (shared by all workers on the host) or "auto" (sqlite with MODEL_SERVER_ENABLED, else memory)
+CONVERSATION_STORE_MAX_MB = 64 # Memory budget of the "memory" store; least recently used conversations are evicted
+CONVERSATION_STORE_PATH = "conversations.sqlite3" # Database file of the "sqlite" store
+CONVERSATION_STORE_TTL_SECONDS = 7 * 86400 # Conversations untouched for this long are forgotten
+
+# --- Conversation Compaction ---
+COMPACTION_ENABLED = True # After a reply, summarize the older turns of long conversations in the background
+COMPACTION_THRESHOLD_TOKENS = 1536 # A stored conversation longer than this (in prompt tokens) is compacted
+COMPACTION_KEEP_RECENT_MESSAGES = 4 # Latest messages kept word for word next to the summary
+COMPACTION_SUMMARY_MAX_TOKENS = 256 # Max new tokens of a summary
+COMPACTION_TIMEOUT_SECONDS = 300 # How long the API waits for a summary from the model server
+COMPACTION_MAX_PENDING = 1000 # Conversations waiting to be checked; more are skipped until their next reply
+COMPACTION_PROMPT = (
+    "Summarize the conversation below between a user and DracoBot for DracoBot to remember. "
+    "Keep the user's goals, stats, preferences, injuries and schedule, and any plans or advice already given. "
+    "Use short sentences and no more than a paragraph."
+)
+
+# --- Context Window ---
+CONTEXT_TOKEN_BUDGET = None # Max prompt + new tokens per request; None uses the model's max_position_embeddings. Capped at its sliding window, if any
+PROMPT_TOKEN_CACHE_SIZE = 4096 # Tokenized turns kept so a new turn only tokenizes the new message
+
+# --- Resource Management ---
+MAX_IDLE_TIME_SECONDS = 3600 # 1 hour (time before unloading inactive model)
+CUDA_ALLOC_CONF = 'max_split_size_mb:128' # Memory allocation setting
+IDLE_CHECK_INTERVAL_SECONDS = 60 # How often the background reaper checks for an idle model
+STANDBY_TIER = "host" # On idle unload: "host" (park weights in host RAM), "mmap" (keep the cached checkpoint mapped) or None
+STANDBY_MAX_SECONDS = 6 * 3600 # A standby model is released completely after this much more idle time
+QUANTIZED_CHECKPOINT_CACHE = True # Save the quantized model once and load that instead of re-quantizing
+QUANTIZED_CHECKPOINT_DIR = "quantized_cache" # Folder for cached quantized checkpoints (safetensors)
+MEMORY_HIGH_WATERMARK = 0.90 # Fraction of device memory (CUDA reserved or host RSS) that triggers reclaiming
+MEMORY_LOW_WATERMARK = 0.75 # Reclaiming stops once usage is back below this fraction
+MEMORY_CHECK_INTERVAL_SECONDS = 1.0 # Minimum time between memory pressure checks
+
+# --- Logging ---
+LOG_LEVEL = "INFO" # e.g., DEBUG, INFO, WARNING, ERROR
+
+# --- Quantization ---
+# BitsAndBytesConfig settings
+BNB_LOAD_IN_8BIT = True
+BNB_LLM_INT8_ENABLE_FP32_CPU_OFFLOAD = True
+BNB_LLM_INT8_SKIP_MODULES = ["lm_head"]
+BNB_LLM_INT8_THRESHOLD = 6.0
+
+# --- Flask App ---
+SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "a-default-development-secret-key") # Add a default for dev
+
+# --- Model Server ---
+MODEL_SERVER_ENABLED = False # API workers use the shared model_server.py process instead of loading the model themselves
+MODEL_SERVER_SOCKET = "/tmp/dracofit-model.sock" # Unix socket the model server listens on
+MODEL_SERVER_AUTHKEY = os.environ.get("MODEL_SERVER_AUTHKEY", SECRET_KEY) # Shared secret workers authenticate with
+MODEL_SERVER_MAX_INFLIGHT_PER_WORKER = 8 # Concurrent generations per API worker; further requests wait for a slot
+MODEL_SERVER_ACQUIRE_TIMEOUT_SECONDS = 30 # How long a request waits for a slot before failing as busy
+MODEL_SERVER_SEND_QUEUE_SIZE = 256 # Messages buffered per worker before that worker's streams are paused
+MODEL_SERVER_CALL_TIMEOUT_SECONDS = 10 # Timeout for non-streaming calls (fit, health, readiness)
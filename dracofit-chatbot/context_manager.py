@@ -0,0 +1,93 @@
+import logging
+from typing import Any, Dict, List
+
+import config
+from prompt_tokenizer import PromptTokenizer, format_history_turn, format_turn
+
+logger = logging.getLogger(__name__)
+
+# --- Context Window Manager ---
+class ContextWindowManager:
+    """
+    Fits a conversation into a token budget instead of keeping a fixed number of messages.
+
+    The budget is the model's context length minus the room reserved for new tokens.
+    The latest message is always kept (truncated if it alone is too long), then older
+    turns are added back newest first for as long as they fit. Turn lengths come from
+    the PromptTokenizer's per-turn cache, so a new turn only tokenizes the new message.
+    """
+    def __init__(self, prompt_tokenizer: PromptTokenizer, max_context_tokens: int, reserved_new_tokens=config.MAX_OUTPUT_LENGTH):
+        self.prompt_tokenizer = prompt_tokenizer
+        self.budget = max_context_tokens - reserved_new_tokens
+        if self.budget <= 0:
+            raise ValueError(f"Context of {max_context_tokens} tokens leaves no room for {reserved_new_tokens} new tokens.")
+        self.trimmed_conversations = 0
+        self.last_prompt_tokens = 0
+
+    def count_tokens(self, text: str) -> int:
+        return self.prompt_tokenizer.count_tokens(text)
+
+    def fit(self, system_turn: str, conversation: List[Dict[str, str]], generation_prompt: str) -> List[Dict[str, str]]:
+        """Returns the most recent part of the conversation whose prompt fits the token budget."""
+        if not conversation:
+            return conversation
+        available = self._available(system_turn, generation_prompt)
+
+        # The latest message is always templated as a user turn
+        latest_message = conversation[-1]
+        latest_tokens = self.count_tokens(format_turn("user", latest_message["content"]))
+        if latest_tokens > available:
+            latest_message = self._truncate(latest_message, available)
+            latest_tokens = self.count_tokens(format_turn("user", latest_message["content"]))
+        available -= latest_tokens
+
+        kept = [latest_message]
+        for message in reversed(conversation[:-1]):
+            message_tokens = self.count_tokens(format_history_turn(message))
+            if message_tokens > available:
+                break
+            available -= message_tokens
+            kept.append(message)
+        kept.reverse()
+
+        # Don't start a trimmed history with an orphaned model reply
+        while 1 < len(kept) < len(conversation) and kept[0]["role"] != "user":
+            available += self.count_tokens(format_history_turn(kept[0]))
+            kept.pop(0)
+
+        self.last_prompt_tokens = self.budget - available
+        if len(kept) < len(conversation) or latest_message is not conversation[-1]:
+            self.trimmed_conversations += 1
+            logger.debug(f"Trimmed conversation from {len(conversation)} to {len(kept)} messages to fit {self.budget} tokens.")
+        return kept
+
+    def fits_whole(self, system_turn: str, message: Dict[str, str], generation_prompt: str) -> bool:
+        """Whether a one-message conversation fits the budget without truncating the message."""
+        return self.count_tokens(format_turn("user", message["content"])) <= self._available(system_turn, generation_prompt)
+
+    def _available(self, system_turn: str, generation_prompt: str) -> int:
+        """Tokens left for the conversation's turns."""
+        return self.budget - self.prompt_tokenizer.special_token_count - self.count_tokens(system_turn) - self.count_tokens(generation_prompt)
+
+    def _truncate(self, message: Dict[str, str], max_tokens: int) -> Dict[str, str]:
+        """Keeps the end of an over-long message, where the actual question usually is."""
+        tokenizer = self.prompt_tokenizer.tokenizer
+        content_ids = tokenizer(message["content"], add_special_tokens=False).input_ids
+        keep = max(max_tokens - self.count_tokens(format_turn("user", "")), 0)
+        while True:
+            content = tokenizer.decode(content_ids[-keep:]) if keep else ""
+            excess = self.count_tokens(format_turn("user", content)) - max_tokens
+            # Re-tokenizing the cut text can merge differently, so re-check the result
+            if excess <= 0 or keep == 0:
+                break
+            keep = max(keep - excess, 0)
+        logger.warning(f"Latest message truncated from {len(content_ids)} to {keep} tokens to fit the context window.")
+        return {**message, "content": content}
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "token_budget": self.budget,
+            "last_prompt_tokens": self.last_prompt_tokens,
+            "trimmed_conversations": self.trimmed_conversations,
+            "token_cache": self.prompt_tokenizer.get_status(),
+        }
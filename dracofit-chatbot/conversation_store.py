@@ -0,0 +1,316 @@
+"""
+Server-side conversation history, keyed by the session's conversation id.
+
+The session cookie only carries the id; the messages live here. Messages are kept in a
+compact form (role and content), and a finished reply is appended so the next turn's
+prompt includes it. Every write bumps the conversation's version, so a request that saves
+the history it loaded earlier can check nothing (e.g. a compaction) replaced it meanwhile.
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Stored Conversations ---
+class StoredMessage:
+    """One turn of a conversation."""
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+    @property
+    def nbytes(self) -> int:
+        # Approximate, used for the in-memory store's size bound
+        return len(self.content.encode("utf-8")) + 64
+
+def messages_from_dicts(conversation: List[Dict[str, str]]) -> List[StoredMessage]:
+    return [StoredMessage(message["role"], message["content"]) for message in conversation]
+
+def messages_to_dicts(messages: List[StoredMessage]) -> List[Dict[str, str]]:
+    return [message.to_dict() for message in messages]
+
+def _encode_messages(messages: List[StoredMessage]) -> bytes:
+    """[[role, content], ...] as JSON."""
+    return json.dumps([[message.role, message.content] for message in messages], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _decode_messages(data: bytes) -> List[StoredMessage]:
+    # Rows written by earlier versions have a third item (token ids, never filled in), which is ignored
+    return [StoredMessage(item[0], item[1]) for item in json.loads(data.decode("utf-8"))]
+
+def _starts_with(messages: List[StoredMessage], prefix: List[StoredMessage]) -> bool:
+    return len(prefix) <= len(messages) and all(
+        (message.role, message.content) == (expected.role, expected.content) for message, expected in zip(messages, prefix)
+    )
+
+# --- Backends ---
+class ConversationStore:
+    """Interface shared by the backends. Every method is safe to call from several threads."""
+    name = None
+
+    def load(self, conversation_id: str) -> List[StoredMessage]:
+        """The conversation's messages, empty if it is unknown or expired."""
+        return self.load_versioned(conversation_id)[0]
+
+    def load_versioned(self, conversation_id: str) -> Tuple[List[StoredMessage], int]:
+        """The conversation's messages and version, which is 0 for an unknown conversation."""
+        raise NotImplementedError
+
+    def save(self, conversation_id: str, messages: List[StoredMessage], expected_version: Optional[int] = None) -> bool:
+        """
+        Replaces the conversation's messages, e.g. after appending a turn and trimming old ones.
+        With expected_version, only if the conversation is still at that version; False if not.
+        """
+        raise NotImplementedError
+
+    def append(self, conversation_id: str, message: StoredMessage):
+        raise NotImplementedError
+
+    def replace_prefix(self, conversation_id: str, old_messages: List[StoredMessage], new_messages: List[StoredMessage]) -> bool:
+        """
+        Replaces the conversation's first messages with new_messages if they still are
+        old_messages (same roles and contents), as one atomic step. False if they changed.
+        """
+        raise NotImplementedError
+
+    def delete(self, conversation_id: str):
+        raise NotImplementedError
+
+    def get_status(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    LRU dict bounded by the approximate size of the stored messages. Each process has its
+    own, so with several API workers use the SQLite store (or sticky sessions).
+    CONVERSATION_STORE="auto" picks SQLite when MODEL_SERVER_ENABLED says there are several.
+    """
+    name = "memory"
+
+    def __init__(self, max_bytes=config.CONVERSATION_STORE_MAX_MB * 1024**2, ttl_seconds=config.CONVERSATION_STORE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # conversation id -> (updated time, messages, nbytes, version)
+        self._lock = Lock()
+        self.total_bytes = 0
+        self.evictions = 0
+
+    def load_versioned(self, conversation_id: str) -> Tuple[List[StoredMessage], int]:
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return [], 0
+            if self.ttl_seconds and time.time() - entry[0] > self.ttl_seconds:
+                self._remove(conversation_id)
+                return [], 0
+            self._entries.move_to_end(conversation_id)
+            return list(entry[1]), entry[3]
+
+    def save(self, conversation_id: str, messages: List[StoredMessage], expected_version: Optional[int] = None) -> bool:
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if expected_version is not None and (entry[3] if entry else 0) != expected_version:
+                return False
+            self._store(conversation_id, list(messages))
+            return True
+
+    def append(self, conversation_id: str, message: StoredMessage):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            self._store(conversation_id, (list(entry[1]) if entry else []) + [message])
+
+    def replace_prefix(self, conversation_id: str, old_messages: List[StoredMessage], new_messages: List[StoredMessage]) -> bool:
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            messages = entry[1] if entry else []
+            if not _starts_with(messages, old_messages):
+                return False
+            self._store(conversation_id, list(new_messages) + messages[len(old_messages):])
+            return True
+
+    def _store(self, conversation_id: str, messages: List[StoredMessage]):
+        nbytes = sum(message.nbytes for message in messages)
+        entry = self._entries.get(conversation_id)
+        version = entry[3] + 1 if entry else 1
+        self._remove(conversation_id)
+        self._entries[conversation_id] = (time.time(), messages, nbytes, version)
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            evicted_id = next(iter(self._entries))
+            self._remove(evicted_id)
+            self.evictions += 1
+            logger.debug(f"Evicted stored conversation {evicted_id}.")
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            self._remove(conversation_id)
+
+    def _remove(self, conversation_id: str):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def get_status(self) -> Dict[str, Any]:
+        status = super().get_status()
+        status.update({
+            "conversations": len(self._entries),
+            "memory_mb": round(self.total_bytes / 1024**2, 2),
+            "budget_mb": round(self.max_bytes / 1024**2, 2),
+            "evictions": self.evictions,
+        })
+        return status
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    One row per conversation in a SQLite file, shared by every worker on the host.
+    WAL mode lets workers read while another one writes.
+    """
+    name = "sqlite"
+    PRUNE_EVERY_SAVES = 1000 # Expired rows are deleted every this many saves
+
+    def __init__(self, path=config.CONVERSATION_STORE_PATH, ttl_seconds=config.CONVERSATION_STORE_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._lock = Lock()
+        self._saves = 0
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL") # A crash may lose the last turns, not corrupt the file
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "conversation_id TEXT PRIMARY KEY, messages BLOB NOT NULL, updated_time REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(conversations)")]
+            if "version" not in columns:
+                # Files created before conversations had versions
+                self._connection.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS conversations_updated_time ON conversations (updated_time)")
+
+    def load_versioned(self, conversation_id: str) -> Tuple[List[StoredMessage], int]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT messages, updated_time, version FROM conversations WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return [], 0
+        if self.ttl_seconds and time.time() - row[1] > self.ttl_seconds:
+            # Still at its version, so a save expecting it overwrites the expired row
+            return [], row[2]
+        return _decode_messages(row[0]), row[2]
+
+    def save(self, conversation_id: str, messages: List[StoredMessage], expected_version: Optional[int] = None) -> bool:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                if expected_version is not None:
+                    row = self._connection.execute(
+                        "SELECT version FROM conversations WHERE conversation_id = ?", (conversation_id,)
+                    ).fetchone()
+                    if (row[0] if row else 0) != expected_version:
+                        self._connection.execute("COMMIT")
+                        return False
+                self._write(conversation_id, messages)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._saves += 1
+            if self.ttl_seconds and self._saves % self.PRUNE_EVERY_SAVES == 0:
+                self._connection.execute("DELETE FROM conversations WHERE updated_time < ?", (time.time() - self.ttl_seconds,))
+            return True
+
+    def append(self, conversation_id: str, message: StoredMessage):
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front, so another worker can't append in between
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT messages FROM conversations WHERE conversation_id = ?", (conversation_id,)
+                ).fetchone()
+                messages = _decode_messages(row[0]) if row else []
+                messages.append(message)
+                self._write(conversation_id, messages)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def replace_prefix(self, conversation_id: str, old_messages: List[StoredMessage], new_messages: List[StoredMessage]) -> bool:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT messages FROM conversations WHERE conversation_id = ?", (conversation_id,)
+                ).fetchone()
+                messages = _decode_messages(row[0]) if row else []
+                replaced = _starts_with(messages, old_messages)
+                if replaced:
+                    self._write(conversation_id, list(new_messages) + messages[len(old_messages):])
+                self._connection.execute("COMMIT")
+                return replaced
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _write(self, conversation_id: str, messages: List[StoredMessage]):
+        self._connection.execute(
+            "INSERT INTO conversations (conversation_id, messages, updated_time, version) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT (conversation_id) DO UPDATE SET messages = excluded.messages, updated_time = excluded.updated_time, "
+            "version = conversations.version + 1",
+            (conversation_id, _encode_messages(messages), time.time()),
+        )
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,))
+
+    def get_status(self) -> Dict[str, Any]:
+        status = super().get_status()
+        with self._lock:
+            count, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(messages)), 0) FROM conversations").fetchone()
+        status.update({"path": self.path, "conversations": count, "stored_mb": round(size / 1024**2, 2)})
+        return status
+
+BACKENDS = {backend.name: backend for backend in (InMemoryConversationStore, SQLiteConversationStore)}
+
+def create_conversation_store(name=None) -> ConversationStore:
+    """Returns the CONVERSATION_STORE backend from config."""
+    name = name or config.CONVERSATION_STORE
+    if name == "auto":
+        # The shared model server is there for several API workers, which must share the history too
+        name = "sqlite" if config.MODEL_SERVER_ENABLED else "memory"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown CONVERSATION_STORE: {name}")
+    if name == "memory" and config.MODEL_SERVER_ENABLED:
+        logger.warning("The memory conversation store is per worker: with several API workers, a conversation's history "
+                       "is lost whenever its requests land on another worker. Use CONVERSATION_STORE='sqlite' (or 'auto').")
+    return BACKENDS[name]()
+
+def save_user_turn(store: ConversationStore, conversation_id: str, content: str,
+                   fit_fn: Callable[[List[Dict[str, str]]], List[Dict[str, str]]]) -> List[Dict[str, str]]:
+    """
+    Adds the user's message to the stored history, fitted to the context by fit_fn, and returns
+    it. Saved only if the conversation wasn't written meanwhile (e.g. by a compaction replacing
+    its older turns), otherwise redone on the new history, so no other write is undone.
+    """
+    while True:
+        messages, version = store.load_versioned(conversation_id)
+        history = fit_fn(messages_to_dicts(messages) + [{"role": "user", "content": content}])
+        if store.save(conversation_id, messages_from_dicts(history), expected_version=version):
+            return history
+        logger.info(f"Conversation {conversation_id} changed while its new turn was added; retrying.")
@@ -0,0 +1,257 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Helper Functions ---
+def cache_nbytes(past_key_values) -> int:
+    """Returns the memory held by a legacy (tuple of (key, value) per layer) cache, in bytes."""
+    if past_key_values is None:
+        return 0
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in past_key_values
+    )
+
+def crop_cache(past_key_values, length: int):
+    """Keeps only the first `length` positions of every layer of a legacy cache."""
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+def common_prefix_length(a, b) -> int:
+    """Length of the longest common prefix of two 1D token id tensors."""
+    length = min(len(a), len(b))
+    mismatches = (a[:length] != b[:length]).nonzero()
+    return int(mismatches[0]) if len(mismatches) else length
+
+# --- Preallocated Batch Cache ---
+class StaticKVCache(DynamicCache):
+    """
+    A cache whose per-layer key/value buffers are preallocated and written in place.
+
+    DynamicCache concatenates every new token onto the cache, reallocating and copying all
+    of it each decode step. Here buffers have spare capacity, rounded up to `block_size`
+    positions, and only grow (by whole blocks) when it runs out. key_cache/value_cache
+    hold views of the filled part, so everything that reads a DynamicCache works unchanged.
+    """
+    def __init__(self, block_size=config.STATIC_KV_CACHE_BLOCK_SIZE):
+        super().__init__()
+        self.block_size = block_size
+        self._key_buffers = []
+        self._value_buffers = []
+        self._legacy_cache = None
+
+    @classmethod
+    def from_legacy_cache(cls, past_key_values, block_size=config.STATIC_KV_CACHE_BLOCK_SIZE) -> "StaticKVCache":
+        cache = cls(block_size)
+        for key, value in past_key_values:
+            length = key.shape[2]
+            cache._key_buffers.append(cache._allocate(key, length))
+            cache._value_buffers.append(cache._allocate(value, length))
+            cache._key_buffers[-1][:, :, :length] = key
+            cache._value_buffers[-1][:, :, :length] = value
+            cache.key_cache.append(cache._key_buffers[-1][:, :, :length])
+            cache.value_cache.append(cache._value_buffers[-1][:, :, :length])
+        cache._seen_tokens = past_key_values[0][0].shape[2] if past_key_values else 0
+        return cache
+
+    def _allocate(self, like, length: int):
+        capacity = (length // self.block_size + 1) * self.block_size # Always room for at least one more token
+        return like.new_empty((like.shape[0], like.shape[1], capacity, like.shape[3]))
+
+    def update(self, key_states, value_states, layer_idx: int, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        self._legacy_cache = None
+        if layer_idx >= len(self._key_buffers):
+            # A layer the cache hasn't seen yet: start its buffers from these states
+            self._key_buffers.append(self._allocate(key_states, 0))
+            self._value_buffers.append(self._allocate(value_states, 0))
+            self.key_cache.append(key_states[:, :, :0])
+            self.value_cache.append(value_states[:, :, :0])
+
+        start = self.key_cache[layer_idx].shape[2]
+        end = start + key_states.shape[2]
+        if end > self._key_buffers[layer_idx].shape[2]:
+            for buffers in (self._key_buffers, self._value_buffers):
+                grown = self._allocate(buffers[layer_idx], end)
+                grown[:, :, :start] = buffers[layer_idx][:, :, :start]
+                buffers[layer_idx] = grown
+        self._key_buffers[layer_idx][:, :, start:end] = key_states
+        self._value_buffers[layer_idx][:, :, start:end] = value_states
+        self.key_cache[layer_idx] = self._key_buffers[layer_idx][:, :, :end]
+        self.value_cache[layer_idx] = self._value_buffers[layer_idx][:, :, :end]
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def to_legacy_cache(self):
+        # Returns the same tuple until the next update, so callers can tell it still belongs to this cache
+        if self._legacy_cache is None:
+            self._legacy_cache = super().to_legacy_cache()
+        return self._legacy_cache
+
+    def holds(self, past_key_values) -> bool:
+        """Whether `past_key_values` is this cache's current legacy view, i.e. nothing rebuilt it since."""
+        return past_key_values is not None and past_key_values is self._legacy_cache
+
+    def capacity_nbytes(self) -> int:
+        return sum(buffer.numel() * buffer.element_size() for buffer in self._key_buffers + self._value_buffers)
+
+# --- System Prompt Prefix ---
+class PrefixKVCache:
+    """
+    Holds the token ids and past_key_values of the fixed system-prompt turn.
+
+    Every prompt starts with the same system turn, so its prefill is done once and
+    reused by each request. The cache is rebuilt only when the prefix text or the
+    model instance changes.
+    """
+    def __init__(self):
+        self.text = None
+        self.input_ids = None # 1D tensor, includes the BOS token
+        self.past_key_values = None
+        self.build_time_seconds = 0.0
+        self.hits = 0
+        self._model_id = None
+
+    def is_valid_for(self, model, text: str) -> bool:
+        return self.past_key_values is not None and self.text == text and self._model_id == id(model)
+
+    def build(self, model, tokenizer, text: str, device):
+        start_time = time.perf_counter()
+        input_ids = tokenizer(text, return_tensors="pt").input_ids
+        # An explicit DynamicCache, since Gemma 2 would otherwise build a HybridCache with no legacy form
+        outputs = model(input_ids=input_ids.to(device), past_key_values=DynamicCache(), use_cache=True)
+        past_key_values = outputs.past_key_values.to_legacy_cache()
+
+        self.text = text
+        self.input_ids = input_ids[0]
+        self.past_key_values = past_key_values
+        self._model_id = id(model)
+        self.build_time_seconds = time.perf_counter() - start_time
+        logger.info(f"System prompt prefix cached: {len(self.input_ids)} tokens in {self.build_time_seconds:.3f}s.")
+
+    def matches(self, input_ids) -> bool:
+        """True if the prompt token ids start with the cached prefix ids."""
+        if self.input_ids is None:
+            return False
+        prefix_length = len(self.input_ids)
+        # The prefix must leave at least one token to prefill so the model produces logits
+        return len(input_ids) > prefix_length and torch.equal(input_ids[:prefix_length], self.input_ids)
+
+    def clear(self):
+        self.text = None
+        self.input_ids = None
+        self.past_key_values = None
+        self._model_id = None
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "tokens": 0 if self.input_ids is None else len(self.input_ids),
+            "memory_mb": round(cache_nbytes(self.past_key_values) / 1024**2, 2),
+            "build_time_seconds": round(self.build_time_seconds, 3),
+            "hits": self.hits,
+        }
+
+# --- Per-Conversation Store ---
+class _SessionEntry:
+    def __init__(self, token_ids, past_key_values):
+        self.token_ids = token_ids # 1D tensor of the ids the cache was computed for
+        self.past_key_values = past_key_values
+        self.nbytes = cache_nbytes(past_key_values)
+
+class SessionKVStore:
+    """
+    LRU store of each conversation's KV cache, bounded by a total byte budget.
+
+    After a turn finishes, the cache for its prompt and response is stored under the
+    conversation id. The next turn reuses the longest common token prefix and only
+    prefills what follows it; anything else falls back to a full prefill.
+    """
+    def __init__(self, max_bytes=config.SESSION_KV_CACHE_MAX_MB * 1024**2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def put(self, conversation_id: str, token_ids, past_key_values):
+        entry = _SessionEntry(token_ids, past_key_values)
+        with self._lock:
+            self._remove(conversation_id)
+            if entry.nbytes > self.max_bytes:
+                logger.debug(f"KV cache for conversation {conversation_id} exceeds the budget, not stored.")
+                return
+            while self._entries and self.total_bytes + entry.nbytes > self.max_bytes:
+                evicted_id, _ = next(iter(self._entries.items()))
+                self._remove(evicted_id)
+                self.evictions += 1
+                logger.debug(f"Evicted KV cache for conversation {evicted_id}.")
+            self._entries[conversation_id] = entry
+            self.total_bytes += entry.nbytes
+
+    def lookup(self, conversation_id: str, input_ids) -> Tuple[int, Optional[tuple]]:
+        """
+        Returns (reused_length, past_key_values) for the longest cached prefix of input_ids,
+        or (0, None) on a miss. At least one prompt token is always left to prefill.
+        """
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                self.misses += 1
+                return 0, None
+            self._entries.move_to_end(conversation_id)
+
+        reused_length = min(common_prefix_length(entry.token_ids, input_ids), len(input_ids) - 1)
+        if reused_length <= 0:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+        return reused_length, crop_cache(entry.past_key_values, reused_length)
+
+    def invalidate(self, conversation_id: str):
+        with self._lock:
+            if self._remove(conversation_id):
+                self.invalidations += 1
+
+    def evict_lru(self) -> int:
+        """Evicts the least recently used entry, returning the bytes freed (0 if the store is empty)."""
+        with self._lock:
+            if not self._entries:
+                return 0
+            conversation_id, entry = next(iter(self._entries.items()))
+            self._remove(conversation_id)
+            self.evictions += 1
+            return entry.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, conversation_id: str) -> bool:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry.nbytes
+        return True
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "memory_mb": round(self.total_bytes / 1024**2, 2),
+            "budget_mb": round(self.max_bytes / 1024**2, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
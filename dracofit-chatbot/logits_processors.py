@@ -0,0 +1,129 @@
+"""
+Repetition penalty and no-repeat-ngram for the generation scheduler's decode loop.
+
+transformers' RepetitionPenaltyLogitsProcessor and NoRepeatNGramLogitsProcessor take the
+whole token sequence on every call, and the no-repeat-ngram one rebuilds its n-gram table
+from it in Python, so each step costs more the longer the sequence gets. Here every sequence
+keeps a SequenceLogitsState that is updated with each new token, and a whole batch of rows
+is processed with a few tensor operations. The results are the same as transformers'.
+"""
+from collections import deque
+from typing import List, Optional, Sequence
+
+import torch
+
+class SequenceLogitsState:
+    """
+    What the processors need to know about one sequence's tokens (prompt included): its
+    distinct ids, kept in a growing tensor on the model's device, and which tokens followed
+    each (n-1)-gram.
+    """
+    __slots__ = ("seen", "seen_ids", "seen_count", "pending", "ngram_size", "ngrams", "tail")
+
+    def __init__(self, token_ids: Sequence[int] = (), no_repeat_ngram_size=0):
+        self.seen = set()
+        self.seen_ids = None # Distinct ids in the order they first occurred, allocated on the first call
+        self.seen_count = 0 # Ids of seen_ids in use, the rest is spare capacity
+        self.pending = [] # New distinct ids not yet copied to seen_ids
+        self.ngram_size = no_repeat_ngram_size
+        self.ngrams = {} # (n-1)-gram -> tokens that followed it
+        self.tail = deque(maxlen=no_repeat_ngram_size or 1) # Last n tokens
+        for token_id in token_ids:
+            self.append(token_id)
+
+    def append(self, token_id: int):
+        if token_id not in self.seen:
+            self.seen.add(token_id)
+            self.pending.append(token_id)
+        if self.ngram_size:
+            tail = self.tail
+            tail.append(token_id)
+            if len(tail) == self.ngram_size:
+                self.ngrams.setdefault(tuple(tail)[:-1], set()).add(token_id)
+
+    def banned_tokens(self):
+        """Tokens that would complete an n-gram already in the sequence."""
+        tail = self.tail
+        if len(tail) == self.ngram_size:
+            key = tuple(tail)[1:]
+        elif len(tail) == self.ngram_size - 1:
+            key = tuple(tail)
+        else:
+            return ()
+        return self.ngrams.get(key, ())
+
+    def flush_seen_ids(self, device):
+        """Copies the pending ids to seen_ids, doubling its capacity when it is full."""
+        if not self.pending and self.seen_ids is not None:
+            return
+        count = self.seen_count + len(self.pending)
+        if self.seen_ids is None or count > self.seen_ids.shape[0]:
+            seen_ids = torch.empty(max(64, 2 * count), dtype=torch.long, device=device)
+            if self.seen_count:
+                seen_ids[:self.seen_count] = self.seen_ids[:self.seen_count]
+            self.seen_ids = seen_ids
+        if self.pending:
+            self.seen_ids[self.seen_count:count] = torch.tensor(self.pending, dtype=torch.long, device=device)
+            self.pending = []
+        self.seen_count = count
+
+class BatchLogitsProcessor:
+    """
+    Applies the repetition penalty, the no-repeat-ngram ban and then `warpers` (temperature,
+    top-k, top-p; these only look at the scores) to a [batch, vocab] tensor, one state per row.
+    """
+    def __init__(self, repetition_penalty: Optional[float] = None, no_repeat_ngram_size=0, warpers=None):
+        self.repetition_penalty = repetition_penalty if repetition_penalty and repetition_penalty != 1.0 else None
+        self.no_repeat_ngram_size = no_repeat_ngram_size if no_repeat_ngram_size and no_repeat_ngram_size > 0 else 0
+        self.warpers = warpers
+
+    def new_state(self, token_ids: Sequence[int] = ()) -> SequenceLogitsState:
+        return SequenceLogitsState(token_ids, self.no_repeat_ngram_size)
+
+    def __call__(self, states: List[SequenceLogitsState], scores: torch.FloatTensor) -> torch.FloatTensor:
+        copied = False # Whether `scores` is already a copy this call may modify in place
+        if self.repetition_penalty:
+            index = self._seen_index(states, scores.device)
+            if index is not None:
+                # Only the seen columns are read and written, not the whole vocabulary
+                score = scores.gather(1, index)
+                penalized = torch.where(score < 0, score * self.repetition_penalty, score / self.repetition_penalty)
+                if any(state.seen_count == 0 for state in states):
+                    has_ids = torch.tensor([state.seen_count > 0 for state in states], device=scores.device)
+                    penalized = torch.where(has_ids[:, None], penalized, score)
+                scores = scores.scatter(1, index, penalized)
+                copied = True
+        if self.no_repeat_ngram_size:
+            rows, columns = [], []
+            for row, state in enumerate(states):
+                banned = state.banned_tokens()
+                rows.extend([row] * len(banned))
+                columns.extend(banned)
+            if columns:
+                if not copied:
+                    scores = scores.clone()
+                index = (torch.tensor(rows, device=scores.device), torch.tensor(columns, device=scores.device))
+                scores.index_put_(index, torch.tensor(-float("inf"), dtype=scores.dtype, device=scores.device))
+        if self.warpers:
+            scores = self.warpers(None, scores)
+        return scores
+
+    def _seen_index(self, states: List[SequenceLogitsState], device) -> Optional[torch.LongTensor]:
+        """
+        [batch, max distinct ids] index of the rows' seen ids. Shorter rows are padded with
+        their first id, which is harmless since every copy of it gets the same penalized score.
+        """
+        for state in states:
+            state.flush_seen_ids(device)
+        width = max(state.seen_count for state in states)
+        if width == 0:
+            return None
+        if len(states) == 1:
+            return states[0].seen_ids[:width].unsqueeze(0)
+        index = torch.zeros((len(states), width), dtype=torch.long, device=device)
+        for row, state in enumerate(states):
+            count = state.seen_count
+            if count:
+                index[row, :count] = state.seen_ids[:count]
+                index[row, count:] = state.seen_ids[0]
+        return index
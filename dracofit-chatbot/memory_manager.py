@@ -0,0 +1,160 @@
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Helper Functions ---
+def process_rss_bytes() -> Optional[int]:
+    """Current resident set size of this process, or None if it can't be read."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _physical_memory_bytes() -> Optional[int]:
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def _load_malloc_trim():
+    """glibc's malloc_trim returns freed heap pages to the OS; unavailable on other platforms."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        return libc.malloc_trim
+    except (OSError, AttributeError, TypeError):
+        return None
+
+# --- Memory Manager ---
+class MemoryManager:
+    """
+    Reclaims memory only when usage crosses a high watermark.
+
+    Usage is measured as a fraction of device memory (reserved CUDA memory, or the
+    process RSS on CPU). Once above `high_watermark`, reclaim steps run from cheapest
+    to most expensive until usage is back under `low_watermark`: allocator flush or
+    malloc_trim, a full GC, then the registered reclaimers (e.g. evicting cached KV
+    state). Below the watermark a check costs a couple of counter reads.
+    """
+    def __init__(self, device: str, high_watermark=config.MEMORY_HIGH_WATERMARK,
+                 low_watermark=config.MEMORY_LOW_WATERMARK, check_interval=config.MEMORY_CHECK_INTERVAL_SECONDS):
+        if not 0 < low_watermark <= high_watermark <= 1:
+            raise ValueError("Memory watermarks must satisfy 0 < low <= high <= 1.")
+        self.device = device
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.check_interval = check_interval
+        self._reclaimers: List[Callable[[], int]] = []
+        self._malloc_trim = _load_malloc_trim() if device == "cpu" else None
+        self._next_check_time = 0.0
+
+        self.checks = 0
+        self.reclaims = 0
+        self.reclaim_time_seconds = 0.0
+        self.recent_decisions = deque(maxlen=10)
+
+    def add_reclaimer(self, reclaimer: Callable[[], int]):
+        """Registers a callable that frees memory on demand and returns the bytes freed (0 when nothing is left)."""
+        self._reclaimers.append(reclaimer)
+
+    def get_usage(self) -> Dict[str, Optional[int]]:
+        if self.device == "cuda" and torch.cuda.is_available():
+            return {
+                "allocated_bytes": torch.cuda.memory_allocated(0),
+                "used_bytes": torch.cuda.memory_reserved(0),
+                "total_bytes": torch.cuda.get_device_properties(0).total_memory,
+            }
+        return {"used_bytes": process_rss_bytes(), "total_bytes": _physical_memory_bytes()}
+
+    def _usage_fraction(self) -> Optional[float]:
+        usage = self.get_usage()
+        if not usage["used_bytes"] or not usage["total_bytes"]:
+            return None
+        return usage["used_bytes"] / usage["total_bytes"]
+
+    def maybe_reclaim(self, reason: str = "periodic", force_check: bool = False) -> bool:
+        """Reclaims memory if usage is above the high watermark. Returns True if a reclaim ran."""
+        now = time.time()
+        if not force_check and now < self._next_check_time:
+            return False
+        self._next_check_time = now + self.check_interval
+        self.checks += 1
+
+        before = self._usage_fraction()
+        if before is None or before < self.high_watermark:
+            return False
+
+        start_time = time.perf_counter()
+        steps = []
+        for step_name, step in self._reclaim_steps():
+            step()
+            steps.append(step_name)
+            if self._usage_fraction() < self.low_watermark:
+                break
+        after = self._usage_fraction()
+        duration = time.perf_counter() - start_time
+
+        self.reclaims += 1
+        self.reclaim_time_seconds += duration
+        self.recent_decisions.append({
+            "time": now,
+            "reason": reason,
+            "usage_before": round(before, 4),
+            "usage_after": round(after, 4),
+            "steps": steps,
+            "duration_seconds": round(duration, 4),
+        })
+        logger.info(f"Memory usage {before:.1%} above high watermark ({reason}), reclaimed to {after:.1%} in {duration:.3f}s via {steps}.")
+        if after >= self.high_watermark:
+            # Nothing left to free (e.g. the weights alone exceed the watermark); don't retry every interval
+            self._next_check_time = now + self.check_interval * 30
+            logger.warning("Memory usage still above high watermark after reclaiming, backing off.")
+        return True
+
+    def _reclaim_steps(self):
+        if self.device == "cuda" and torch.cuda.is_available():
+            yield "empty_cache", torch.cuda.empty_cache
+            yield "gc_collect", lambda: (gc.collect(), torch.cuda.empty_cache())
+        else:
+            if self._malloc_trim is not None:
+                yield "malloc_trim", lambda: self._malloc_trim(0)
+            yield "gc_collect", gc.collect
+        for reclaimer in self._reclaimers:
+            yield getattr(reclaimer, "__name__", "reclaimer"), lambda reclaimer=reclaimer: self._run_reclaimer(reclaimer)
+
+    def _run_reclaimer(self, reclaimer: Callable[[], int]):
+        # Keep calling until usage is low enough or the reclaimer has nothing left to free
+        while reclaimer() > 0:
+            if self._usage_fraction() < self.low_watermark:
+                break
+        if self.device == "cuda" and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        elif self._malloc_trim is not None:
+            self._malloc_trim(0)
+
+    def get_status(self) -> Dict[str, Any]:
+        usage = self.get_usage()
+        fraction = self._usage_fraction()
+        return {
+            "device": self.device,
+            "used_mb": round((usage["used_bytes"] or 0) / 1024**2, 2),
+            "total_mb": round((usage["total_bytes"] or 0) / 1024**2, 2),
+            "usage_fraction": None if fraction is None else round(fraction, 4),
+            "high_watermark": self.high_watermark,
+            "low_watermark": self.low_watermark,
+            "checks": self.checks,
+            "reclaims": self.reclaims,
+            "reclaim_time_seconds": round(self.reclaim_time_seconds, 4),
+            "recent_decisions": list(self.recent_decisions),
+        }
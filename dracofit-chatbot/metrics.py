@@ -0,0 +1,196 @@
+"""
+Prometheus-format counters, gauges and histograms for the chat service, served on /metrics.
+
+MODEL_METRICS are recorded where the model runs (the API process, or model_server.py
+when it is enabled); HTTP_METRICS are recorded by each API worker. Recording is a dict
+update under a lock, so it is cheap enough for the decode loop.
+"""
+import bisect
+import math
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# --- Helper Functions ---
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(label_names: Sequence[str], label_values: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+# --- Metric Types ---
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. requests served."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.label_names:
+            values[()] = 0
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in sorted(values.items())]
+
+class Gauge(_Metric):
+    """A value that goes up and down. With `function`, it is read when rendered instead of set."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], Dict[Tuple[str, ...], float]]):
+        """`function` returns {label values tuple: value}; values that are None are skipped."""
+        self.function = function
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            values = self.function() or {}
+        else:
+            with self._lock:
+                values = dict(self._values)
+            if not values and not self.label_names:
+                values[()] = 0
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(values.items()) if value is not None]
+
+class Histogram(_Metric):
+    """Counts observations into cumulative buckets, plus their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            counts[index] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            counts = {key: list(value) for key, value in self._counts.items()}
+            sums = dict(self._sums)
+        lines = []
+        for key in sorted(counts):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts[key]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(sums[key])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+class Registry:
+    """A named set of metrics rendered together in the Prometheus text format."""
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        return "".join(metric.render() + "\n" for metric in self._metrics)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- Model Metrics ---
+MODEL_METRICS = Registry()
+QUEUE_WAIT_SECONDS = MODEL_METRICS.histogram("dracobot_queue_wait_seconds", "Time a generation request waited in the scheduler queue before prefill.")
+TOKENIZATION_SECONDS = MODEL_METRICS.histogram("dracobot_tokenization_seconds", "Time spent fitting the conversation to the context and tokenizing the prompt.")
+PREFILL_SECONDS = MODEL_METRICS.histogram("dracobot_prefill_seconds", "Time of the prefill forward pass and first token sample.")
+TIME_TO_FIRST_TOKEN_SECONDS = MODEL_METRICS.histogram("dracobot_time_to_first_token_seconds", "Time from the start of a generation to its first streamed chunk.")
+DECODE_TOKENS_PER_SECOND = MODEL_METRICS.histogram("dracobot_decode_tokens_per_second", "Decode speed of each completed generation after its first token.",
+                                                   buckets=THROUGHPUT_BUCKETS)
+PROMPT_TOKENS = MODEL_METRICS.histogram("dracobot_prompt_tokens", "Prompt length of each generation, in tokens.", buckets=TOKEN_BUCKETS)
+PREFILL_TOKENS_REUSED = MODEL_METRICS.counter("dracobot_prefill_tokens_reused_total", "Prompt tokens served from the prefix or conversation KV caches.")
+GENERATED_TOKENS = MODEL_METRICS.histogram("dracobot_generated_tokens", "Tokens generated by each generation.", buckets=TOKEN_BUCKETS)
+GENERATIONS = MODEL_METRICS.counter("dracobot_generations_total", "Generations by outcome.", ["outcome"]) # completed, cancelled, failed
+RESPONSE_CACHE_HITS = MODEL_METRICS.counter("dracobot_response_cache_hits_total", "Responses replayed from the response cache.")
+KV_CACHE_BYTES = MODEL_METRICS.gauge("dracobot_kv_cache_bytes", "Memory held by KV caches.", ["cache"]) # prefix, session, batch
+MEMORY_USED_BYTES = MODEL_METRICS.gauge("dracobot_memory_used_bytes", "Memory used on the model's device (CUDA reserved, or process RSS on CPU).", ["device"])
+HOST_MEMORY_RSS_BYTES = MODEL_METRICS.gauge("dracobot_host_memory_rss_bytes", "Resident set size of the process running the model.")
+SCHEDULER_SEQUENCES = MODEL_METRICS.gauge("dracobot_scheduler_sequences", "Sequences in the generation scheduler.", ["state"]) # active, pending
+
+# --- HTTP Metrics ---
+HTTP_METRICS = Registry()
+HTTP_REQUESTS = HTTP_METRICS.counter("dracobot_http_chat_requests_total", "/chat requests by final status.", ["status"])
+HTTP_REQUEST_SECONDS = HTTP_METRICS.histogram("dracobot_http_chat_duration_seconds", "Time from receiving a /chat request to the end of its stream.")
+HTTP_FIRST_CHUNK_SECONDS = HTTP_METRICS.histogram("dracobot_http_chat_first_chunk_seconds", "Time from receiving a /chat request to sending its first chunk.")
+HTTP_ACTIVE_STREAMS = HTTP_METRICS.gauge("dracobot_http_chat_active_streams", "/chat streams currently open.")
+# admission_class is "chat" for /chat and "batch" for /chat/batch jobs, which have their own slots
+HTTP_ADMISSION_IN_FLIGHT = HTTP_METRICS.gauge("dracobot_http_admission_in_flight", "Generations holding an admission slot.", ["admission_class"])
+HTTP_ADMISSION_QUEUE_DEPTH = HTTP_METRICS.gauge("dracobot_http_admission_queue_depth", "Requests waiting for an admission slot.", ["admission_class"])
+HTTP_ADMISSION_WAIT_SECONDS = HTTP_METRICS.histogram("dracobot_http_admission_wait_seconds", "Time admitted requests waited for a slot.", ["admission_class"])
+HTTP_ADMISSION_REJECTIONS = HTTP_METRICS.counter("dracobot_http_admission_rejections_total", "Requests rejected by admission control, by reason.", ["admission_class", "reason"]) # user_queue_full, queue_full, queue_timeout
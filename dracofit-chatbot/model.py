@@ -1,188 +1,1163 @@
 import os
+import asyncio
 import logging
 import time
 import gc
-from typing import Dict, Any, List
-from huggingface_hub import login
-
-# --- Add these imports ---
-from transformers import TextIteratorStreamer # For streaming output
-from threading import Thread # To run generation in background
+import queue
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
+from threading import Thread, Condition, Event, Lock # To run generation in background
 
 # Import configuration settings
 import config
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
-# --- End of new imports ---
+import metrics
+import profiling
+from checkpoint_cache import QuantizedCheckpointCache, MappedCheckpoint
 
 # --- Logging Setup ---
 logging.basicConfig(level=getattr(logging, config.LOG_LEVEL.upper(), logging.INFO))
 logger = logging.getLogger(__name__)
 
 # --- Dependency Check & Login ---
-try:
-    import torch
-    from transformers import AutoTokenizer, AutoModelForCausalLM
-    from transformers import BitsAndBytesConfig
-    TRANSFORMERS_AVAILABLE = True
-except ImportError:
-    logger.error("Required packages not installed. Please run: pip install transformers torch bitsandbytes")
-    TRANSFORMERS_AVAILABLE = False
-
-if TRANSFORMERS_AVAILABLE:
-    try:
-        login(token=config.HF_TOKEN)
-        logger.info("Hugging Face login successful.")
-    except Exception as e:
-        logger.error(f"Hugging Face login failed: {e}")
-        TRANSFORMERS_AVAILABLE = False
+# torch, transformers and the modules built on them take seconds to import, so they are
+# loaded on first use (or by the background loader) instead of when this module is imported.
+TRANSFORMERS_AVAILABLE = None # Unknown until _load_dependencies() has run
+_dependencies_lock = Lock()
+
+def _load_dependencies() -> bool:
+    """Imports torch/transformers and logs in to Hugging Face once. Returns TRANSFORMERS_AVAILABLE."""
+    global TRANSFORMERS_AVAILABLE, torch, TextIteratorStreamer, AutoTokenizer, AutoModelForCausalLM
+    global DynamicCache, LogitsProcessorList, RepetitionPenaltyLogitsProcessor, NoRepeatNGramLogitsProcessor
+    global TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+    global PrefixKVCache, SessionKVStore, StaticKVCache, cache_nbytes, MemoryManager, process_rss_bytes, ContextWindowManager, select_backend
+    global PromptTokenizer, GENERATION_PROMPT, MEMORY_ROLE, format_system_turn, format_history_turn, conversation_turns
+    global build_drafter, verify_draft_token, ResponseCache, generation_fingerprint, load_embedder
+    global AsyncTextStreamer, BatchLogitsProcessor, CompiledDecoder
+
+    with _dependencies_lock:
+        if TRANSFORMERS_AVAILABLE is not None:
+            return TRANSFORMERS_AVAILABLE
+
+        try:
+            import torch
+            from huggingface_hub import login
+            from transformers import TextIteratorStreamer # For streaming output
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+            from transformers import (
+                DynamicCache,
+                LogitsProcessorList,
+                RepetitionPenaltyLogitsProcessor,
+                NoRepeatNGramLogitsProcessor,
+                TemperatureLogitsWarper,
+                TopKLogitsWarper,
+                TopPLogitsWarper,
+            )
+            from kv_cache import PrefixKVCache, SessionKVStore, StaticKVCache, cache_nbytes
+            from backends import select_backend
+            from memory_manager import MemoryManager, process_rss_bytes
+            from context_manager import ContextWindowManager
+            from prompt_tokenizer import PromptTokenizer, GENERATION_PROMPT, MEMORY_ROLE, format_system_turn, format_history_turn, conversation_turns
+            from speculative import build_drafter, verify_draft_token
+            from response_cache import ResponseCache, generation_fingerprint, load_embedder
+            from async_streaming import AsyncTextStreamer
+            from logits_processors import BatchLogitsProcessor
+            from compiled_decode import CompiledDecoder
+            TRANSFORMERS_AVAILABLE = True
+        except ImportError as e:
+            logger.error(f"Required packages not installed ({e}). Please run: pip install transformers torch bitsandbytes")
+            TRANSFORMERS_AVAILABLE = False
+            return TRANSFORMERS_AVAILABLE
+
+        if not config.HF_TOKEN:
+            # Local checkpoints (e.g. the benchmarks' stub model) load without a login
+            logger.warning("HF_TOKEN not set, skipping Hugging Face login. Only local or public models can be loaded.")
+            return TRANSFORMERS_AVAILABLE
+
+        try:
+            login(token=config.HF_TOKEN)
+            logger.info("Hugging Face login successful.")
+        except Exception as e:
+            logger.error(f"Hugging Face login failed: {e}")
+            TRANSFORMERS_AVAILABLE = False
+        return TRANSFORMERS_AVAILABLE
+
+# --- Load Progress ---
+class LoadProgress:
+    """
+    Records the model loading phases and their timings for the readiness probe.
+
+    state is one of "not_started", "loading", "ready" or "failed".
+    """
+    def __init__(self):
+        self.state = "not_started"
+        self.current_phase = None
+        self.phases = {} # phase -> {"status", "seconds"}, in the order they ran
+        self.error = None
+        self.started_time = None
+        self.ready_time = None
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            if self.state == "loading":
+                return # Already timing this load, e.g. the background loader's import phase
+            self.state = "loading"
+            self.phases = {}
+            self.error = None
+            self.started_time = time.time()
+            self.ready_time = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start_time = time.perf_counter()
+        with self._lock:
+            self.current_phase = name
+            self.phases[name] = {"status": "running", "seconds": None}
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self.phases[name] = {"status": "failed", "seconds": round(time.perf_counter() - start_time, 3)}
+            raise
+        else:
+            with self._lock:
+                self.phases[name] = {"status": "done", "seconds": round(time.perf_counter() - start_time, 3)}
+        finally:
+            with self._lock:
+                self.current_phase = None
+
+    def finish(self, error=None):
+        with self._lock:
+            self.state = "failed" if error else "ready"
+            self.error = error
+            self.ready_time = None if error else time.time()
+            logger.info(f"Model load {self.state} after {self._elapsed()}s: {self.phases}")
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def _elapsed(self):
+        if self.started_time is None:
+            return None
+        return round((self.ready_time or time.time()) - self.started_time, 3)
+
+    def get_status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "current_phase": self.current_phase,
+                "phases": {name: dict(phase) for name, phase in self.phases.items()},
+                "elapsed_seconds": self._elapsed(),
+                "error": self.error,
+            }
+
+load_progress = LoadProgress()
 
 # --- Helper Functions ---
 def _format_conversation_prompt(system_prompt: str, conversation: List[Dict[str, str]]) -> str:
     """Formats the conversation history into a single prompt string for Gemma."""
-    prompt = f"<start_of_turn>system\n{system_prompt}<end_of_turn>\n\n"
-    if not conversation:
-        raise IndexError("Cannot format prompt from empty conversation.")
-    for message in conversation[:-1]: # All but the latest message
-        role = "user" if message["role"] == "user" else "model"
-        prompt += f"<start_of_turn>{role}\n{message['content']}<end_of_turn>\n\n"
-    # Add the latest user message
-    latest_message = conversation[-1]
-    prompt += f"<start_of_turn>user\n{latest_message['content']}<end_of_turn>\n\n"
-    # Signal the start of the model's turn
-    prompt += "<start_of_turn>model\n"
+    prompt = "".join(conversation_turns(system_prompt, conversation))
     logger.debug(f"Formatted prompt (first 100 chars): {prompt[:100]}...")
     return prompt
 
+def _to_legacy_cache(past_key_values):
+    """Returns the cache as a tuple of (key, value) tensors per layer, each [batch, heads, seq, head_dim]."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+def _max_context_tokens(model_config) -> int:
+    """
+    Positions a sequence may span: CONTEXT_TOKEN_BUDGET or the model's max_position_embeddings,
+    capped at its sliding window if it has one. Every cache the scheduler keeps holds all
+    positions of every layer, so the sliding window layers of a model like Gemma 2 only
+    attend as trained while the whole sequence fits in the window.
+    """
+    max_context_tokens = config.CONTEXT_TOKEN_BUDGET or model_config.max_position_embeddings
+    sliding_window = getattr(model_config, "sliding_window", None)
+    if sliding_window and sliding_window < max_context_tokens:
+        logger.warning(f"Capping the context at the model's {sliding_window} token sliding window.")
+        return sliding_window
+    return max_context_tokens
+
+def _left_pad_cache(past_key_values, pad_length: int):
+    """Left-pads every layer of a legacy cache along the sequence dimension with zeros."""
+    return tuple(
+        (torch.nn.functional.pad(key, (0, 0, pad_length, 0)), torch.nn.functional.pad(value, (0, 0, pad_length, 0)))
+        for key, value in past_key_values
+    )
+
+def _length_buckets(lengths: List[int], bucket_size: int) -> List[List[int]]:
+    """Indices of `lengths` sorted by length and cut into runs of `bucket_size`, so each run pads little."""
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    return [order[start:start + bucket_size] for start in range(0, len(order), bucket_size)]
+
+class _BatchResultStreamer:
+    """Streamer of a batch job's request: drops the tokens and reports the request's index once it ends."""
+    def __init__(self, finished: "queue.Queue", index: int):
+        self.finished = finished
+        self.index = index
+
+    def put(self, value):
+        pass
+
+    def end(self):
+        self.finished.put(self.index)
+
+def _build_logits_warpers() -> "LogitsProcessorList":
+    """The sampling warpers model.generate uses for the configured settings (empty when greedy)."""
+    warpers = LogitsProcessorList()
+    if config.DO_SAMPLE:
+        if config.TEMPERATURE and config.TEMPERATURE != 1.0:
+            warpers.append(TemperatureLogitsWarper(config.TEMPERATURE))
+        if config.TOP_K and config.TOP_K > 0:
+            warpers.append(TopKLogitsWarper(top_k=config.TOP_K))
+        if config.TOP_P and config.TOP_P < 1.0:
+            warpers.append(TopPLogitsWarper(top_p=config.TOP_P))
+    return warpers
+
+def _build_logits_processor() -> "LogitsProcessorList":
+    """Builds the same processor/warper chain model.generate uses for the configured sampling settings."""
+    processors = LogitsProcessorList()
+    if config.REPETITION_PENALTY and config.REPETITION_PENALTY != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty=config.REPETITION_PENALTY))
+    if config.NO_REPEAT_NGRAM_SIZE and config.NO_REPEAT_NGRAM_SIZE > 0:
+        processors.append(NoRepeatNGramLogitsProcessor(config.NO_REPEAT_NGRAM_SIZE))
+    processors.extend(_build_logits_warpers())
+    return processors
+
+def _build_batch_logits_processor() -> "BatchLogitsProcessor":
+    """The same chain as _build_logits_processor, with per-sequence state for the scheduler's decode loop."""
+    return BatchLogitsProcessor(config.REPETITION_PENALTY, config.NO_REPEAT_NGRAM_SIZE, _build_logits_warpers())
+
+# --- Generation Scheduler ---
+class GenerationRequest:
+    """A single conversation waiting for (or undergoing) generation in the GenerationScheduler."""
+    def __init__(self, input_ids, streamer, max_new_tokens=config.MAX_OUTPUT_LENGTH, abort_event=None, conversation_id=None, background=False):
+        self.input_ids = input_ids # 1D tensor of prompt token ids
+        # Only admitted while no other request is queued or decoding, e.g. warm-up and conversation summaries.
+        # Nobody waits on these, so they stay out of the latency metrics
+        self.background = background
+        self.streamer = streamer # TextIteratorStreamer the consumer iterates over
+        self.max_new_tokens = max_new_tokens
+        self.abort_event = abort_event
+        self.conversation_id = conversation_id # Key into the SessionKVStore, None disables reuse
+        self.token_ids = input_ids.tolist() # Prompt + generated ids, used by the drafters
+        self.logits_state = None # SequenceLogitsState, created when the scheduler admits the request
+        self.generated_ids = []
+        self.next_token = None # Sampled but not yet fed through the model
+        self.seq_len = 0 # Real (unpadded) tokens held in the KV cache for this sequence
+        self.slot = None # Row of the CompiledDecoder's cache, when decoding with one
+        self.group = None # Shared by the requests of one submit_batch call, which are prefilled together
+        self.past_key_values = None # Own cache, only used when decoding speculatively (not merged into the batch)
+        self.draft_state = {} # Drafter-specific per-request state
+        self.error = None
+        self.cancelled = False # Set by the scheduler once the request was stopped early
+        self.submitted_time = time.time()
+        self.first_token_time = None
+        self.done = Event()
+        self._cancel_event = Event()
+
+    def cancel(self):
+        """Asks the scheduler to stop this request before its next decode step."""
+        self._cancel_event.set()
+
+    def should_stop(self) -> bool:
+        """Stopping hook checked by the scheduler between decode steps."""
+        return self._cancel_event.is_set() or (self.abort_event is not None and self.abort_event.is_set())
+
+    def is_finished(self, eos_token_ids) -> bool:
+        if not self.generated_ids:
+            return False
+        return self.generated_ids[-1] in eos_token_ids or len(self.generated_ids) >= self.max_new_tokens
+
+class GenerationScheduler:
+    """
+    Runs a single decode loop shared by all in-flight requests (continuous batching).
+
+    New requests are prefilled and merged into the running batch between decode steps,
+    finished ones are retired, and every step's tokens are fanned out to each request's streamer.
+    The batch KV cache is kept left-padded so all rows share one sequence dimension.
+
+    With a drafter (speculative decoding), each sequence keeps its own cache instead and
+    a step verifies several drafted tokens for one sequence in a single forward pass.
+    With a CompiledDecoder, each sequence is copied into a slot of its preallocated cache
+    after prefill, and decode steps run through its fixed-shape (compiled) forward pass.
+
+    Requests queued together with submit_batch (offline batch jobs) are prefilled in one
+    padded forward pass when they are admitted in the same step, instead of one by one.
+    Background requests (warm-up, conversation summaries) wait until nothing else is queued
+    or decoding, so they never delay live traffic's admission.
+    """
+    def __init__(self, model, tokenizer, device, max_batch_size=config.MAX_BATCH_SIZE, memory_manager=None, drafter=None,
+                 static_kv_cache=False, compiled_decoder=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.memory_manager = memory_manager
+        self.drafter = drafter
+        self.static_kv_cache = static_kv_cache # Decode into preallocated buffers instead of concatenating each step
+        self.compiled_decoder = compiled_decoder
+        self.num_draft_tokens = config.SPECULATIVE_NUM_DRAFT_TOKENS
+        self.logits_processor = _build_batch_logits_processor()
+        self.eos_token_ids = self._resolve_eos_token_ids()
+        self.prefix_cache = PrefixKVCache()
+        self.session_store = SessionKVStore()
+        self._prefix_text = None
+
+        self._cond = Condition()
+        self._pending = deque()
+        self._background = deque() # Background requests, which wait until the scheduler is otherwise idle
+        self._active = [] # Row i of the batch cache belongs to self._active[i]
+        self._past_key_values = None
+        self._static_cache = None # Owns the buffers behind _past_key_values while the batch is unchanged
+        self._attention_mask = None
+        self._thread = None
+        self._started = Event() # Set once the thread has warmed up and entered its loop
+        self._startup_error = None
+        self._stopped = False
+
+        self.stats = {
+            "requests_completed": 0,
+            "requests_failed": 0,
+            "requests_cancelled": 0,
+            "tokens_wasted": 0, # Tokens decoded for requests that were later cancelled
+            "tokens_generated": 0,
+            "decode_steps": 0,
+            "decode_time_seconds": 0.0,
+            "prefill_tokens": 0,
+            "prefill_tokens_reused": 0,
+            "draft_tokens_proposed": 0,
+            "draft_tokens_accepted": 0,
+        }
+
+    def _resolve_eos_token_ids(self):
+        eos_token_ids = set()
+        generation_eos = getattr(getattr(self.model, "generation_config", None), "eos_token_id", None)
+        if isinstance(generation_eos, int):
+            eos_token_ids.add(generation_eos)
+        elif generation_eos:
+            eos_token_ids.update(generation_eos)
+        if self.tokenizer.eos_token_id is not None:
+            eos_token_ids.add(self.tokenizer.eos_token_id)
+        return eos_token_ids
+
+    def set_prefix(self, text: str):
+        """Sets the text every prompt starts with; its KV cache is (re)built lazily on the scheduler thread."""
+        self._prefix_text = text
+
+    def build_prefix(self):
+        """Builds the prefix KV cache now, e.g. at load time, so the first request doesn't pay for it."""
+        with torch.inference_mode():
+            self._ensure_prefix()
+
+    def _ensure_prefix(self):
+        if self._prefix_text is None:
+            return
+        if not self.prefix_cache.is_valid_for(self.model, self._prefix_text):
+            self.prefix_cache.build(self.model, self.tokenizer, self._prefix_text, self.device)
+
+    def start(self):
+        """
+        Starts the decode thread now rather than with the first request, and waits until it
+        has warmed up (which compiles the CompiledDecoder's steps). Raises if that failed.
+        """
+        with self._cond:
+            self._start_thread()
+        self._started.wait()
+        if self._startup_error is not None:
+            raise RuntimeError(f"Generation scheduler failed to start: {self._startup_error}") from self._startup_error
+
+    def _start_thread(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="generation-scheduler", daemon=True)
+            self._thread.start()
+
+    def submit(self, request: GenerationRequest):
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Generation scheduler has been stopped.")
+            (self._background if request.background else self._pending).append(request)
+            self._start_thread()
+            self._cond.notify()
+
+    def submit_batch(self, requests: List[GenerationRequest]):
+        """
+        Queues requests to be prefilled together: those admitted in the same step share one
+        padded forward pass. They can't reuse conversation caches, so have no conversation ids.
+        """
+        if any(request.conversation_id for request in requests):
+            raise ValueError("Batched requests can't have conversation ids.")
+        group = object()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Generation scheduler has been stopped.")
+            for request in requests:
+                request.group = group
+                self._pending.append(request)
+            self._start_thread()
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for request in list(self._pending) + list(self._background) + self._active:
+            self._finish(request, error="Generation scheduler stopped")
+        self._pending.clear()
+        self._background.clear()
+        self._reset_batch()
+        if self.compiled_decoder:
+            self.compiled_decoder.close()
+        self.prefix_cache.clear()
+        self.session_store.clear()
+
+    @property
+    def has_work(self) -> bool:
+        """Whether any request is queued or being decoded."""
+        with self._cond:
+            return bool(self._pending or self._background or self._active)
+
+    def get_status(self) -> Dict[str, Any]:
+        status = dict(self.stats)
+        status["active_sequences"] = len(self._active)
+        status["pending_requests"] = len(self._pending)
+        status["background_requests"] = len(self._background)
+        if self.stats["decode_time_seconds"] > 0:
+            status["decode_tokens_per_second"] = round(self.stats["tokens_generated"] / self.stats["decode_time_seconds"], 2)
+        status["decode_time_seconds"] = round(self.stats["decode_time_seconds"], 3)
+        status["static_kv_cache"] = self.static_kv_cache
+        if self.compiled_decoder:
+            status["compiled_decode"] = self.compiled_decoder.get_status()
+        static_cache = self._static_cache
+        if static_cache is not None:
+            status["static_kv_cache_mb"] = round(static_cache.capacity_nbytes() / 1024**2, 2)
+        if self.drafter:
+            status["speculative_mode"] = self.drafter.name
+            if self.stats["draft_tokens_proposed"]:
+                status["draft_acceptance_rate"] = round(self.stats["draft_tokens_accepted"] / self.stats["draft_tokens_proposed"], 4)
+        status["prefix_cache"] = self.prefix_cache.get_status()
+        status["session_kv_cache"] = self.session_store.get_status()
+        return status
+
+    def kv_cache_bytes(self) -> Dict[str, int]:
+        """Memory held by the system prompt prefix, the stored conversations and the running batch."""
+        static_cache = self._static_cache
+        if self.compiled_decoder and self.compiled_decoder.cache is not None:
+            batch_bytes = self.compiled_decoder.cache.nbytes()
+        elif static_cache is not None:
+            batch_bytes = static_cache.capacity_nbytes()
+        else:
+            batch_bytes = cache_nbytes(self._past_key_values)
+        # Speculative decoding keeps a cache per sequence instead of the batch cache
+        batch_bytes += sum(cache_nbytes(request.past_key_values) for request in list(self._active))
+        return {
+            "prefix": cache_nbytes(self.prefix_cache.past_key_values),
+            "session": self.session_store.total_bytes,
+            "batch": batch_bytes,
+        }
+
+    def _run(self):
+        if self.compiled_decoder:
+            # Warmed up on this thread: CUDA graphs are recorded per thread, and this one replays them
+            try:
+                self.compiled_decoder.warm_up()
+            except Exception as e:
+                logger.exception(f"Compiled decoder warm-up failed: {str(e)}")
+                self._startup_error = e
+                self._started.set()
+                return
+        self._started.set()
+        logger.info("Generation scheduler started.")
+        while True:
+            with self._cond:
+                while not self._stopped and not self._pending and not self._background and not self._active:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                admitted = []
+                while self._pending and len(self._active) + len(admitted) < self.max_batch_size:
+                    admitted.append(self._pending.popleft())
+                if not admitted and not self._active and self._background:
+                    # Requests arriving meanwhile join its batch, so it only takes one row from them
+                    admitted.append(self._background.popleft())
+
+            try:
+                with torch.inference_mode():
+                    self._retire_stopped()
+                    ready = []
+                    for request in admitted:
+                        if request.should_stop():
+                            self._finish(request, cancelled=True)
+                        else:
+                            ready.append(request)
+                    for requests in self._prefill_groups(ready):
+                        with profiling.phase("prefill"):
+                            if len(requests) > 1:
+                                self._admit_group(requests)
+                            else:
+                                self._admit(requests[0])
+                    if self._active:
+                        with profiling.phase("decode_step"):
+                            if self.drafter:
+                                self._speculative_decode_step()
+                            else:
+                                self._decode_step()
+            except Exception as e:
+                logger.exception(f"Error in generation scheduler loop: {str(e)}")
+                for request in admitted + self._active:
+                    self._finish(request, error=f"Error during generation: {str(e)}")
+                self._reset_batch()
+
+            if self.memory_manager:
+                # Runs between decode steps on this thread, so no other stream has to be synchronized
+                # Always check once the batch drains, since nothing will trigger a check while idle
+                self.memory_manager.maybe_reclaim("decode_loop", force_check=not self._active and not self._pending and not self._background)
+        logger.info("Generation scheduler stopped.")
+
+    def _admit(self, request: GenerationRequest):
+        """Prefills a new sequence on its own, then merges its cache into the running batch."""
+        if not request.background:
+            metrics.QUEUE_WAIT_SECONDS.observe(time.time() - request.submitted_time)
+        self._ensure_prefix()
+        if self.compiled_decoder:
+            capacity = self.compiled_decoder.max_length - len(request.input_ids)
+            if capacity <= 0:
+                self._finish(request, error=f"Prompt of {len(request.input_ids)} tokens does not fit the {self.compiled_decoder.max_length} token KV cache.")
+                return
+            # The last token generated is never fed back, so the cache always has room for the others
+            request.max_new_tokens = min(request.max_new_tokens, capacity)
+        request.logits_state = self.logits_processor.new_state(request.token_ids)
+        prefill_start = time.perf_counter()
+        input_ids = request.input_ids.unsqueeze(0).to(self.device)
+        reused_length, past_key_values = 0, None
+        if request.conversation_id:
+            reused_length, past_key_values = self.session_store.lookup(request.conversation_id, request.input_ids)
+        if self.prefix_cache.matches(request.input_ids) and len(self.prefix_cache.input_ids) > reused_length:
+            reused_length, past_key_values = len(self.prefix_cache.input_ids), self.prefix_cache.past_key_values
+            self.prefix_cache.hits += 1
+
+        with profiling.phase("prefill_forward"):
+            # Always an explicit DynamicCache: left to itself, Gemma 2 builds a HybridCache, which
+            # can't be converted to the legacy tuples the batch and session caches are kept as
+            cache = DynamicCache.from_legacy_cache(past_key_values) if past_key_values is not None else DynamicCache()
+            # Only the tokens after the cached prefix need a forward pass; the mask covers the cached ones too
+            outputs = self.model(
+                input_ids=input_ids[:, reused_length:],
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                use_cache=True,
+            )
+        self.stats["prefill_tokens_reused"] += reused_length
+        self.stats["prefill_tokens"] += input_ids.shape[1] - reused_length
+        request.seq_len = input_ids.shape[1]
+        self._emit(request, self._sample(request, outputs.logits[:, -1, :]))
+        # Sampling reads the logits back to the host, so the forward pass has finished by now
+        if not request.background:
+            metrics.PREFILL_SECONDS.observe(time.perf_counter() - prefill_start)
+        metrics.PREFILL_TOKENS_REUSED.inc(reused_length)
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        if request.is_finished(self.eos_token_ids):
+            self._store_session(request, past_key_values)
+            self._finish(request)
+            return
+        if self.drafter:
+            request.past_key_values = past_key_values
+            self._active.append(request)
+        elif self.compiled_decoder:
+            request.slot = self.compiled_decoder.insert(past_key_values)
+            self._active.append(request)
+        else:
+            row_length = past_key_values[0][0].shape[2]
+            self._merge([request], past_key_values, torch.ones((1, row_length), dtype=torch.long, device=past_key_values[0][0].device))
+
+    def _prefill_groups(self, requests: List[GenerationRequest]) -> List[List[GenerationRequest]]:
+        """
+        Splits admitted requests into those prefilled together: consecutive requests of one
+        submit_batch call. A drafter or compiled decoder keeps a cache per sequence, so there
+        every request is prefilled on its own.
+        """
+        groups = []
+        for request in requests:
+            batched = request.group is not None and not self.drafter and not self.compiled_decoder
+            if batched and groups and groups[-1][0].group is request.group:
+                groups[-1].append(request)
+            else:
+                groups.append([request])
+        return groups
+
+    def _admit_group(self, requests: List[GenerationRequest]):
+        """
+        Prefills several new sequences in one forward pass, then merges them into the running
+        batch. Prompts are left-padded to the longest; when they all start with the system
+        prompt prefix, its cache is shared and the padding sits between it and the rest.
+        """
+        submitted_time = time.time()
+        for request in requests:
+            if not request.background:
+                metrics.QUEUE_WAIT_SECONDS.observe(submitted_time - request.submitted_time)
+            request.logits_state = self.logits_processor.new_state(request.token_ids)
+        self._ensure_prefix()
+        prefill_start = time.perf_counter()
+        prefix_length, past_key_values = 0, DynamicCache() # Explicit, as in _admit
+        if all(self.prefix_cache.matches(request.input_ids) for request in requests):
+            prefix_length = len(self.prefix_cache.input_ids)
+            past_key_values = DynamicCache.from_legacy_cache(tuple(
+                (key.expand(len(requests), -1, -1, -1), value.expand(len(requests), -1, -1, -1))
+                for key, value in self.prefix_cache.past_key_values
+            ))
+            self.prefix_cache.hits += 1
+
+        lengths = [len(request.input_ids) - prefix_length for request in requests]
+        width = max(lengths)
+        input_ids = torch.zeros((len(requests), width), dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), prefix_length + width), dtype=torch.long)
+        attention_mask[:, :prefix_length] = 1
+        for row, (request, length) in enumerate(zip(requests, lengths)):
+            input_ids[row, width - length:] = request.input_ids[prefix_length:]
+            attention_mask[row, prefix_length + width - length:] = 1
+        # Positions count real tokens only, so every row continues from the prefix without a gap
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, prefix_length:]
+        attention_mask = attention_mask.to(self.device)
+        with profiling.phase("prefill_forward"):
+            outputs = self.model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask,
+                position_ids=position_ids.to(self.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        self.stats["prefill_tokens_reused"] += prefix_length * len(requests)
+        self.stats["prefill_tokens"] += sum(lengths)
+        scores = self._process_batch_scores(requests, outputs.logits[:, -1, :])
+        for request, token_id in zip(requests, self._sample_batch(scores)):
+            request.seq_len = len(request.input_ids)
+            self._emit(request, token_id)
+        prefill_seconds = time.perf_counter() - prefill_start
+        for request in requests:
+            if not request.background:
+                metrics.PREFILL_SECONDS.observe(prefill_seconds)
+            metrics.PREFILL_TOKENS_REUSED.inc(prefix_length)
+
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        keep = []
+        for row, request in enumerate(requests):
+            if request.is_finished(self.eos_token_ids):
+                self._finish(request)
+            else:
+                keep.append(row)
+        if not keep:
+            return
+        if len(keep) < len(requests):
+            index = torch.tensor(keep, device=attention_mask.device)
+            attention_mask = attention_mask.index_select(0, index)
+            past_key_values = tuple(
+                (key.index_select(0, index.to(key.device)), value.index_select(0, index.to(value.device)))
+                for key, value in past_key_values
+            )
+        self._merge([requests[row] for row in keep], past_key_values, attention_mask)
+
+    def _merge(self, requests: List[GenerationRequest], past_key_values, row_mask):
+        """Appends prefilled rows (their cache and attention mask) to the batch, left-padding whichever is shorter."""
+        row_length = row_mask.shape[1]
+        if self._past_key_values is None:
+            self._past_key_values = past_key_values
+            self._attention_mask = row_mask
+        else:
+            batch_length = self._attention_mask.shape[1]
+            if row_length < batch_length:
+                past_key_values = _left_pad_cache(past_key_values, batch_length - row_length)
+                row_mask = torch.nn.functional.pad(row_mask, (batch_length - row_length, 0))
+            elif row_length > batch_length:
+                self._past_key_values = _left_pad_cache(self._past_key_values, row_length - batch_length)
+                self._attention_mask = torch.nn.functional.pad(self._attention_mask, (row_length - batch_length, 0))
+            self._past_key_values = tuple(
+                (torch.cat([key, row_key]), torch.cat([value, row_value]))
+                for (key, value), (row_key, row_value) in zip(self._past_key_values, past_key_values)
+            )
+            self._attention_mask = torch.cat([self._attention_mask, row_mask])
+        self._active.extend(requests)
+
+    def _decode_step(self):
+        start_time = time.perf_counter()
+        with profiling.phase("decode_forward"):
+            if self.compiled_decoder:
+                logits = self.compiled_decoder.decode(
+                    [request.slot for request in self._active],
+                    [request.next_token for request in self._active],
+                    [request.seq_len for request in self._active],
+                )
+            else:
+                logits = self._batch_forward()
+
+        # Every row's scores are processed and sampled together
+        scores = self._process_batch_scores(self._active, logits)
+        finished_rows = []
+        for row, (request, token_id) in enumerate(zip(self._active, self._sample_batch(scores))):
+            request.seq_len += 1
+            self._emit(request, token_id)
+            if request.is_finished(self.eos_token_ids):
+                finished_rows.append(row)
+
+        self.stats["decode_steps"] += 1
+        self.stats["decode_time_seconds"] += time.perf_counter() - start_time
+        if finished_rows:
+            self._retire(finished_rows)
+
+    def _batch_forward(self):
+        """Feeds every row's next token through the model with the left-padded batch cache. Returns the logits [batch, vocab]."""
+        input_ids = torch.tensor([[request.next_token] for request in self._active], device=self.device)
+        position_ids = torch.tensor([[request.seq_len] for request in self._active], device=self.device)
+        new_column = torch.ones((len(self._active), 1), dtype=torch.long, device=self._attention_mask.device)
+        attention_mask = torch.cat([self._attention_mask, new_column], dim=1)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._batch_cache(),
+            use_cache=True,
+        )
+        self._past_key_values = _to_legacy_cache(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        return outputs.logits[:, -1, :]
+
+    def _batch_cache(self):
+        """
+        The batch cache for the next forward pass. A StaticKVCache is only rebuilt when rows
+        joined or left (which replaces the legacy tuple), not on every decode step.
+        """
+        if not self.static_kv_cache:
+            return DynamicCache.from_legacy_cache(self._past_key_values)
+        if self._static_cache is None or not self._static_cache.holds(self._past_key_values):
+            self._static_cache = StaticKVCache.from_legacy_cache(self._past_key_values)
+        return self._static_cache
+
+    def _speculative_decode_step(self):
+        """Drafts tokens for each sequence and verifies them with one target forward pass per sequence."""
+        start_time = time.perf_counter()
+        finished_rows = []
+        for row, request in enumerate(self._active):
+            # Never draft beyond the token limit: the last allowed token comes from the target model
+            remaining = request.max_new_tokens - len(request.generated_ids)
+            with profiling.phase("draft"):
+                draft_ids, draft_probs = self.drafter.propose(request, min(self.num_draft_tokens, remaining - 1))
+            draft_ids = draft_ids[:max(remaining - 1, 0)]
+
+            with profiling.phase("decode_forward"):
+                input_ids = torch.tensor([[request.next_token] + draft_ids], device=self.device)
+                outputs = self.model(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones((1, request.seq_len + input_ids.shape[1]), dtype=torch.long, device=self.device),
+                    past_key_values=DynamicCache.from_legacy_cache(request.past_key_values),
+                    use_cache=True,
+                )
+            request.seq_len += 1 # next_token is now in the cache
+            accepted = 0
+            for position in range(len(draft_ids) + 1):
+                scores = self._process_scores(request, outputs.logits[:, position, :])
+                if position < len(draft_ids):
+                    probs = None if draft_probs is None else draft_probs[position]
+                    token, is_accepted = verify_draft_token(scores, draft_ids[position], probs)
+                else:
+                    # Every draft was accepted: the last position yields one more token for free
+                    token, is_accepted = self._sample_from_scores(scores), False
+                self._emit(request, token)
+                if is_accepted:
+                    accepted += 1
+                    request.seq_len += 1 # Accepted draft tokens were already fed through the model
+                if not is_accepted or request.is_finished(self.eos_token_ids):
+                    break
+
+            # Drop the cache entries of rejected draft tokens
+            request.past_key_values = tuple(
+                (key[:, :, :request.seq_len], value[:, :, :request.seq_len])
+                for key, value in _to_legacy_cache(outputs.past_key_values)
+            )
+            self.stats["draft_tokens_proposed"] += len(draft_ids)
+            self.stats["draft_tokens_accepted"] += accepted
+            if request.is_finished(self.eos_token_ids):
+                finished_rows.append(row)
+
+        self.stats["decode_steps"] += 1
+        self.stats["decode_time_seconds"] += time.perf_counter() - start_time
+        if finished_rows:
+            self._retire(finished_rows)
+
+    def _retire_stopped(self):
+        """Drops cancelled or aborted sequences so they don't take part in the next decode step."""
+        with self._cond:
+            for queue in (self._pending, self._background):
+                for request in [request for request in queue if request.should_stop()]:
+                    queue.remove(request)
+                    self._finish(request, cancelled=True)
+        stopped_rows = [row for row, request in enumerate(self._active) if request.should_stop()]
+        if stopped_rows:
+            self._retire(stopped_rows, cancelled=True)
+
+    def _process_scores(self, request: GenerationRequest, logits):
+        return self._process_batch_scores([request], logits)
+
+    def _process_batch_scores(self, requests: List[GenerationRequest], logits):
+        with profiling.phase("logits_processing"):
+            return self.logits_processor([request.logits_state for request in requests], logits.float())
+
+    def _sample_from_scores(self, scores) -> int:
+        with profiling.phase("sample"):
+            if config.DO_SAMPLE:
+                probs = torch.nn.functional.softmax(scores, dim=-1)
+                return int(torch.multinomial(probs, num_samples=1)[0, 0])
+            return int(torch.argmax(scores, dim=-1)[0])
+
+    def _sample_batch(self, scores) -> List[int]:
+        """One token per row of scores."""
+        with profiling.phase("sample"):
+            if config.DO_SAMPLE:
+                probs = torch.nn.functional.softmax(scores, dim=-1)
+                return torch.multinomial(probs, num_samples=1)[:, 0].tolist()
+            return torch.argmax(scores, dim=-1).tolist()
+
+    def _sample(self, request: GenerationRequest, logits):
+        return self._sample_from_scores(self._process_scores(request, logits))
+
+    def _emit(self, request: GenerationRequest, token_id: int):
+        request.next_token = token_id
+        request.token_ids.append(token_id)
+        request.logits_state.append(token_id)
+        request.generated_ids.append(token_id)
+        if request.first_token_time is None:
+            request.first_token_time = time.time()
+        self.stats["tokens_generated"] += 1
+        if token_id not in self.eos_token_ids:
+            # A TextIteratorStreamer decodes the text right here, on the scheduler thread
+            with profiling.phase("detokenize"):
+                request.streamer.put(torch.tensor([token_id]))
+
+    def _retire(self, rows, cancelled=False):
+        if self.compiled_decoder:
+            for row in rows:
+                request = self._active[row]
+                if not cancelled and request.conversation_id:
+                    self._store_session(request, self.compiled_decoder.export(request.slot, request.seq_len))
+                self.compiled_decoder.release(request.slot)
+                self._finish(request, cancelled=cancelled)
+            self._active = [request for row, request in enumerate(self._active) if row not in rows]
+            return
+
+        if self.drafter:
+            for row in rows:
+                request = self._active[row]
+                if cancelled:
+                    self._finish(request, cancelled=True)
+                    continue
+                self._store_session(request, request.past_key_values)
+                self._finish(request)
+            self._active = [request for row, request in enumerate(self._active) if row not in rows]
+            return
+
+        for row in rows:
+            request = self._active[row]
+            if cancelled:
+                self._finish(request, cancelled=True)
+                continue
+            if request.conversation_id:
+                # Real tokens of a row are the last seq_len positions (the batch is left-padded)
+                self._store_session(request, tuple(
+                    (key[row:row + 1, :, -request.seq_len:].clone(), value[row:row + 1, :, -request.seq_len:].clone())
+                    for key, value in self._past_key_values
+                ))
+            self._finish(request)
+        keep = [row for row in range(len(self._active)) if row not in rows]
+        self._active = [self._active[row] for row in keep]
+        if not self._active:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # Drop leading columns that are padding for every remaining row
+        leading_padding = int((attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        self._attention_mask = attention_mask[:, leading_padding:]
+        self._past_key_values = tuple(
+            (key.index_select(0, index.to(key.device))[:, :, leading_padding:], value.index_select(0, index.to(value.device))[:, :, leading_padding:])
+            for key, value in self._past_key_values
+        )
+
+    def _store_session(self, request: GenerationRequest, past_key_values):
+        """Keeps the cache of the prompt and response so the conversation's next turn can reuse it."""
+        if not request.conversation_id:
+            return
+        token_ids = torch.tensor(request.token_ids[:request.seq_len])
+        self.session_store.put(request.conversation_id, token_ids, past_key_values)
+
+    def _finish(self, request: GenerationRequest, error=None, cancelled=False):
+        if request.done.is_set():
+            return
+        request.error = error
+        request.cancelled = cancelled
+        if error:
+            self.stats["requests_failed"] += 1
+            metrics.GENERATIONS.inc(outcome="failed")
+        elif cancelled:
+            self.stats["requests_cancelled"] += 1
+            self.stats["tokens_wasted"] += len(request.generated_ids)
+            metrics.GENERATIONS.inc(outcome="cancelled")
+            logger.info(f"Generation cancelled after {len(request.generated_ids)} tokens.")
+        else:
+            self.stats["requests_completed"] += 1
+            metrics.GENERATIONS.inc(outcome="completed")
+            metrics.GENERATED_TOKENS.observe(len(request.generated_ids))
+            decode_seconds = time.time() - request.first_token_time if request.first_token_time else 0
+            if len(request.generated_ids) > 1 and decode_seconds > 0:
+                metrics.DECODE_TOKENS_PER_SECOND.observe((len(request.generated_ids) - 1) / decode_seconds)
+        request.streamer.end()
+        request.done.set()
+
+    def _reset_batch(self):
+        self._active = []
+        self._past_key_values = None
+        self._static_cache = None
+        self._attention_mask = None
+        if self.compiled_decoder and self.compiled_decoder.cache is not None:
+            self.compiled_decoder.reset()
+
 # --- Model Singleton ---
 class GemmaModelSingleton:
     _instance = None
+    _lock = Lock() # Requests and the background loader may ask for the instance at the same time
 
     @classmethod
     def get_instance(cls, model_name=config.DEFAULT_MODEL_NAME):
-        if not TRANSFORMERS_AVAILABLE:
+        if not _load_dependencies():
             raise RuntimeError("Transformers library not available or login failed. Cannot create model instance.")
-        if cls._instance is None:
-            logger.info(f"Creating new GemmaModel instance for {model_name}")
-            cls._instance = GemmaModel(model_name)
-        else:
-            logger.info("Reusing existing GemmaModel instance")
-        return cls._instance
+        with cls._lock:
+            if cls._instance is None:
+                logger.info(f"Creating new GemmaModel instance for {model_name}")
+                cls._instance = GemmaModel(model_name)
+            else:
+                logger.info("Reusing existing GemmaModel instance")
+            return cls._instance
 
 # --- Core Model Class ---
 class GemmaModel:
     def __init__(self, model_name=config.DEFAULT_MODEL_NAME):
-        if not TRANSFORMERS_AVAILABLE:
+        if not _load_dependencies():
             raise RuntimeError("Transformers library not available or login failed.")
         self.model_name = model_name
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.tokenizer = None
         self.model = None
+        self.scheduler = None
+        self.prompt_tokenizer = None
+        self.context_manager = None
+        self.memory_manager = MemoryManager(self.device)
+        self.memory_manager.add_reclaimer(self._evict_session_cache)
+        self.backend = select_backend(self.device)
+        self._runtime_configured = False
         self.system_prompt = config.SYSTEM_PROMPT
         self.last_used_time = time.time()
         self.is_loaded = False
+        self._load_lock = Lock() # A request arriving mid-load waits for the load in progress
+        self.checkpoint_cache = QuantizedCheckpointCache() if config.QUANTIZED_CHECKPOINT_CACHE else None
+        self.load_source = None # "hub", "checkpoint_cache" or "standby" for the current load
+        # Warm standby after an idle unload: either the model itself, parked in host RAM,
+        # or its cached checkpoint kept memory-mapped
+        self.standby_tier = None
+        self.standby_since = None
+        self._standby_model = None
+        self._mapped_checkpoint = None
 
         if self.device == "cpu":
-            logger.warning("CUDA not available. Model will run on CPU, which is not recommended for performance.")
+            logger.info(f"CUDA not available. Model will run on CPU with the {self.backend.name} backend.")
 
     def load_model(self):
+        with self._load_lock:
+            return self._load_model()
+
+    def _load_model(self):
         if self.is_loaded:
             logger.info("Model already loaded.")
             return True
 
-        if self.device == "cpu":
-            logger.warning("CUDA not available. Model will run on CPU with offloading, performance will be limited.")
-
-        logger.info(f"Attempting to load model: {self.model_name} onto device: {self.device} with 8-bit quantization")
+        logger.info(f"Attempting to load model: {self.model_name} onto device: {self.device} with the {self.backend.name} backend")
+        load_progress.start()
         try:
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
                 logger.info("CUDA cache cleared before loading.")
-                os.environ['PYTORCH_CUDA_ALLOC_CONF'] = config.CUDA_ALLOC_CONF
-
-            logger.info(f"Loading tokenizer for {self.model_name}...")
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, token=config.HF_TOKEN)
-            logger.info("Tokenizer loaded.")
+            if not self._runtime_configured:
+                self.backend.configure_runtime()
+                self._runtime_configured = True
 
-            logger.info("Configuring BitsAndBytes using settings from config...")
-            bnb_config = BitsAndBytesConfig(
-                load_in_8bit=config.BNB_LOAD_IN_8BIT,
-                llm_int8_enable_fp32_cpu_offload=config.BNB_LLM_INT8_ENABLE_FP32_CPU_OFFLOAD,
-                llm_int8_skip_modules=config.BNB_LLM_INT8_SKIP_MODULES,
-                llm_int8_threshold=config.BNB_LLM_INT8_THRESHOLD
-            )
-            logger.info("BitsAndBytes configured.")
+            if self._standby_model is not None:
+                with load_progress.phase("standby_reactivation"):
+                    self._reactivate_standby()
+            else:
+                self._load_weights()
 
-            logger.info(f"Loading model {self.model_name} with quantization_config and device_map='auto'...")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                quantization_config=bnb_config,
-                device_map="auto",
-                offload_folder=config.OFFLOAD_FOLDER,
-                trust_remote_code=True,
-                token=config.HF_TOKEN
-            )
-
-            logger.info("Model loaded successfully with quantization and potential offloading.")
+            with load_progress.phase("scheduler"):
+                max_context_tokens = _max_context_tokens(self.model.config)
+                compiled_decoder = self._build_compiled_decoder(max_context_tokens) if config.COMPILED_DECODE else None
+                if compiled_decoder:
+                    max_context_tokens = compiled_decoder.max_length
+                drafter = None if compiled_decoder else self._build_drafter()
+                self.scheduler = GenerationScheduler(self.model, self.tokenizer, self.device, memory_manager=self.memory_manager, drafter=drafter,
+                                                     static_kv_cache=self.backend.static_kv_cache, compiled_decoder=compiled_decoder)
+                self.scheduler.set_prefix(format_system_turn(self.system_prompt))
+                self.scheduler.build_prefix()
+                self.prompt_tokenizer = PromptTokenizer(self.tokenizer)
+                self.context_manager = ContextWindowManager(self.prompt_tokenizer, max_context_tokens)
+            if compiled_decoder:
+                with load_progress.phase("compile"):
+                    self.scheduler.start()
             self.is_loaded = True
+
+            if config.WARMUP_ON_LOAD:
+                with load_progress.phase("warmup"):
+                    self.warm_up()
             self.last_used_time = time.time()
+            load_progress.finish()
             return True
 
         except Exception as e:
             logger.exception(f"Failed to load model: {str(e)}")
+            if self.scheduler:
+                self.scheduler.stop()
+            self.scheduler = None
+            self.prompt_tokenizer = None
+            self.context_manager = None
             self.model = None
             self.tokenizer = None
             self.is_loaded = False
+            self._release_standby()
             self.clear_gpu_memory()
+            load_progress.finish(error=str(e))
             return False
 
-    def generate_response_stream(self, conversation: List[Dict[str, str]], max_length=config.MAX_OUTPUT_LENGTH, abort_event=None):
+    def _load_weights(self):
+        """Loads tokenizer and weights through the backend, from the quantized checkpoint cache when it has a valid copy."""
+        settings = self.backend.checkpoint_settings()
+        use_checkpoint_cache = self.checkpoint_cache is not None and self.backend.supports_checkpoint_cache
+        cached_path = self.checkpoint_cache.lookup(self.model_name, settings) if use_checkpoint_cache else None
+        source = cached_path or self.model_name
+        self.load_source = "checkpoint_cache" if cached_path else "hub"
+        if self.standby_tier == "mmap" and cached_path:
+            self.load_source = "mmap_standby"
+
+        with load_progress.phase("tokenizer"):
+            logger.info(f"Loading tokenizer for {self.model_name} from {source}...")
+            self.tokenizer = AutoTokenizer.from_pretrained(source, token=config.HF_TOKEN)
+            logger.info("Tokenizer loaded.")
+
+        with load_progress.phase("weights"):
+            self.model = self.backend.load(source)
+        # The loaded weights no longer need the mapping that kept the checkpoint's pages warm
+        self._release_standby()
+
+        if use_checkpoint_cache and not cached_path:
+            with load_progress.phase("checkpoint_save"):
+                self.checkpoint_cache.save(self.model, self.tokenizer, self.model_name, settings)
+
+    def _reactivate_standby(self):
+        """Moves the model parked in host RAM back onto the device."""
+        logger.info(f"Reactivating model from warm standby (idle for {time.time() - self.standby_since:.0f}s)...")
+        model = self._standby_model
+        if self.device != "cpu":
+            model.to(self.device)
+        self.model = model
+        self.load_source = "standby"
+        self._release_standby()
+
+    def warm_up(self):
+        """Runs one short generation so kernels, allocator pools and the scheduler thread are initialized."""
+        logger.info("Warming up with a short generation...")
+        warmup_conversation = [{"role": "user", "content": config.WARMUP_PROMPT}]
+        # In the background, so it stays out of the latency metrics; nothing else is running yet anyway
+        for result in self.generate_response_stream(warmup_conversation, max_length=config.WARMUP_MAX_NEW_TOKENS, background=True):
+            if result["status"] == "error":
+                raise RuntimeError(f"Warm-up generation failed: {result['message']}")
+        logger.info("Warm-up finished.")
+
+    def _build_compiled_decoder(self, max_context_tokens: int) -> "CompiledDecoder":
+        """
+        Preallocates the compiled decoder's KV cache for MAX_BATCH_SIZE sequences of the context
+        budget (or COMPILED_MAX_CACHE_LENGTH, if smaller), which then also bounds the prompts.
+        """
+        max_length = min(max_context_tokens, config.COMPILED_MAX_CACHE_LENGTH or max_context_tokens)
+        if config.SPECULATIVE_DECODING:
+            logger.warning("Speculative decoding is not supported with compiled decoding, disabling it.")
+        compile = config.COMPILED_DECODE_TORCH_COMPILE
+        if compile and not self.backend.supports_torch_compile:
+            logger.warning(f"The {self.backend.name} backend's weights don't compile into whole graphs, running the fixed-shape decode steps eagerly.")
+            compile = False
+        compiled_decoder = CompiledDecoder(self.model, self.device, max_length, compile=compile)
+        logger.info(f"Compiled decoding enabled: {config.MAX_BATCH_SIZE} x {max_length} position KV cache "
+                    f"({compiled_decoder.cache.nbytes() / 1024**2:.0f} MB).")
+        return compiled_decoder
+
+    def _build_drafter(self):
+        """Creates the speculative decoding drafter selected in config, loading the draft model if needed."""
+        draft_model = None
+        if config.SPECULATIVE_DECODING == "draft_model" and config.SPECULATIVE_DRAFT_MODEL_NAME:
+            logger.info(f"Loading draft model {config.SPECULATIVE_DRAFT_MODEL_NAME} for speculative decoding...")
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                config.SPECULATIVE_DRAFT_MODEL_NAME,
+                device_map="auto",
+                token=config.HF_TOKEN
+            )
+        drafter = build_drafter(config.SPECULATIVE_DECODING, _build_logits_processor(), self.device, draft_model)
+        if drafter:
+            logger.info(f"Speculative decoding enabled ({drafter.name}, {config.SPECULATIVE_NUM_DRAFT_TOKENS} draft tokens).")
+        return drafter
+
+    def generate_response_stream(self, conversation: List[Dict[str, str]], max_length=config.MAX_OUTPUT_LENGTH, abort_event=None,
+                                 conversation_id=None, background=False):
         if not self.is_loaded:
             logger.error("Model not loaded, cannot generate response.")
             yield {"status": "error", "message": "Model not loaded"}
             return
 
         self.last_used_time = time.time()
+        start_time = time.perf_counter()
         logger.info("Starting streamed generation...")
 
-        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=False, skip_special_tokens=True)
+        request = None
 
         try:
-            prompt = _format_conversation_prompt(self.system_prompt, conversation)
-            input_ids = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-
-            generation_kwargs = dict(
-                input_ids=input_ids.input_ids,
-                attention_mask=input_ids.attention_mask,
-                streamer=streamer,
-                max_new_tokens=max_length,
-                do_sample=config.DO_SAMPLE,
-                temperature=config.TEMPERATURE,
-                top_p=config.TOP_P,
-                top_k=config.TOP_K,
-                repetition_penalty=config.REPETITION_PENALTY,
-                no_repeat_ngram_size=config.NO_REPEAT_NGRAM_SIZE,
-                early_stopping=config.EARLY_STOPPING,
-            )
+            request = self._submit_request(conversation, streamer, max_length, abort_event, conversation_id, background)
 
-            thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
-            thread.start()
-            logger.info("Generation thread started.")
-
-            full_response_text = ""
+            response_chunks = []
             for text_chunk in streamer:
                 if abort_event and abort_event.is_set():
-                    logger.warning("Abort signal received during streaming.")
-                    yield {"status": "aborted", "message": "Generation aborted by client"}
-                    return
+                    break
 
                 if text_chunk:
-                    full_response_text += text_chunk
+                    if not response_chunks and not background:
+                        metrics.TIME_TO_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start_time)
+                    response_chunks.append(text_chunk)
                     yield {"status": "streaming", "chunk": text_chunk}
 
-            thread.join()
-            logger.info("Generation thread finished.")
-            yield {"status": "success", "full_response": full_response_text}
+            if abort_event and abort_event.is_set():
+                # Carry the abort into the scheduler so it stops decoding for this request
+                request.cancel()
+                logger.warning("Abort signal received during streaming.")
+                yield {"status": "aborted", "message": "Generation aborted by client"}
+                return
+
+            request.done.wait()
+            if request.error:
+                logger.error(f"Scheduler reported an error: {request.error}")
+                yield {"status": "error", "message": request.error}
+                return
+            logger.info("Generation request finished.")
+            yield {"status": "success", "full_response": "".join(response_chunks)}
 
         except IndexError:
             logger.error("Conversation list appears to be empty during streaming setup.")
@@ -191,9 +1166,251 @@ class GemmaModel:
             logger.exception(f"Error during streamed generation: {str(e)}")
             yield {"status": "error", "message": f"Error during generation: {str(e)}"}
         finally:
-            self.clear_gpu_memory()
+            if request is not None and not request.done.is_set():
+                # The consumer went away (generator closed or errored), stop decoding for it
+                request.cancel()
             logger.info("Streamed generation process finished.")
 
+    async def generate_response_stream_async(self, conversation: List[Dict[str, str]], max_length=config.MAX_OUTPUT_LENGTH, abort_event=None, conversation_id=None):
+        """
+        Same results as generate_response_stream, but the chunks are awaited on the running
+        event loop, so a stream waiting for tokens doesn't hold a thread.
+        """
+        if not self.is_loaded:
+            logger.error("Model not loaded, cannot generate response.")
+            yield {"status": "error", "message": "Model not loaded"}
+            return
+
+        self.last_used_time = time.time()
+        start_time = time.perf_counter()
+        logger.info("Starting async streamed generation...")
+
+        streamer = AsyncTextStreamer(self.tokenizer, asyncio.get_running_loop(), skip_prompt=False, skip_special_tokens=True)
+        request = None
+
+        try:
+            request = self._submit_request(conversation, streamer, max_length, abort_event, conversation_id)
+
+            response_chunks = []
+            async for text_chunk in streamer:
+                if abort_event and abort_event.is_set():
+                    break
+
+                if text_chunk:
+                    if not response_chunks:
+                        metrics.TIME_TO_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start_time)
+                    response_chunks.append(text_chunk)
+                    yield {"status": "streaming", "chunk": text_chunk}
+
+            if abort_event and abort_event.is_set():
+                request.cancel()
+                logger.warning("Abort signal received during streaming.")
+                yield {"status": "aborted", "message": "Generation aborted by client"}
+                return
+
+            # No need to wait on request.done: _finish records the error before it ends the streamer
+            if request.error:
+                logger.error(f"Scheduler reported an error: {request.error}")
+                yield {"status": "error", "message": request.error}
+                return
+            logger.info("Generation request finished.")
+            yield {"status": "success", "full_response": "".join(response_chunks)}
+
+        except IndexError:
+            logger.error("Conversation list appears to be empty during streaming setup.")
+            yield {"status": "error", "message": "Cannot generate response from empty conversation."}
+        except Exception as e:
+            logger.exception(f"Error during streamed generation: {str(e)}")
+            yield {"status": "error", "message": f"Error during generation: {str(e)}"}
+        finally:
+            # Also reached through CancelledError/GeneratorExit when the client disconnects
+            if request is not None and not request.done.is_set():
+                request.cancel()
+            logger.info("Async streamed generation process finished.")
+
+    def generate_batch(self, conversations: List[List[Dict[str, str]]], max_length=config.MAX_OUTPUT_LENGTH, abort_event=None):
+        """
+        Generates a reply to each conversation, for offline jobs. Yields {"status": "result", "index": i, ...}
+        per conversation as it finishes (not in input order), then a "success" summary with the throughput.
+
+        Prompts are sorted by length and submitted in buckets of BATCH_BUCKET_SIZE, which the
+        scheduler prefills together, so little of each batch is padding. Only
+        BATCH_MAX_BUCKETS_IN_FLIGHT buckets are queued at a time, so /chat requests still get in.
+        """
+        if not self.is_loaded:
+            logger.error("Model not loaded, cannot generate responses.")
+            yield {"status": "error", "message": "Model not loaded"}
+            return
+
+        self.last_used_time = time.time()
+        start_time = time.perf_counter()
+        logger.info(f"Starting batch generation of {len(conversations)} conversations...")
+        finished = queue.Queue()
+        requests = {} # index -> request still being generated
+        try:
+            prompts = []
+            for conversation in conversations:
+                prompts.append(self._tokenize_conversation(conversation))
+            buckets = _length_buckets([len(input_ids) for input_ids in prompts], config.BATCH_BUCKET_SIZE)
+            self.scheduler.set_prefix(format_system_turn(self.system_prompt))
+
+            bucket_of = {index: number for number, bucket in enumerate(buckets) for index in bucket}
+            unfinished = {} # bucket number -> requests of the bucket still being generated
+            next_bucket = 0
+            prompt_tokens = generated_tokens = failed = 0
+            while next_bucket < len(buckets) or requests:
+                while next_bucket < len(buckets) and len(unfinished) < config.BATCH_MAX_BUCKETS_IN_FLIGHT:
+                    bucket = buckets[next_bucket]
+                    batch = [GenerationRequest(prompts[index], _BatchResultStreamer(finished, index), max_new_tokens=max_length) for index in bucket]
+                    requests.update(zip(bucket, batch))
+                    unfinished[next_bucket] = len(bucket)
+                    self.scheduler.submit_batch(batch)
+                    next_bucket += 1
+                if abort_event and abort_event.is_set():
+                    logger.warning("Abort signal received during batch generation.")
+                    yield {"status": "aborted", "message": "Batch generation aborted by client"}
+                    return
+                try:
+                    index = finished.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                request = requests.pop(index)
+                request.done.wait()
+                self.last_used_time = time.time()
+                number = bucket_of[index]
+                unfinished[number] -= 1
+                if not unfinished[number]:
+                    del unfinished[number]
+                result = {"status": "result", "index": index, "prompt_tokens": len(request.input_ids), "generated_tokens": len(request.generated_ids)}
+                if request.error:
+                    failed += 1
+                    result["error"] = request.error
+                else:
+                    result["response"] = self.tokenizer.decode(request.generated_ids, skip_special_tokens=True)
+                prompt_tokens += result["prompt_tokens"]
+                generated_tokens += result["generated_tokens"]
+                yield result
+
+            seconds = time.perf_counter() - start_time
+            logger.info(f"Batch generation of {len(conversations)} conversations finished in {seconds:.1f}s.")
+            yield {
+                "status": "success",
+                "conversations": len(conversations),
+                "failed": failed,
+                "prompt_tokens": prompt_tokens,
+                "generated_tokens": generated_tokens,
+                "seconds": round(seconds, 3),
+                "prompts_per_second": round(len(conversations) / seconds, 3) if seconds > 0 else None,
+                "tokens_per_second": round(generated_tokens / seconds, 2) if seconds > 0 else None,
+            }
+
+        except IndexError:
+            logger.error("A conversation in the batch is empty.")
+            yield {"status": "error", "message": "Cannot generate responses for empty conversations."}
+        except Exception as e:
+            logger.exception(f"Error during batch generation: {str(e)}")
+            yield {"status": "error", "message": f"Error during generation: {str(e)}"}
+        finally:
+            # Aborted, failed or the consumer went away: stop decoding what's left
+            for request in requests.values():
+                request.cancel()
+
+    def _submit_request(self, conversation: List[Dict[str, str]], streamer, max_length, abort_event, conversation_id, background=False) -> GenerationRequest:
+        """Fits and tokenizes the conversation and queues it on the scheduler, streaming into `streamer`."""
+        tokenization_start = time.perf_counter()
+        input_ids = self._tokenize_conversation(conversation, conversation_id)
+        if not background:
+            metrics.TOKENIZATION_SECONDS.observe(time.perf_counter() - tokenization_start)
+            metrics.PROMPT_TOKENS.observe(len(input_ids))
+
+        request = GenerationRequest(input_ids, streamer, max_new_tokens=max_length, abort_event=abort_event,
+                                    conversation_id=conversation_id, background=background)
+        self.scheduler.set_prefix(format_system_turn(self.system_prompt))
+        self.scheduler.submit(request)
+        logger.info("Generation request submitted to scheduler.")
+        return request
+
+    def _tokenize_conversation(self, conversation: List[Dict[str, str]], conversation_id=None):
+        """The prompt token ids of the conversation, fitted to the context token budget."""
+        with profiling.phase("fit_context"):
+            conversation = self.fit_conversation(conversation, conversation_id)
+        with profiling.phase("format_template"):
+            turns = conversation_turns(self.system_prompt, conversation)
+        with profiling.phase("tokenize"):
+            return self.prompt_tokenizer.encode(turns)
+
+    def fit_conversation(self, conversation: List[Dict[str, str]], conversation_id=None) -> List[Dict[str, str]]:
+        """Drops the oldest turns that don't fit the context token budget."""
+        if not self.context_manager:
+            return conversation
+        fitted = self.context_manager.fit(format_system_turn(self.system_prompt), conversation, GENERATION_PROMPT)
+        if conversation_id and len(fitted) < len(conversation):
+            # The start of the prompt changed, so the cached KV state can't be reused
+            self.invalidate_conversation(conversation_id)
+        return fitted
+
+    def compact_conversation(self, conversation: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
+        """
+        Summarizes the older messages of a stored conversation whose prompt passed
+        COMPACTION_THRESHOLD_TOKENS. Returns {"compacted_messages": n, "memory": message}: the
+        memory turn to replace its first n messages with. None if it is short enough, or the
+        summary failed.
+        """
+        if not self.is_loaded:
+            return None
+        prompt_tokens = sum(self.prompt_tokenizer.count_tokens(format_history_turn(message)) for message in conversation)
+        if prompt_tokens <= config.COMPACTION_THRESHOLD_TOKENS:
+            return None
+        # The messages kept word for word start with a user turn
+        split = max(len(conversation) - config.COMPACTION_KEEP_RECENT_MESSAGES, 0)
+        while 0 < split < len(conversation) and conversation[split]["role"] != "user":
+            split -= 1
+        if split < 2:
+            return None
+
+        speakers = {"user": "User", MEMORY_ROLE: "Earlier summary"}
+
+        def summary_request(messages):
+            transcript = "\n\n".join(f"{speakers.get(message['role'], 'DracoBot')}: {message['content']}" for message in messages)
+            return [{"role": "user", "content": f"{config.COMPACTION_PROMPT}\n\n{transcript}"}]
+
+        # A request over the budget would be truncated from the start, cutting off the instruction, and the
+        # reply would then replace those turns for good. Summarize fewer turns instead; a later compaction
+        # (which sees this summary as the earlier one) takes the rest
+        request = summary_request(conversation[:split])
+        while self.context_manager and not self.context_manager.fits_whole(format_system_turn(self.system_prompt), request[0], GENERATION_PROMPT):
+            split -= 1
+            while split > 0 and conversation[split]["role"] != "user":
+                split -= 1
+            if split < 2:
+                logger.warning("The oldest turns of a conversation are too long to summarize; not compacting it.")
+                return None
+            request = summary_request(conversation[:split])
+        start_time = time.perf_counter()
+        summary = None
+        # In the background: it only starts while no live request is queued or decoding
+        for result in self.generate_response_stream(request, max_length=config.COMPACTION_SUMMARY_MAX_TOKENS, background=True):
+            if result["status"] == "success":
+                summary = result["full_response"].strip()
+            elif result["status"] != "streaming":
+                logger.warning(f"Conversation summary failed: {result.get('message')}")
+        if not summary:
+            return None
+        logger.info(f"Summarized {split} messages ({prompt_tokens} prompt tokens in all) in {time.perf_counter() - start_time:.1f}s.")
+        return {"compacted_messages": split, "memory": {"role": MEMORY_ROLE, "content": summary}}
+
+    def _evict_session_cache(self) -> int:
+        """Memory manager reclaimer: drops the least recently used conversation KV cache."""
+        if not self.scheduler:
+            return 0
+        return self.scheduler.session_store.evict_lru()
+
+    def invalidate_conversation(self, conversation_id: str):
+        """Drops the cached KV state of a conversation, e.g. after its history was trimmed."""
+        if self.scheduler:
+            self.scheduler.session_store.invalidate(conversation_id)
+
     def get_health_status(self) -> Dict[str, Any]:
         status = {
             "is_loaded": self.is_loaded,
@@ -202,6 +1419,11 @@ class GemmaModel:
             "gpu_available": torch.cuda.is_available()
         }
 
+        if self.scheduler:
+            status["scheduler"] = self.scheduler.get_status()
+        if self.context_manager:
+            status["context"] = self.context_manager.get_status()
+
         if torch.cuda.is_available():
             allocated = torch.cuda.memory_allocated(0) / 1024**2
             reserved = torch.cuda.memory_reserved(0) / 1024**2
@@ -210,24 +1432,107 @@ class GemmaModel:
                 "reserved_mb": round(reserved, 2)
             }
 
+        status["memory"] = self.memory_manager.get_status()
+        status["standby"] = self.get_standby_status()
+        status["backend"] = self.backend.get_status()
+        if self.checkpoint_cache:
+            status["checkpoint_cache"] = self.checkpoint_cache.get_status()
+
         return status
 
     def unload_if_inactive(self, max_idle_time=config.MAX_IDLE_TIME_SECONDS):
-        if not self.is_loaded:
+        """
+        Unloads the model once idle for `max_idle_time`, into the STANDBY_TIER if one is set.
+        A standby copy is dropped too after another STANDBY_MAX_SECONDS without requests.
+        """
+        idle_time = time.time() - self.last_used_time
+        if self.standby_tier and time.time() - self.standby_since > config.STANDBY_MAX_SECONDS:
+            with self._load_lock:
+                if self.standby_tier and not self.is_loaded:
+                    logger.info(f"Model in {self.standby_tier} standby for {config.STANDBY_MAX_SECONDS} seconds, releasing it.")
+                    self._release_standby()
+                    self.clear_gpu_memory()
             return False
 
-        current_time = time.time()
-        if (current_time - self.last_used_time) > max_idle_time:
-            logger.info(f"Model inactive for {max_idle_time} seconds, unloading...")
-            self.model = None
-            self.tokenizer = None
+        if not self.is_loaded or idle_time <= max_idle_time:
+            return False
+        if self.scheduler and self.scheduler.has_work:
+            return False # A long generation counts as activity
+        logger.info(f"Model inactive for {max_idle_time} seconds, unloading...")
+        return self.unload(standby_tier=config.STANDBY_TIER)
+
+    def unload(self, standby_tier=None) -> bool:
+        """
+        Frees the model. With standby_tier "host" the weights are parked in host RAM and
+        the next load only moves them back; with "mmap" the quantized checkpoint is kept
+        memory-mapped so the next load reads it from the page cache.
+        """
+        with self._load_lock:
+            if not self.is_loaded:
+                return False
+            if self.scheduler:
+                self.scheduler.stop()
+                self.scheduler = None
+            self.prompt_tokenizer = None
+            self.context_manager = None
             self.is_loaded = False
 
+            if standby_tier == "host":
+                self._park_in_host_memory()
+            elif standby_tier == "mmap":
+                self._map_checkpoint()
+            elif standby_tier:
+                logger.warning(f"Unknown STANDBY_TIER {standby_tier!r}, unloading completely.")
+            if not self.standby_tier or self.standby_tier == "mmap":
+                self.model = None
+                self.tokenizer = None
+            if self.standby_tier:
+                self.standby_since = time.time()
+                logger.info(f"Model parked in {self.standby_tier} standby.")
+
+            gc.collect()
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
 
             return True
-        return False
+
+    def _park_in_host_memory(self):
+        try:
+            if self.device != "cpu":
+                self.model.to("cpu")
+        except Exception as e:
+            # Quantized or dispatched models can refuse .to(); the mmap tier still helps
+            logger.warning(f"Could not park the model in host memory ({e}), falling back to mmap standby.")
+            self._map_checkpoint()
+            return
+        self._standby_model = self.model
+        self.standby_tier = "host"
+
+    def _map_checkpoint(self):
+        cached_path = None
+        if self.checkpoint_cache and self.backend.supports_checkpoint_cache:
+            cached_path = self.checkpoint_cache.lookup(self.model_name, self.backend.checkpoint_settings())
+        if not cached_path:
+            logger.warning("No cached quantized checkpoint to keep mapped, unloading completely.")
+            return
+        self._mapped_checkpoint = MappedCheckpoint(cached_path)
+        self.standby_tier = "mmap"
+
+    def _release_standby(self):
+        self._standby_model = None
+        if self._mapped_checkpoint:
+            self._mapped_checkpoint.close()
+            self._mapped_checkpoint = None
+        self.standby_tier = None
+        self.standby_since = None
+
+    def get_standby_status(self) -> Dict[str, Any]:
+        status = {"tier": self.standby_tier, "last_load_source": self.load_source}
+        if self.standby_tier:
+            status["seconds_in_standby"] = round(time.time() - self.standby_since, 1)
+        if self._mapped_checkpoint:
+            status["mapped_mb"] = round(self._mapped_checkpoint.nbytes / 1024**2, 2)
+        return status
 
     def clear_gpu_memory(self):
         if torch.cuda.is_available():
@@ -236,24 +1541,244 @@ class GemmaModel:
             torch.cuda.synchronize()
             logger.info("GPU memory cleared")
 
+# --- Background Loading ---
+_background_load_thread = None
+_background_load_lock = Lock()
+
+def _background_load(model_name: str):
+    load_progress.start()
+    try:
+        with load_progress.phase("imports"):
+            available = _load_dependencies()
+        if not available:
+            load_progress.finish(error="Transformers library not available or login failed.")
+            return
+        # load_model records the remaining phases and finishes load_progress itself
+        GemmaModelSingleton.get_instance(model_name).load_model()
+    except Exception as e:
+        logger.exception(f"Background model load failed: {str(e)}")
+        load_progress.finish(error=str(e))
+
+def start_background_load(model_name=config.DEFAULT_MODEL_NAME) -> Thread:
+    """Imports dependencies, loads and warms up the model in a daemon thread; later calls return the same thread."""
+    global _background_load_thread
+    with _background_load_lock:
+        if _background_load_thread is None:
+            _background_load_thread = Thread(target=_background_load, args=(model_name,), daemon=True, name="model-loader")
+            _background_load_thread.start()
+    return _background_load_thread
+
+_idle_reaper_thread = None
+_idle_reaper_stop = Event()
+
+def _reap_idle_model(check_interval: float):
+    while not _idle_reaper_stop.wait(check_interval):
+        model_instance = GemmaModelSingleton._instance
+        if model_instance is None:
+            continue
+        try:
+            model_instance.unload_if_inactive()
+        except Exception as e:
+            logger.exception(f"Idle unload check failed: {str(e)}")
+
+def start_idle_reaper(check_interval=config.IDLE_CHECK_INTERVAL_SECONDS) -> Thread:
+    """Periodically unloads the model (into warm standby) once it has been idle for MAX_IDLE_TIME_SECONDS."""
+    global _idle_reaper_thread
+    with _background_load_lock:
+        if _idle_reaper_thread is None:
+            _idle_reaper_thread = Thread(target=_reap_idle_model, args=(check_interval,), daemon=True, name="idle-reaper")
+            _idle_reaper_thread.start()
+    return _idle_reaper_thread
+
+def get_readiness() -> Dict[str, Any]:
+    """Readiness probe data: whether the model finished loading and warming up, plus per-phase timings."""
+    model_instance = GemmaModelSingleton._instance
+    return {
+        "ready": load_progress.is_ready,
+        # Still ready after an idle unload, the next request reloads the model
+        "model_loaded": bool(model_instance and model_instance.is_loaded),
+        **load_progress.get_status(),
+    }
+
+# --- Metrics ---
+def _kv_cache_bytes():
+    model_instance = GemmaModelSingleton._instance
+    scheduler = model_instance.scheduler if model_instance else None
+    if scheduler is None:
+        return {}
+    return {(cache,): nbytes for cache, nbytes in scheduler.kv_cache_bytes().items()}
+
+def _memory_used_bytes():
+    model_instance = GemmaModelSingleton._instance
+    if model_instance is None:
+        return {}
+    return {(model_instance.device,): model_instance.memory_manager.get_usage()["used_bytes"]}
+
+def _host_memory_rss_bytes():
+    # process_rss_bytes is imported with torch; nothing is loaded (and little is resident) before that
+    return {(): process_rss_bytes()} if TRANSFORMERS_AVAILABLE else {}
+
+def _scheduler_sequences():
+    model_instance = GemmaModelSingleton._instance
+    scheduler = model_instance.scheduler if model_instance else None
+    if scheduler is None:
+        return {}
+    status = scheduler.get_status()
+    return {("active",): status["active_sequences"], ("pending",): status["pending_requests"]}
+
+metrics.KV_CACHE_BYTES.set_function(_kv_cache_bytes)
+metrics.MEMORY_USED_BYTES.set_function(_memory_used_bytes)
+metrics.HOST_MEMORY_RSS_BYTES.set_function(_host_memory_rss_bytes)
+metrics.SCHEDULER_SEQUENCES.set_function(_scheduler_sequences)
+
+def get_metrics_text() -> str:
+    """The model's metrics in the Prometheus text format."""
+    return metrics.MODEL_METRICS.render()
+
 # --- API Interface Functions ---
-def get_chatbot_response_stream(conversation: List[Dict[str, str]], abort_event=None):
+_response_cache = None
+_response_cache_lock = Lock()
+
+def _get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None and config.RESPONSE_CACHE_ENABLED:
+            embedder = load_embedder() if config.RESPONSE_CACHE_SEMANTIC else None
+            _response_cache = ResponseCache(embedder=embedder)
+    return _response_cache
+
+def _replay_cached_response(chunks: List[str]):
+    """Yields a cached answer in the same shape as a live stream."""
+    for chunk in chunks:
+        yield {"status": "streaming", "chunk": chunk}
+    yield {"status": "success", "full_response": "".join(chunks)}
+
+def _store_response_stream(stream_generator, response_cache, fingerprint, conversation):
+    """Passes a live stream through and caches the answer if it completes successfully."""
+    chunks = []
+    try:
+        for result in stream_generator:
+            if result["status"] == "streaming":
+                chunks.append(result["chunk"])
+            elif result["status"] == "success":
+                response_cache.put(fingerprint, conversation, chunks)
+            yield result
+    finally:
+        # Closing this wrapper early must also close (and so cancel) the live stream
+        stream_generator.close()
+
+def get_chatbot_response_stream(conversation: List[Dict[str, str]], abort_event=None, conversation_id=None):
     try:
         model_instance = GemmaModelSingleton.get_instance()
+
+        response_cache = _get_response_cache()
+        if response_cache:
+            fingerprint = generation_fingerprint(model_instance.model_name, model_instance.system_prompt)
+            cached_chunks = response_cache.get(fingerprint, conversation)
+            if cached_chunks is not None:
+                logger.info("Serving response from cache.")
+                metrics.RESPONSE_CACHE_HITS.inc()
+                return _replay_cached_response(cached_chunks)
+
         if not model_instance.is_loaded:
             if not model_instance.load_model():
                 def error_generator():
                     yield {"status": "error", "message": "Model failed to load"}
                 return error_generator()
 
-        return model_instance.generate_response_stream(conversation, abort_event=abort_event)
+        stream_generator = model_instance.generate_response_stream(conversation, abort_event=abort_event, conversation_id=conversation_id)
+        if response_cache:
+            return _store_response_stream(stream_generator, response_cache, fingerprint, list(conversation))
+        return stream_generator
 
     except Exception as e:
         logger.exception(f"Error getting model instance for streaming: {str(e)}")
+        error_message = f"Failed to get model instance: {str(e)}" # `e` is unbound once the except block ends
+        def error_generator():
+            yield {"status": "error", "message": error_message}
+        return error_generator()
+
+async def get_chatbot_response_stream_async(conversation: List[Dict[str, str]], abort_event=None, conversation_id=None):
+    """Async counterpart of get_chatbot_response_stream, used by the ASGI app."""
+    try:
+        # Creating the instance may import torch and loading takes a while, keep both off the event loop
+        model_instance = await asyncio.to_thread(GemmaModelSingleton.get_instance)
+
+        response_cache = _get_response_cache()
+        if response_cache:
+            fingerprint = generation_fingerprint(model_instance.model_name, model_instance.system_prompt)
+            cached_chunks = await asyncio.to_thread(response_cache.get, fingerprint, conversation)
+            if cached_chunks is not None:
+                logger.info("Serving response from cache.")
+                metrics.RESPONSE_CACHE_HITS.inc()
+                for result in _replay_cached_response(cached_chunks):
+                    yield result
+                return
+
+        if not model_instance.is_loaded:
+            if not await asyncio.to_thread(model_instance.load_model):
+                yield {"status": "error", "message": "Model failed to load"}
+                return
+    except Exception as e:
+        logger.exception(f"Error getting model instance for streaming: {str(e)}")
+        yield {"status": "error", "message": f"Failed to get model instance: {str(e)}"}
+        return
+
+    conversation = list(conversation)
+    stream_generator = model_instance.generate_response_stream_async(conversation, abort_event=abort_event, conversation_id=conversation_id)
+    chunks = []
+    try:
+        async for result in stream_generator:
+            if response_cache:
+                if result["status"] == "streaming":
+                    chunks.append(result["chunk"])
+                elif result["status"] == "success":
+                    response_cache.put(fingerprint, conversation, chunks)
+            yield result
+    finally:
+        # Closing this wrapper early must also close (and so cancel) the live stream
+        await stream_generator.aclose()
+
+def get_batch_response_stream(conversations: List[List[Dict[str, str]]], max_length=config.MAX_OUTPUT_LENGTH, abort_event=None):
+    """
+    Results of GemmaModel.generate_batch, loading the model first if needed. Offline jobs
+    skip the response cache: pre-generated content is meant to be fresh.
+    """
+    try:
+        model_instance = GemmaModelSingleton.get_instance()
+        if not model_instance.is_loaded:
+            if not model_instance.load_model():
+                def error_generator():
+                    yield {"status": "error", "message": "Model failed to load"}
+                return error_generator()
+        return model_instance.generate_batch(conversations, max_length, abort_event)
+
+    except Exception as e:
+        logger.exception(f"Error getting model instance for batch generation: {str(e)}")
+        error_message = f"Failed to get model instance: {str(e)}"
         def error_generator():
-            yield {"status": "error", "message": f"Failed to get model instance: {str(e)}"}
+            yield {"status": "error", "message": error_message}
         return error_generator()
 
+def fit_conversation_to_context(conversation: List[Dict[str, str]], conversation_id=None) -> List[Dict[str, str]]:
+    """Trims a conversation to the context token budget; returned unchanged until the model is loaded."""
+    model_instance = GemmaModelSingleton._instance
+    if model_instance and model_instance.is_loaded:
+        return model_instance.fit_conversation(conversation, conversation_id)
+    return conversation
+
+def compact_conversation(conversation: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
+    """GemmaModel.compact_conversation on the loaded model. None while it isn't loaded: compaction never loads it."""
+    model_instance = GemmaModelSingleton._instance
+    if model_instance and model_instance.is_loaded:
+        return model_instance.compact_conversation(conversation)
+    return None
+
+def invalidate_conversation_cache(conversation_id: str):
+    model_instance = GemmaModelSingleton._instance
+    if model_instance:
+        model_instance.invalidate_conversation(conversation_id)
+
 def get_health_check() -> Dict[str, Any]:
     try:
         model_instance = GemmaModelSingleton._instance
@@ -263,11 +1788,16 @@ def get_health_check() -> Dict[str, Any]:
             status_data = {
                 "model_name": config.DEFAULT_MODEL_NAME,
                 "is_loaded": False,
-                "device": "cuda" if torch.cuda.is_available() else "cpu",
                 "transformers_available": TRANSFORMERS_AVAILABLE,
-                "gpu_available": torch.cuda.is_available() if TRANSFORMERS_AVAILABLE else False,
                 "status": "Instance not created yet."
             }
+            if TRANSFORMERS_AVAILABLE:
+                # Only report devices once torch is imported; a health check shouldn't trigger the import
+                status_data["device"] = "cuda" if torch.cuda.is_available() else "cpu"
+                status_data["gpu_available"] = torch.cuda.is_available()
+        status_data["load_progress"] = load_progress.get_status()
+        if _response_cache:
+            status_data["response_cache"] = _response_cache.get_status()
         return {"status": "success", "data": status_data}
     except Exception as e:
         logger.exception(f"Error during health check: {str(e)}")
@@ -300,8 +1830,7 @@ if __name__ == "__main__":
                 elif result["status"] == "error":
                     print(f"\n[Error: {result['message']}]")
                     break
-            if len(conversation_history) > 10:
-                conversation_history = conversation_history[-10:]
+            conversation_history = GemmaModelSingleton.get_instance().fit_conversation(conversation_history)
     except RuntimeError as e: print(f"\nRuntime Error: {e}")
     except KeyboardInterrupt: print("\nExiting chat due to interrupt.")
     except Exception as e: print(f"\nAn unexpected error occurred: {e}"); logger.exception("Error during interactive chat session:")
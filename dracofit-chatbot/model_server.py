@@ -0,0 +1,503 @@
+"""
+Shared model server: one process owns the GemmaModel and serves every API worker over a
+Unix socket, so the weights are loaded once and requests from all workers are batched
+by the same scheduler.
+
+Run it with `python model_server.py`, set MODEL_SERVER_ENABLED = True and start the API
+workers as usual (e.g. gunicorn --workers 4 ...). With the flag off, api.py loads the
+model in-process as before.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import signal
+import time
+import uuid
+from multiprocessing.connection import Client, Listener
+from threading import BoundedSemaphore, Event, Lock, Thread
+from typing import Any, Dict, List
+
+import config
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("success", "error", "aborted")
+
+# --- Helper Functions ---
+def _authkey() -> bytes:
+    return (config.MODEL_SERVER_AUTHKEY or "").encode("utf-8")
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return json.dumps(message).encode("utf-8")
+
+def _decode(data: bytes) -> Dict[str, Any]:
+    return json.loads(data.decode("utf-8"))
+
+# --- Server ---
+class _WorkerConnection:
+    """
+    The server side of one API worker's connection.
+
+    Messages to the worker go through a bounded outbox drained by a writer thread. When
+    the worker reads slower than tokens are produced the outbox fills and only that
+    worker's streams pause; other workers keep streaming.
+    """
+    def __init__(self, server: "ModelServer", connection, name: str):
+        self.server = server
+        self.connection = connection
+        self.name = name
+        self.outbox = queue.Queue(maxsize=config.MODEL_SERVER_SEND_QUEUE_SIZE)
+        self.abort_events = {} # request id -> Event of that worker's in-flight generations
+        self.closed = Event()
+        self._lock = Lock()
+
+    def start(self):
+        Thread(target=self._read_loop, daemon=True, name=f"{self.name}-reader").start()
+        Thread(target=self._write_loop, daemon=True, name=f"{self.name}-writer").start()
+
+    def send(self, message: Dict[str, Any]) -> bool:
+        """Queues a message, blocking while the outbox is full. False once the connection is gone."""
+        while not self.closed.is_set():
+            try:
+                self.outbox.put(message, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        with self._lock:
+            # Nobody is left to read these streams
+            for abort_event in self.abort_events.values():
+                abort_event.set()
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+        self.server.remove_worker(self)
+        logger.info(f"Model server: {self.name} disconnected.")
+
+    def _write_loop(self):
+        while not self.closed.is_set():
+            try:
+                message = self.outbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.connection.send_bytes(_encode(message))
+            except (OSError, EOFError):
+                self.close()
+
+    def _read_loop(self):
+        while not self.closed.is_set():
+            try:
+                message = _decode(self.connection.recv_bytes())
+            except (OSError, EOFError):
+                break
+            except ValueError:
+                logger.warning(f"Model server: malformed message from {self.name}, ignoring.")
+                continue
+            self._dispatch(message)
+        self.close()
+
+    def _dispatch(self, message: Dict[str, Any]):
+        kind = message.get("type")
+        request_id = message.get("id")
+        if kind == "generate":
+            with self._lock:
+                if len(self.abort_events) >= config.MODEL_SERVER_MAX_INFLIGHT_PER_WORKER:
+                    self.send({"id": request_id, "status": "error", "message": "Too many concurrent requests from this worker"})
+                    return
+                abort_event = Event()
+                self.abort_events[request_id] = abort_event
+            Thread(target=self._generate, args=(request_id, message, abort_event), daemon=True).start()
+        elif kind == "cancel":
+            with self._lock:
+                abort_event = self.abort_events.get(request_id)
+            if abort_event:
+                abort_event.set()
+        elif kind == "call":
+            # Calls are quick but may wait for the model lock, so keep the reader free
+            Thread(target=self._call, args=(request_id, message), daemon=True).start()
+        else:
+            logger.warning(f"Model server: unknown message type {kind!r} from {self.name}.")
+
+    def _generate(self, request_id: str, message: Dict[str, Any], abort_event: Event):
+        import model
+        if "conversations" in message:
+            # A batch job: one request id streams a result per conversation, then the summary
+            stream_generator = model.get_batch_response_stream(message["conversations"], message["max_new_tokens"], abort_event)
+        else:
+            stream_generator = model.get_chatbot_response_stream(message["conversation"], abort_event, message.get("conversation_id"))
+        try:
+            for result in stream_generator:
+                finished = result.get("status") in TERMINAL_STATUSES
+                if finished:
+                    # Free the slot before the worker hears about it, or its next request could be refused
+                    self._release(request_id)
+                if not self.send({"id": request_id, **result}):
+                    abort_event.set()
+                    break
+                if finished:
+                    break
+        except Exception as e:
+            logger.exception(f"Model server: generation failed: {e}")
+            self._release(request_id)
+            self.send({"id": request_id, "status": "error", "message": f"Error during generation: {str(e)}"})
+        finally:
+            stream_generator.close()
+            self._release(request_id)
+
+    def _release(self, request_id: str):
+        with self._lock:
+            self.abort_events.pop(request_id, None)
+
+    def _call(self, request_id: str, message: Dict[str, Any]):
+        try:
+            result = self.server.handle_call(message["method"], message.get("args", {}))
+            self.send({"id": request_id, "status": "result", "result": result})
+        except Exception as e:
+            logger.exception(f"Model server: call {message.get('method')!r} failed: {e}")
+            self.send({"id": request_id, "status": "error", "message": str(e)})
+
+class ModelServer:
+    """Owns the model in this process and serves API workers connecting to `address`."""
+    def __init__(self, address=None):
+        self.address = address or config.MODEL_SERVER_SOCKET
+        self.listener = None
+        self.workers = []
+        self.connections_accepted = 0
+        self._lock = Lock()
+        self._stopped = Event()
+
+    def handle_call(self, method: str, args: Dict[str, Any]):
+        import model
+        if method == "fit_conversation":
+            return model.fit_conversation_to_context(args["conversation"], args.get("conversation_id"))
+        if method == "compact_conversation":
+            return model.compact_conversation(args["conversation"])
+        if method == "invalidate_conversation":
+            model.invalidate_conversation_cache(args["conversation_id"])
+            return None
+        if method == "health":
+            health = model.get_health_check()
+            if health.get("status") == "success":
+                health["data"]["model_server"] = self.get_status()
+            return health
+        if method == "readiness":
+            return model.get_readiness()
+        if method == "metrics":
+            return model.get_metrics_text()
+        raise ValueError(f"Unknown model server method: {method}")
+
+    def remove_worker(self, worker: _WorkerConnection):
+        with self._lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+    def serve_forever(self):
+        import model
+        if os.path.exists(self.address):
+            os.unlink(self.address) # Left behind by a previous server that didn't shut down cleanly
+        self.listener = Listener(self.address, family="AF_UNIX", authkey=_authkey())
+        os.chmod(self.address, 0o600)
+        logger.info(f"Model server listening on {self.address}")
+
+        model.start_background_load()
+        model.start_idle_reaper()
+        while not self._stopped.is_set():
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                if self._stopped.is_set():
+                    break
+                logger.exception("Model server: failed to accept a worker connection.")
+                continue
+            except Exception as e:
+                # e.g. a client with the wrong authkey
+                logger.warning(f"Model server: rejected a connection: {e}")
+                continue
+            with self._lock:
+                self.connections_accepted += 1
+                worker = _WorkerConnection(self, connection, f"worker-{self.connections_accepted}")
+                self.workers.append(worker)
+            worker.start()
+            logger.info(f"Model server: {worker.name} connected.")
+
+    def stop(self):
+        self._stopped.set()
+        for worker in list(self.workers):
+            worker.close()
+        if self.listener:
+            self.listener.close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def get_status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "address": self.address,
+                "workers": len(self.workers),
+                "connections_accepted": self.connections_accepted,
+                "in_flight": {worker.name: len(worker.abort_events) for worker in self.workers},
+                "outbox_depth": {worker.name: worker.outbox.qsize() for worker in self.workers},
+            }
+
+# --- Client ---
+class _AsyncRequestQueue:
+    """Lets the client's reader thread hand messages to a request awaited on an event loop."""
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, message: Dict[str, Any]):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+        except RuntimeError:
+            pass # The loop was closed, nobody is waiting for this anymore
+
+    async def get(self) -> Dict[str, Any]:
+        return await self.queue.get()
+
+class ModelServerClient:
+    """
+    An API worker's connection to the model server, shared by all of its request threads.
+
+    Generations are multiplexed over the one connection by request id. At most
+    `max_in_flight` run at a time per worker; further requests wait for a slot (up to
+    MODEL_SERVER_ACQUIRE_TIMEOUT_SECONDS) instead of piling onto the server.
+    """
+    def __init__(self, address=None, max_in_flight=None):
+        self.address = address or config.MODEL_SERVER_SOCKET
+        self.max_in_flight = max_in_flight or config.MODEL_SERVER_MAX_INFLIGHT_PER_WORKER
+        self._connection = None
+        self._pid = None
+        self._connect_lock = Lock()
+        self._send_lock = Lock()
+        self._queues = {} # request id -> Queue of messages for that request
+        self._slots = BoundedSemaphore(self.max_in_flight)
+        self.requests_started = 0
+        self.requests_rejected = 0
+
+    def _connect(self):
+        with self._connect_lock:
+            if self._connection is not None and self._pid == os.getpid():
+                return self._connection
+            # A connection inherited across fork belongs to the parent process
+            connection = Client(self.address, family="AF_UNIX", authkey=_authkey())
+            self._connection, self._pid = connection, os.getpid()
+            Thread(target=self._read_loop, args=(connection,), daemon=True, name="model-server-client").start()
+            logger.info(f"Connected to model server at {self.address}")
+            return connection
+
+    def _read_loop(self, connection):
+        while True:
+            try:
+                message = _decode(connection.recv_bytes())
+            except (OSError, EOFError):
+                break
+            request_queue = self._queues.get(message.get("id"))
+            if request_queue is not None:
+                request_queue.put(message)
+        with self._connect_lock:
+            if self._connection is connection:
+                self._connection = None
+        # Wake everyone waiting on this connection
+        for request_queue in list(self._queues.values()):
+            request_queue.put({"status": "error", "message": "Lost connection to the model server"})
+
+    def _send(self, message: Dict[str, Any]):
+        connection = self._connect()
+        with self._send_lock:
+            connection.send_bytes(_encode(message))
+
+    def call(self, method: str, timeout=None, **args):
+        request_id = uuid.uuid4().hex
+        request_queue = queue.Queue()
+        self._queues[request_id] = request_queue
+        try:
+            self._send({"type": "call", "id": request_id, "method": method, "args": args})
+            reply = request_queue.get(timeout=timeout or config.MODEL_SERVER_CALL_TIMEOUT_SECONDS)
+        except queue.Empty:
+            raise TimeoutError(f"Model server didn't answer {method} in time")
+        finally:
+            self._queues.pop(request_id, None)
+        if reply["status"] == "error":
+            raise RuntimeError(reply["message"])
+        return reply["result"]
+
+    def stream(self, conversation: List[Dict[str, str]], abort_event=None, conversation_id=None):
+        """Yields the same result dicts as model.get_chatbot_response_stream, produced by the server."""
+        return self._stream({"type": "generate", "conversation": conversation, "conversation_id": conversation_id}, abort_event)
+
+    def stream_batch(self, conversations: List[List[Dict[str, str]]], max_new_tokens: int, abort_event=None):
+        """Yields the same result dicts as model.get_batch_response_stream, produced by the server."""
+        return self._stream({"type": "generate", "conversations": conversations, "max_new_tokens": max_new_tokens}, abort_event)
+
+    def _stream(self, request_message: Dict[str, Any], abort_event=None):
+        if not self._slots.acquire(timeout=config.MODEL_SERVER_ACQUIRE_TIMEOUT_SECONDS):
+            self.requests_rejected += 1
+            yield {"status": "error", "message": "Model server is busy, please try again"}
+            return
+        request_id = uuid.uuid4().hex
+        request_queue = queue.Queue()
+        self._queues[request_id] = request_queue
+        finished = cancel_sent = False
+        try:
+            self.requests_started += 1
+            self._send({**request_message, "id": request_id})
+            while True:
+                if abort_event and abort_event.is_set() and not cancel_sent:
+                    self._send({"type": "cancel", "id": request_id})
+                    cancel_sent = True
+                try:
+                    message = request_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                message.pop("id", None)
+                finished = message["status"] in TERMINAL_STATUSES
+                yield message
+                if finished:
+                    return
+        except (OSError, EOFError) as e:
+            logger.error(f"Model server connection failed: {e}")
+            finished = True
+            yield {"status": "error", "message": "Model server unavailable"}
+        finally:
+            if not finished and not cancel_sent:
+                # The consumer went away mid-stream: stop the server decoding for it
+                try:
+                    self._send({"type": "cancel", "id": request_id})
+                except (OSError, EOFError):
+                    pass
+            self._queues.pop(request_id, None)
+            self._slots.release()
+
+    async def stream_async(self, conversation: List[Dict[str, str]], abort_event=None, conversation_id=None):
+        """Async counterpart of stream: messages are awaited on the running event loop instead of a blocked thread."""
+        deadline = time.monotonic() + config.MODEL_SERVER_ACQUIRE_TIMEOUT_SECONDS
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                self.requests_rejected += 1
+                yield {"status": "error", "message": "Model server is busy, please try again"}
+                return
+            await asyncio.sleep(0.05)
+        request_id = uuid.uuid4().hex
+        request_queue = _AsyncRequestQueue(asyncio.get_running_loop())
+        self._queues[request_id] = request_queue
+        finished = cancel_sent = False
+        try:
+            self.requests_started += 1
+            # Connecting may block briefly on the socket; later sends are small writes
+            await asyncio.to_thread(self._connect)
+            self._send({"type": "generate", "id": request_id, "conversation": conversation, "conversation_id": conversation_id})
+            while True:
+                if abort_event and abort_event.is_set() and not cancel_sent:
+                    self._send({"type": "cancel", "id": request_id})
+                    cancel_sent = True
+                try:
+                    message = await asyncio.wait_for(request_queue.get(), timeout=0.1)
+                except asyncio.TimeoutError:
+                    continue
+                message.pop("id", None)
+                finished = message["status"] in TERMINAL_STATUSES
+                yield message
+                if finished:
+                    return
+        except (OSError, EOFError) as e:
+            logger.error(f"Model server connection failed: {e}")
+            finished = True
+            yield {"status": "error", "message": "Model server unavailable"}
+        finally:
+            if not finished and not cancel_sent:
+                # The client disconnected mid-stream: stop the server decoding for it
+                try:
+                    self._send({"type": "cancel", "id": request_id})
+                except (OSError, EOFError):
+                    pass
+            self._queues.pop(request_id, None)
+            self._slots.release()
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "address": self.address,
+            "connected": self._connection is not None and self._pid == os.getpid(),
+            "in_flight": len(self._queues),
+            "max_in_flight": self.max_in_flight,
+            "requests_started": self.requests_started,
+            "requests_rejected": self.requests_rejected,
+        }
+
+# --- API Interface Functions (model server mode) ---
+_client = None
+_client_lock = Lock()
+
+def _get_client() -> ModelServerClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ModelServerClient()
+    return _client
+
+def get_chatbot_response_stream(conversation: List[Dict[str, str]], abort_event=None, conversation_id=None):
+    return _get_client().stream(conversation, abort_event, conversation_id)
+
+def get_chatbot_response_stream_async(conversation: List[Dict[str, str]], abort_event=None, conversation_id=None):
+    return _get_client().stream_async(conversation, abort_event, conversation_id)
+
+def get_batch_response_stream(conversations: List[List[Dict[str, str]]], max_length=config.MAX_OUTPUT_LENGTH, abort_event=None):
+    return _get_client().stream_batch(conversations, max_length, abort_event)
+
+def fit_conversation_to_context(conversation: List[Dict[str, str]], conversation_id=None) -> List[Dict[str, str]]:
+    try:
+        return _get_client().call("fit_conversation", conversation=conversation, conversation_id=conversation_id)
+    except Exception as e:
+        logger.warning(f"Could not fit conversation on the model server, sending it as is: {e}")
+        return conversation
+
+def compact_conversation(conversation: List[Dict[str, str]]):
+    # Summarizing takes a whole generation, much longer than the other calls
+    return _get_client().call("compact_conversation", timeout=config.COMPACTION_TIMEOUT_SECONDS, conversation=conversation)
+
+def invalidate_conversation_cache(conversation_id: str):
+    _get_client().call("invalidate_conversation", conversation_id=conversation_id)
+
+def get_health_check() -> Dict[str, Any]:
+    client = _get_client()
+    try:
+        health = client.call("health")
+    except Exception as e:
+        return {"status": "error", "message": f"Model server unavailable: {str(e)}", "data": {"model_server_client": client.get_status()}}
+    if health.get("status") == "success":
+        health["data"]["model_server_client"] = client.get_status()
+    return health
+
+def get_metrics_text() -> str:
+    """The model's metrics, as recorded by the model server."""
+    try:
+        return _get_client().call("metrics")
+    except Exception as e:
+        logger.warning(f"Could not fetch metrics from the model server: {e}")
+        return ""
+
+def get_readiness() -> Dict[str, Any]:
+    try:
+        return _get_client().call("readiness")
+    except Exception as e:
+        return {"ready": False, "state": "model_server_unavailable", "error": str(e)}
+
+if __name__ == "__main__":
+    server = ModelServer()
+
+    def handle_shutdown(signum, frame):
+        logger.info("Shutdown signal received, stopping model server...")
+        server.stop()
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+    server.serve_forever()
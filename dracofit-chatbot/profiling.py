@@ -0,0 +1,96 @@
+"""
+Opt-in profiling hooks for the generation hot paths.
+
+model.py wraps each phase of a request in `phase(name)`: fitting the context, formatting
+the prompt template, tokenization, prefill, every decode step (forward pass, logits
+processing, sampling) and detokenization. Until a PhaseProfiler is installed with
+`enable()`, `phase` returns a shared no-op context manager, so serving pays one function
+call per phase. An installed profiler records the wall-clock time of each phase (nested
+phases are charged to their own name, and their parents' self time excludes them), and
+with `record_functions` each phase is also a named range in a torch.profiler trace.
+
+On CUDA, kernels run asynchronously: a forward pass's time shows up in the first phase
+that reads its result (sampling), unless CUDA_LAUNCH_BLOCKING=1 is set.
+"""
+import statistics
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from threading import Lock, local
+from typing import Any, Dict, List
+
+_NULL_PHASE = nullcontext()
+_profiler = None
+
+class PhaseProfiler:
+    """Wall-clock time per phase, plus folded stacks of self time for flamegraphs."""
+    def __init__(self, record_functions=False):
+        self.record_functions = record_functions # Also open a torch.profiler.record_function range per phase
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.self_seconds: Dict[str, float] = defaultdict(float) # "outer;inner" stack -> time not spent in nested phases
+        self._lock = Lock()
+        self._local = local() # Each thread (request threads, the scheduler) has its own phase stack
+
+    @contextmanager
+    def phase(self, name: str):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        frame = [name, 0.0] # Name and the time spent in nested phases
+        stack.append(frame)
+        record_function = None
+        if self.record_functions:
+            import torch
+            record_function = torch.profiler.record_function(name)
+            record_function.__enter__()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            if record_function is not None:
+                record_function.__exit__(None, None, None)
+            path = ";".join(name for name, _ in stack)
+            stack.pop()
+            if stack:
+                stack[-1][1] += duration
+            with self._lock:
+                self.durations[name].append(duration)
+                self.self_seconds[path] += duration - frame[1]
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Per phase: how often it ran and its total, mean, p50, p99 and max time in milliseconds."""
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self.durations.items()}
+        summary = {}
+        for name, values in sorted(durations.items()):
+            summary[name] = {
+                "count": len(values),
+                "total_ms": round(sum(values) * 1000, 3),
+                "mean_ms": round(statistics.mean(values) * 1000, 4),
+                "p50_ms": round(values[len(values) // 2] * 1000, 4),
+                "p99_ms": round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 4),
+                "max_ms": round(values[-1] * 1000, 4),
+            }
+        return summary
+
+    def folded_stacks(self) -> str:
+        """Self time per phase stack in the folded format of flamegraph.pl and speedscope, in microseconds."""
+        with self._lock:
+            stacks = sorted(self.self_seconds.items())
+        return "".join(f"{path} {max(int(seconds * 1e6), 0)}\n" for path, seconds in stacks)
+
+def enable(profiler: PhaseProfiler):
+    global _profiler
+    _profiler = profiler
+
+def disable():
+    global _profiler
+    _profiler = None
+
+def phase(name: str):
+    """Context manager timing `name` with the installed profiler; a no-op when profiling is off."""
+    profiler = _profiler
+    if profiler is None:
+        return _NULL_PHASE
+    return profiler.phase(name)
@@ -0,0 +1,106 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List
+
+import torch
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Gemma Prompt Template ---
+GENERATION_PROMPT = "<start_of_turn>model\n" # Signals the start of the model's turn
+MEMORY_ROLE = "memory" # Role of the summary that replaces a conversation's compacted older turns
+
+def format_system_turn(system_prompt: str) -> str:
+    """Formats the system prompt turn that starts every Gemma prompt."""
+    return f"<start_of_turn>system\n{system_prompt}<end_of_turn>\n\n"
+
+def format_turn(role: str, content: str) -> str:
+    """Formats a single user or model turn."""
+    return f"<start_of_turn>{role}\n{content}<end_of_turn>\n\n"
+
+def format_memory_turn(summary: str) -> str:
+    """Formats the summary of compacted turns, which stands in for them after the system turn."""
+    return f"<start_of_turn>system\nSummary of the conversation so far:\n{summary}<end_of_turn>\n\n"
+
+def format_history_turn(message: Dict[str, str]) -> str:
+    """Formats an earlier message of the conversation: a user or model turn, or the memory turn."""
+    if message["role"] == MEMORY_ROLE:
+        return format_memory_turn(message["content"])
+    return format_turn("user" if message["role"] == "user" else "model", message["content"])
+
+def conversation_turns(system_prompt: str, conversation: List[Dict[str, str]]) -> List[str]:
+    """Splits the prompt for a conversation into its templated turns, in order."""
+    if not conversation:
+        raise IndexError("Cannot format prompt from empty conversation.")
+    turns = [format_system_turn(system_prompt)]
+    for message in conversation[:-1]: # All but the latest message
+        turns.append(format_history_turn(message))
+    # The latest message is always a user turn
+    turns.append(format_turn("user", conversation[-1]["content"]))
+    turns.append(GENERATION_PROMPT)
+    return turns
+
+# --- Prompt Tokenizer ---
+class PromptTokenizer:
+    """
+    Tokenizes prompts one templated turn at a time, caching each turn's ids by content hash.
+
+    Every turn starts with the <start_of_turn> special token, which the tokenizer never
+    merges across, so concatenating the per-turn ids gives exactly the ids of the full
+    prompt. A new message therefore only costs tokenizing that message.
+    """
+    def __init__(self, tokenizer, cache_size=config.PROMPT_TOKEN_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        # Ids the tokenizer adds around a whole prompt, e.g. the BOS token
+        self._prefix_ids = torch.tensor(tokenizer("").input_ids, dtype=torch.long)
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def encode_turn(self, text: str):
+        """Returns the 1D token id tensor for one templated turn, without special tokens added."""
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        with self._lock:
+            ids = self._cache.get(key)
+            if ids is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return ids
+        ids = torch.tensor(self.tokenizer(text, add_special_tokens=False).input_ids, dtype=torch.long)
+        with self._lock:
+            self.cache_misses += 1
+            self._cache[key] = ids
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return ids
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encode_turn(text))
+
+    def encode(self, turns: List[str]):
+        """Returns the 1D token ids of the prompt made of `turns`, filling one preallocated tensor."""
+        segments = [self._prefix_ids] + [self.encode_turn(turn) for turn in turns]
+        input_ids = torch.empty(sum(len(segment) for segment in segments), dtype=torch.long)
+        position = 0
+        for segment in segments:
+            input_ids[position:position + len(segment)] = segment
+            position += len(segment)
+        return input_ids
+
+    @property
+    def special_token_count(self) -> int:
+        return len(self._prefix_ids)
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "cache_entries": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+import config
+from prompt_tokenizer import MEMORY_ROLE
+
+logger = logging.getLogger(__name__)
+
+# --- Optional Dependency ---
+try:
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
+
+# --- Helper Functions ---
+_WHITESPACE = re.compile(r"\s+")
+# A message with numbers or about the user themselves ("my knee", "I'm 40", "I weigh 80 kg") needs its own
+# answer: one for a similarly worded message with other details would be wrong, so it is only matched exactly
+_PERSONAL_CONTEXT = re.compile(r"\d|\b(?:my|mine|me|myself|i'm|im|i am|i've|i have|i weigh|i was)\b")
+
+def normalize_text(text: str) -> str:
+    """Case-, whitespace- and trailing-punctuation-insensitive form of a message."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _WHITESPACE.sub(" ", text).strip().rstrip("?!.").strip()
+
+def is_personalized(text: str) -> bool:
+    """True if the message carries the user's own details, so only an exact match may answer it."""
+    return bool(_PERSONAL_CONTEXT.search(normalize_text(text)))
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def generation_fingerprint(model_name: str, system_prompt: str) -> List[Any]:
+    """Everything besides the conversation that changes what the model would answer."""
+    return [
+        model_name, system_prompt, config.MAX_OUTPUT_LENGTH, config.DO_SAMPLE, config.TEMPERATURE,
+        config.TOP_P, config.TOP_K, config.REPETITION_PENALTY, config.NO_REPEAT_NGRAM_SIZE,
+    ]
+
+def load_embedder(model_name=config.RESPONSE_CACHE_EMBEDDING_MODEL) -> Optional[Callable[[str], torch.Tensor]]:
+    """Returns a text -> normalized embedding function, or None if sentence-transformers isn't installed."""
+    if not SENTENCE_TRANSFORMERS_AVAILABLE:
+        logger.warning("sentence-transformers not installed, semantic response cache disabled. Run: pip install sentence-transformers")
+        return None
+    embedding_model = SentenceTransformer(model_name, device="cpu")
+    return lambda text: embedding_model.encode(text, convert_to_tensor=True, normalize_embeddings=True)
+
+# --- Response Cache ---
+class _CacheEntry:
+    def __init__(self, chunks: List[str], semantic_bucket: Optional[str], embedding):
+        self.chunks = chunks # Streamed chunks, replayed as-is
+        self.created_time = time.time()
+        self.semantic_bucket = semantic_bucket
+        self.embedding = embedding
+
+class ResponseCache:
+    """
+    Caches full responses keyed on the normalized conversation and generation settings.
+
+    The exact layer matches the whole normalized history. The optional semantic layer
+    matches conversations with the same earlier history whose latest message embeds
+    within `similarity_threshold` (cosine) of a cached one, unless that message is
+    personalized. Conversations carrying a compacted summary of the user's earlier turns
+    are never cached. Entries expire after `ttl_seconds` (checked when they are looked
+    up) and the least recently used are evicted beyond `max_entries`.
+    """
+    def __init__(self, max_entries=config.RESPONSE_CACHE_MAX_ENTRIES, ttl_seconds=config.RESPONSE_CACHE_TTL_SECONDS,
+                 embedder: Optional[Callable[[str], torch.Tensor]] = None,
+                 similarity_threshold=config.RESPONSE_CACHE_SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._buckets: Dict[str, set] = {} # Semantic bucket -> exact keys of its entries that have embeddings
+        self._lock = Lock()
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bypasses = 0 # Lookups of conversations that are never cached
+
+    def _keys(self, fingerprint: List[Any], conversation: List[Dict[str, str]]):
+        history = [[message["role"], normalize_text(message["content"])] for message in conversation]
+        exact_key = _digest([fingerprint, history])
+        # Conversations that only differ in the wording of the latest message share a bucket
+        semantic_bucket = _digest([fingerprint, history[:-1]])
+        return exact_key, semantic_bucket
+
+    @staticmethod
+    def is_cacheable(conversation: List[Dict[str, str]]) -> bool:
+        """False for a conversation with a summary of the user's compacted turns, which is specific to that user."""
+        return not any(message["role"] == MEMORY_ROLE for message in conversation)
+
+    def get(self, fingerprint: List[Any], conversation: List[Dict[str, str]]) -> Optional[List[str]]:
+        if not self.is_cacheable(conversation):
+            with self._lock:
+                self.bypasses += 1
+            return None
+        exact_key, semantic_bucket = self._keys(fingerprint, conversation)
+        with self._lock:
+            entry = self._live_entry(exact_key)
+            if entry is not None:
+                self._entries.move_to_end(exact_key)
+                self.exact_hits += 1
+                return entry.chunks
+            if self.embedder is None or is_personalized(conversation[-1]["content"]):
+                self.misses += 1
+                return None
+            candidates = []
+            for key in list(self._buckets.get(semantic_bucket, ())):
+                entry = self._live_entry(key)
+                if entry is not None:
+                    candidates.append((key, entry))
+
+        if candidates:
+            embedding = self.embedder(conversation[-1]["content"])
+            similarities = torch.stack([entry.embedding for _, entry in candidates]) @ embedding
+            best = int(torch.argmax(similarities))
+            if float(similarities[best]) >= self.similarity_threshold:
+                key, entry = candidates[best]
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.semantic_hits += 1
+                logger.debug(f"Semantic response cache hit (similarity {float(similarities[best]):.3f}).")
+                return entry.chunks
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, fingerprint: List[Any], conversation: List[Dict[str, str]], chunks: List[str]):
+        if not self.is_cacheable(conversation):
+            return
+        exact_key, semantic_bucket = self._keys(fingerprint, conversation)
+        if self.embedder is None or is_personalized(conversation[-1]["content"]):
+            semantic_bucket, embedding = None, None # Exact matches only
+        else:
+            embedding = self.embedder(conversation[-1]["content"])
+        with self._lock:
+            self._remove(exact_key)
+            self._entries[exact_key] = _CacheEntry(list(chunks), semantic_bucket, embedding)
+            if semantic_bucket is not None:
+                self._buckets.setdefault(semantic_bucket, set()).add(exact_key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _live_entry(self, key: str) -> Optional[_CacheEntry]:
+        """The entry under `key`, dropping it if it has expired. Expiry is only checked on lookup, so
+        an expired entry that is never asked for again stays until it is evicted as least recently used."""
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry.created_time > self.ttl_seconds:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.semantic_bucket is not None:
+            bucket = self._buckets[entry.semantic_bucket]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[entry.semantic_bucket]
+
+    def get_status(self) -> Dict[str, Any]:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "semantic_enabled": self.embedder is not None,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else None,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "bypasses": self.bypasses,
+        }
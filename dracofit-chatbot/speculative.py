@@ -0,0 +1,146 @@
+import logging
+from typing import List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- Verification ---
+def verify_draft_token(scores, draft_token: int, draft_probs=None, do_sample=None) -> Tuple[int, bool]:
+    """
+    Speculative sampling acceptance test for one drafted token.
+
+    `scores` are the target model's processed logits for that position and `draft_probs`
+    the distribution the drafter sampled from (None for deterministic drafters such as
+    prompt lookup). Returns (token, accepted): the draft token if accepted, otherwise a
+    replacement sampled from the residual distribution, so emitted tokens follow the
+    target model's distribution exactly. Without sampling this reduces to an argmax match.
+    """
+    if do_sample is None:
+        do_sample = config.DO_SAMPLE
+    scores = scores.reshape(-1)
+    if not do_sample:
+        target_token = int(torch.argmax(scores))
+        return target_token, target_token == draft_token
+
+    probs = torch.nn.functional.softmax(scores, dim=-1)
+    if draft_probs is None:
+        # Deterministic draft: q is one-hot on the draft token
+        draft_probs = torch.zeros_like(probs)
+        draft_probs[draft_token] = 1.0
+    else:
+        draft_probs = draft_probs.reshape(-1).to(probs.device, probs.dtype)
+        if draft_probs.shape[0] != probs.shape[0]:
+            # Draft vocabularies may be padded to a different size
+            draft_probs = torch.nn.functional.pad(draft_probs[:probs.shape[0]], (0, max(probs.shape[0] - draft_probs.shape[0], 0)))
+
+    p, q = probs[draft_token], draft_probs[draft_token]
+    if q > 0 and torch.rand(()) < torch.clamp(p / q, max=1.0):
+        return draft_token, True
+
+    residual = torch.clamp(probs - draft_probs, min=0)
+    if residual.sum() <= 0:
+        residual = probs
+    return int(torch.multinomial(residual / residual.sum(), num_samples=1)), False
+
+# --- Drafters ---
+class PromptLookupDrafter:
+    """
+    Drafts tokens by finding the latest n-gram earlier in the context and copying what
+    followed it. Needs no extra model and works well when answers quote the question
+    or repeat earlier phrasing.
+    """
+    name = "prompt_lookup"
+
+    def __init__(self, max_ngram_size=config.PROMPT_LOOKUP_MAX_NGRAM_SIZE, min_ngram_size=1):
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+
+    def propose(self, request, num_tokens: int) -> Tuple[List[int], Optional[torch.Tensor]]:
+        token_ids = request.token_ids
+        for ngram_size in range(self.max_ngram_size, self.min_ngram_size - 1, -1):
+            if len(token_ids) <= ngram_size:
+                continue
+            ngram = token_ids[-ngram_size:]
+            # Most recent earlier occurrence first
+            for start in range(len(token_ids) - ngram_size - 1, -1, -1):
+                if token_ids[start:start + ngram_size] == ngram:
+                    draft = token_ids[start + ngram_size:start + ngram_size + num_tokens]
+                    if draft:
+                        return draft, None
+        return [], None
+
+class DraftModelDrafter:
+    """
+    Drafts tokens with a small model that shares the target model's tokenizer.
+
+    Each request keeps its own draft KV cache in request.draft_state; on the next
+    proposal the cache is cropped to the tokens the target model actually kept.
+    """
+    name = "draft_model"
+
+    def __init__(self, draft_model, logits_processor, device, do_sample=None):
+        self.model = draft_model
+        self.logits_processor = logits_processor
+        self.device = device
+        self.do_sample = config.DO_SAMPLE if do_sample is None else do_sample
+
+    def propose(self, request, num_tokens: int) -> Tuple[List[int], Optional[torch.Tensor]]:
+        if num_tokens <= 0:
+            return [], None
+        state = request.draft_state
+        cached_ids = state.get("ids", [])
+        past_key_values = state.get("past_key_values")
+
+        # Reuse the draft cache up to the first token the target model replaced
+        valid_length = 0
+        for cached, current in zip(cached_ids, request.token_ids):
+            if cached != current:
+                break
+            valid_length += 1
+        valid_length = min(valid_length, len(request.token_ids) - 1)
+        if past_key_values is not None and valid_length > 0:
+            past_key_values = tuple((key[:, :, :valid_length], value[:, :, :valid_length]) for key, value in past_key_values)
+        else:
+            past_key_values, valid_length = None, 0
+
+        token_ids = list(request.token_ids)
+        input_ids = torch.tensor([token_ids[valid_length:]], device=self.device)
+        draft_ids, draft_probs = [], []
+        for _ in range(num_tokens):
+            # An explicit DynamicCache (Gemma 2 would build a HybridCache), and a mask over the cached tokens too
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=torch.ones((1, valid_length + input_ids.shape[1]), dtype=torch.long, device=self.device),
+                past_key_values=DynamicCache.from_legacy_cache(past_key_values) if past_key_values else DynamicCache(),
+                use_cache=True,
+            )
+            valid_length += input_ids.shape[1]
+            past_key_values = outputs.past_key_values.to_legacy_cache()
+            scores = self.logits_processor(torch.tensor([token_ids], device=self.device), outputs.logits[:, -1, :].float())
+            probs = torch.nn.functional.softmax(scores, dim=-1)[0]
+            token = int(torch.multinomial(probs, num_samples=1)) if self.do_sample else int(torch.argmax(probs))
+            draft_ids.append(token)
+            draft_probs.append(probs)
+            token_ids.append(token)
+            input_ids = torch.tensor([[token]], device=self.device)
+
+        # The last draft token hasn't been fed through the draft model
+        state["ids"] = token_ids[:-1]
+        state["past_key_values"] = past_key_values
+        return draft_ids, torch.stack(draft_probs)
+
+def build_drafter(mode: Optional[str], logits_processor, device, draft_model=None):
+    """Returns the drafter for SPECULATIVE_DECODING, or None when speculative decoding is off."""
+    if not mode:
+        return None
+    if mode == "prompt_lookup":
+        return PromptLookupDrafter()
+    if mode == "draft_model":
+        if draft_model is None:
+            raise ValueError("SPECULATIVE_DECODING='draft_model' requires SPECULATIVE_DRAFT_MODEL_NAME.")
+        return DraftModelDrafter(draft_model, logits_processor, device)
+    raise ValueError(f"Unknown SPECULATIVE_DECODING mode: {mode}")
@@ -0,0 +1,131 @@
+"""
+Server-sent event framing for /chat, shared by api.py and asgi_api.py.
+
+The model streams one result per decoded text fragment, often a single short word. Writing
+each as its own frame costs a JSON encode, a write and a flush per token, plus the frame
+overhead on the wire. coalesce_stream merges consecutive chunks until STREAM_FLUSH_INTERVAL_MS
+has passed since the last frame or STREAM_FLUSH_MAX_BYTES are pending; the first chunk is
+always sent at once, so time to first token is unchanged.
+"""
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+import config
+
+# Encodes a str as a JSON string literal; non-ASCII text is kept as UTF-8 instead of \uXXXX escapes
+_encode_string = json.encoder.encode_basestring
+_encode_payload = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+_STREAMING_PREFIX = 'data: {"status":"streaming","chunk":'
+
+# --- Framing ---
+def format_chunk(chunk: str) -> str:
+    """The SSE frame of a streamed chunk, without building and encoding a dict."""
+    return _STREAMING_PREFIX + _encode_string(chunk) + "}\n\n"
+
+def format_event(result: Dict[str, Any]) -> str:
+    """The SSE frame of any stream result."""
+    if result.get("status") == "streaming":
+        return format_chunk(result["chunk"])
+    return "data: " + _encode_payload(result) + "\n\n"
+
+# --- Coalescing ---
+class _ChunkBuffer:
+    """Pending chunk text and the flush policy."""
+    __slots__ = ("parts", "nbytes", "last_flush_time", "flush_interval", "max_bytes")
+
+    def __init__(self, flush_interval_ms, max_bytes):
+        self.parts: List[str] = []
+        self.nbytes = 0
+        self.last_flush_time = None # None until the first chunk is sent
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_bytes = max_bytes
+
+    def add(self, chunk: str):
+        self.parts.append(chunk)
+        self.nbytes += len(chunk) # Characters, a cheap stand-in for bytes
+
+    def due(self, now: float) -> bool:
+        return (self.last_flush_time is None or self.nbytes >= self.max_bytes
+                or now - self.last_flush_time >= self.flush_interval)
+
+    def deadline(self) -> float:
+        return self.last_flush_time + self.flush_interval
+
+    def flush(self, now: float) -> Dict[str, str]:
+        chunk = self.parts[0] if len(self.parts) == 1 else "".join(self.parts)
+        self.parts.clear()
+        self.nbytes = 0
+        self.last_flush_time = now
+        return {"status": "streaming", "chunk": chunk}
+
+def coalesce_stream(stream: Iterator[Dict[str, Any]], flush_interval_ms=config.STREAM_FLUSH_INTERVAL_MS,
+                    max_bytes=config.STREAM_FLUSH_MAX_BYTES) -> Iterator[Dict[str, Any]]:
+    """
+    Merges the "streaming" results of `stream`; other results pass through after any pending text.
+    A chunk is only checked against the flush interval when the next one arrives, so text can
+    wait up to one token's decode time beyond the interval.
+    """
+    if not flush_interval_ms:
+        yield from stream
+        return
+    buffer = _ChunkBuffer(flush_interval_ms, max_bytes)
+    for result in stream:
+        if result.get("status") == "streaming":
+            buffer.add(result["chunk"])
+            now = time.monotonic()
+            if buffer.due(now):
+                yield buffer.flush(now)
+            continue
+        if buffer.parts:
+            yield buffer.flush(time.monotonic())
+        yield result
+    if buffer.parts:
+        yield buffer.flush(time.monotonic())
+
+async def coalesce_stream_async(stream: AsyncIterator[Dict[str, Any]], flush_interval_ms=config.STREAM_FLUSH_INTERVAL_MS,
+                                max_bytes=config.STREAM_FLUSH_MAX_BYTES) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Like coalesce_stream, but pending text is also flushed when the interval ends while
+    waiting for the next chunk, so no text is held longer than the interval.
+    """
+    if not flush_interval_ms:
+        async for result in stream:
+            yield result
+        return
+    buffer = _ChunkBuffer(flush_interval_ms, max_bytes)
+    iterator = stream.__aiter__()
+    next_result = None
+    try:
+        while True:
+            if next_result is None:
+                # A task, so that a timed-out wait doesn't cancel (and so close) the underlying stream
+                next_result = asyncio.ensure_future(iterator.__anext__())
+            if buffer.parts:
+                timeout = max(buffer.deadline() - time.monotonic(), 0)
+                done, _ = await asyncio.wait((next_result,), timeout=timeout)
+                if not done:
+                    yield buffer.flush(time.monotonic())
+                    continue
+            try:
+                result = await next_result
+            except StopAsyncIteration:
+                break
+            next_result = None
+            if result.get("status") == "streaming":
+                buffer.add(result["chunk"])
+                now = time.monotonic()
+                if buffer.due(now):
+                    yield buffer.flush(now)
+                continue
+            if buffer.parts:
+                yield buffer.flush(time.monotonic())
+            yield result
+        if buffer.parts:
+            yield buffer.flush(time.monotonic())
+    finally:
+        if next_result is not None and not next_result.done():
+            next_result.cancel()
+            # Let the cancellation finish, so the caller can close the underlying stream
+            await asyncio.gather(next_result, return_exceptions=True)
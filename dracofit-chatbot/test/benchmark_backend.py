@@ -0,0 +1,113 @@
+"""
+Measures decode throughput of the inference backend on this machine, e.g. CPU weight
+formats and the static vs concatenating KV cache.
+
+Usage: python test/benchmark_backend.py [--model NAME_OR_PATH] [--weight-dtypes int8 bfloat16 float32]
+                                        [--concurrency N] [--max-new-tokens N] [--threads N] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+PROMPTS = [
+    "How many sets should I do for hypertrophy?",
+    "What should I eat before a morning workout?",
+    "Give me a 3-day full body beginner routine.",
+    "How much protein do I need to build muscle?",
+    "Is it fine to train the same muscle two days in a row?",
+    "How long should I rest between heavy squat sets?",
+    "What are good alternatives to the barbell bench press?",
+    "How do I start running if I've never done it before?",
+]
+
+def _generate(model_instance, prompt: str, max_new_tokens: int, results: list):
+    start_time = time.perf_counter()
+    first_token_time = None
+    for result in model_instance.generate_response_stream([{"role": "user", "content": prompt}], max_length=max_new_tokens):
+        if result["status"] == "streaming" and first_token_time is None:
+            first_token_time = time.perf_counter()
+        elif result["status"] == "error":
+            raise RuntimeError(result["message"])
+    results.append((first_token_time or time.perf_counter()) - start_time)
+
+def run_configuration(model_name: str, weight_dtype: str, static_kv_cache: bool, concurrency: int, max_new_tokens: int):
+    from model import GemmaModel
+
+    config.CPU_WEIGHT_DTYPE = weight_dtype
+    model_instance = GemmaModel(model_name)
+    model_instance.backend.static_kv_cache = static_kv_cache
+    load_start = time.perf_counter()
+    if not model_instance.load_model():
+        raise RuntimeError(f"Model failed to load with {weight_dtype} weights")
+    load_seconds = time.perf_counter() - load_start
+    scheduler = model_instance.scheduler
+    tokens_before = scheduler.stats["tokens_generated"]
+    decode_time_before = scheduler.stats["decode_time_seconds"]
+
+    time_to_first_token = []
+    threads = [
+        threading.Thread(target=_generate, args=(model_instance, PROMPTS[i % len(PROMPTS)], max_new_tokens, time_to_first_token))
+        for i in range(concurrency)
+    ]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - start_time
+
+    tokens = scheduler.stats["tokens_generated"] - tokens_before
+    decode_seconds = scheduler.stats["decode_time_seconds"] - decode_time_before
+    row = {
+        "backend": model_instance.backend.name,
+        "weight_dtype": model_instance.backend.get_status().get("weight_dtype"),
+        "static_kv_cache": static_kv_cache,
+        "threads": model_instance.backend.get_status().get("num_threads"),
+        "load_seconds": round(load_seconds, 2),
+        "tokens": tokens,
+        "tokens_per_second": round(tokens / wall_seconds, 2),
+        "decode_tokens_per_second": round(tokens / decode_seconds, 2) if decode_seconds else None,
+        "mean_ttft_seconds": round(sum(time_to_first_token) / len(time_to_first_token), 3) if time_to_first_token else None,
+    }
+    model_instance.unload()
+    return row
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=config.DEFAULT_MODEL_NAME)
+    parser.add_argument("--weight-dtypes", nargs="+", default=["int8", "bfloat16", "float32"])
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests decoded together")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads (default: one per physical core)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    # Measure the backend itself: no cached answers, no warm-up, no draft model
+    config.RESPONSE_CACHE_ENABLED = False
+    config.WARMUP_ON_LOAD = False
+    config.SPECULATIVE_DECODING = None
+    config.CPU_NUM_THREADS = args.threads
+
+    rows = []
+    for weight_dtype in args.weight_dtypes:
+        for static_kv_cache in (True, False):
+            rows.append(run_configuration(args.model, weight_dtype, static_kv_cache, args.concurrency, args.max_new_tokens))
+            print(f"{weight_dtype} static_kv_cache={static_kv_cache}: {rows[-1]['tokens_per_second']} tokens/s", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"\n{'backend':<10}{'weights':<10}{'static kv':>10}{'threads':>8}{'tokens/s':>10}{'decode tok/s':>13}{'ttft s':>8}{'load s':>8}")
+    for row in rows:
+        print(f"{row['backend']:<10}{row['weight_dtype'] or '-':<10}{str(row['static_kv_cache']):>10}{row['threads'] or '-':>8}"
+              f"{row['tokens_per_second']:>10}{row['decode_tokens_per_second'] or '-':>13}{row['mean_ttft_seconds'] or '-':>8}{row['load_seconds']:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Load-tests the chat service and reports TTFT, inter-token latency, tokens/s and p50/p95/p99 latency.
+
+Drives either the in-process get_chatbot_response_stream or a running server's /chat SSE
+endpoint at a given concurrency, with a mix of short, medium and long prompts. --stub
+builds a tiny random Gemma 2 (see stub_model.py) so it runs offline on a CPU-only machine;
+--save-baseline/--baseline turn a run into a regression gate.
+
+Usage: python test/benchmark_chat.py [--target inprocess|http] [--url URL] [--stub | --model NAME_OR_PATH]
+                                     [--concurrency N] [--requests N] [--prompt-mix short=0.5,medium=0.3,long=0.2]
+                                     [--max-new-tokens N] [--save-baseline FILE] [--baseline FILE --max-regression 0.2] [--json]
+
+To benchmark a server on the stub model:
+    python test/stub_model.py /tmp/stub-gemma
+    DRACOBOT_MODEL=/tmp/stub-gemma python api.py
+    python test/benchmark_chat.py --target http --tokenizer /tmp/stub-gemma
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from stub_model import DEFAULT_ARCHITECTURE, REFERENCE_CONFIGS
+
+QUESTIONS = [
+    "How many sets should I do for hypertrophy?",
+    "What should I eat before a morning workout?",
+    "Give me a 3-day full body beginner routine.",
+    "How much protein do I need to build muscle?",
+    "Is it fine to train the same muscle two days in a row?",
+    "How long should I rest between heavy squat sets?",
+]
+CONTEXT = (
+    "I'm 29, I train four times a week and I've been lifting for about a year. My squat is stuck at 100 kg, "
+    "I sleep around six hours and I usually skip breakfast. I have a desk job and a slightly sore lower back. "
+)
+# Number of CONTEXT paragraphs sent along with the question for each prompt length
+PROMPT_LENGTHS = {"short": 0, "medium": 2, "long": 12}
+
+# Metrics compared against a baseline, and whether higher values are better
+GATED_METRICS = {
+    "ttft_p50_seconds": False,
+    "latency_p95_seconds": False,
+    "inter_token_latency_p50_seconds": False,
+    "tokens_per_second": True,
+}
+
+# --- Helper Functions ---
+def _parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in PROMPT_LENGTHS:
+            raise ValueError(f"Unknown prompt length {name!r}, expected one of {sorted(PROMPT_LENGTHS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def build_workload(num_requests: int, mix: Dict[str, float], seed=0) -> List[Dict[str, str]]:
+    """Picks the prompt length and question of every request up front, so runs are comparable."""
+    rng = random.Random(seed)
+    lengths = rng.choices(list(mix), weights=list(mix.values()), k=num_requests)
+    return [
+        {"length": length, "message": CONTEXT * PROMPT_LENGTHS[length] + rng.choice(QUESTIONS)}
+        for length in lengths
+    ]
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Linearly interpolated percentile, e.g. fraction=0.95 for p95."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+# --- Targets ---
+def stream_inprocess(message: str):
+    from model import get_chatbot_response_stream
+    yield from get_chatbot_response_stream([{"role": "user", "content": message}])
+
+def stream_http(url: str, message: str):
+    """Yields the results of one /chat SSE stream. No cookies are kept, so every request is a new conversation."""
+    body = json.dumps({"message": message}).encode("utf-8")
+    http_request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(http_request, timeout=600) as response:
+        for line in response:
+            line = line.decode("utf-8").strip()
+            if line.startswith("data: "):
+                yield json.loads(line[len("data: "):])
+
+# --- Benchmark ---
+def run_request(stream, item: Dict[str, str], tokenizer) -> Dict[str, Any]:
+    start_time = time.perf_counter()
+    first_chunk_time = last_chunk_time = None
+    chunks = []
+    status = None
+    for result in stream(item["message"]):
+        status = result["status"]
+        if status == "streaming":
+            last_chunk_time = time.perf_counter()
+            first_chunk_time = first_chunk_time or last_chunk_time
+            chunks.append(result["chunk"])
+        elif status in ("success", "error", "aborted"):
+            break
+    end_time = time.perf_counter()
+    text = "".join(chunks)
+    # Streamed chunks are decoded words, not tokens; re-tokenize to count tokens when possible
+    tokens = len(tokenizer(text, add_special_tokens=False).input_ids) if tokenizer else len(chunks)
+    return {
+        "length": item["length"],
+        "status": status,
+        "tokens": tokens,
+        "latency_seconds": end_time - start_time,
+        "ttft_seconds": first_chunk_time - start_time if first_chunk_time else None,
+        "inter_token_latency_seconds": (last_chunk_time - first_chunk_time) / (tokens - 1) if first_chunk_time and tokens > 1 else None,
+    }
+
+def run_benchmark(stream, workload: List[Dict[str, str]], concurrency: int, tokenizer=None) -> Dict[str, Any]:
+    """Runs the workload as a closed loop: `concurrency` clients, each sending its next request when the last one ends."""
+    pending = list(reversed(workload))
+    results = []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                item = pending.pop()
+            try:
+                result = run_request(stream, item, tokenizer)
+            except Exception as e:
+                result = {"length": item["length"], "status": "error", "error": str(e)}
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(results, time.perf_counter() - start_time, concurrency)
+
+def summarize(results: List[Dict[str, Any]], wall_seconds: float, concurrency: int) -> Dict[str, Any]:
+    succeeded = [result for result in results if result["status"] == "success"]
+    latencies = [result["latency_seconds"] for result in succeeded]
+    ttfts = [result["ttft_seconds"] for result in succeeded if result["ttft_seconds"] is not None]
+    inter_token_latencies = [result["inter_token_latency_seconds"] for result in succeeded if result["inter_token_latency_seconds"] is not None]
+    tokens = sum(result["tokens"] for result in succeeded)
+
+    def rounded(value):
+        return round(value, 4) if value is not None else None
+
+    summary = {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "failed": len(results) - len(succeeded),
+        "wall_seconds": round(wall_seconds, 3),
+        "tokens": tokens,
+        "tokens_per_second": round(tokens / wall_seconds, 2) if wall_seconds else None,
+        "requests_per_second": round(len(succeeded) / wall_seconds, 3) if wall_seconds else None,
+    }
+    for name, values in (("latency", latencies), ("ttft", ttfts), ("inter_token_latency", inter_token_latencies)):
+        for label, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+            summary[f"{name}_{label}_seconds"] = rounded(percentile(values, fraction))
+    summary["by_length"] = {
+        length: {
+            "requests": sum(1 for result in succeeded if result["length"] == length),
+            "ttft_p50_seconds": rounded(percentile([result["ttft_seconds"] for result in succeeded
+                                                    if result["length"] == length and result["ttft_seconds"] is not None], 0.5)),
+            "latency_p50_seconds": rounded(percentile([result["latency_seconds"] for result in succeeded if result["length"] == length], 0.5)),
+        }
+        for length in sorted({result["length"] for result in results})
+    }
+    errors = [result.get("error") for result in results if result.get("error")]
+    if errors:
+        summary["first_error"] = errors[0]
+    return summary
+
+def check_regressions(summary: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Returns a message for every gated metric that got worse than the baseline by more than `max_regression`."""
+    regressions = []
+    for metric, higher_is_better in GATED_METRICS.items():
+        current, reference = summary.get(metric), baseline.get(metric)
+        if not current or not reference:
+            continue
+        change = (reference - current) / reference if higher_is_better else (current - reference) / reference
+        if change > max_regression:
+            regressions.append(f"{metric}: {current} vs baseline {reference} ({change:+.0%} worse)")
+    if summary["failed"] > baseline.get("failed", 0):
+        regressions.append(f"failed requests: {summary['failed']} vs baseline {baseline.get('failed', 0)}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--url", default="http://localhost:5000/chat", help="/chat endpoint for --target http")
+    parser.add_argument("--model", default=config.DEFAULT_MODEL_NAME, help="Model for --target inprocess")
+    parser.add_argument("--stub", action="store_true", help="Use a tiny random model with the default model's architecture (see stub_model.py)")
+    parser.add_argument("--stub-layers", type=int, default=2)
+    parser.add_argument("--stub-architecture", choices=sorted(REFERENCE_CONFIGS), default=DEFAULT_ARCHITECTURE)
+    parser.add_argument("--tokenizer", default=None, help="Tokenizer used to count tokens (default: the in-process model's)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--prompt-mix", default="short=0.5,medium=0.3,long=0.2")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--response-cache", action="store_true", help="Keep the response cache on (in-process only)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", default=None, help="Write the summary to this file")
+    parser.add_argument("--baseline", default=None, help="Fail (exit 1) if a gated metric regressed against this file")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed fractional regression per metric")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    workload = build_workload(args.requests, _parse_mix(args.prompt_mix), args.seed)
+    tokenizer = None
+    stub_dir = None
+    if args.target == "inprocess":
+        if args.stub:
+            from stub_model import build_stub_model
+            stub_dir = tempfile.mkdtemp(prefix="stub-gemma-")
+            args.model = build_stub_model(stub_dir, num_hidden_layers=args.stub_layers, architecture=args.stub_architecture)
+        # Set before model.py is imported, which binds them as default arguments
+        config.DEFAULT_MODEL_NAME = args.model
+        config.MAX_OUTPUT_LENGTH = args.max_new_tokens
+        config.RESPONSE_CACHE_ENABLED = args.response_cache
+        config.QUANTIZED_CHECKPOINT_CACHE = not args.stub
+        from model import GemmaModelSingleton
+        model_instance = GemmaModelSingleton.get_instance(args.model)
+        if not model_instance.load_model():
+            raise SystemExit("Model failed to load")
+        tokenizer = model_instance.tokenizer
+        stream = stream_inprocess
+    else:
+        stream = lambda message: stream_http(args.url, message)
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    summary = run_benchmark(stream, workload, args.concurrency, tokenizer)
+    summary["target"] = args.target
+    summary["model"] = "stub" if args.stub else (args.model if args.target == "inprocess" else args.url)
+    if stub_dir:
+        import shutil
+        shutil.rmtree(stub_dir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(summary, baseline_file, indent=2)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"\n{summary['requests']} requests ({summary['failed']} failed) at concurrency {summary['concurrency']} "
+              f"in {summary['wall_seconds']}s: {summary['tokens_per_second']} tokens/s, {summary['requests_per_second']} requests/s")
+        print(f"{'metric':<22}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}")
+        for name in ("ttft", "inter_token_latency", "latency"):
+            print(f"{name:<22}" + "".join(f"{summary[f'{name}_{label}_seconds'] or '-':>10}" for label in ("p50", "p95", "p99")))
+        for length, row in summary["by_length"].items():
+            print(f"  {length:<8}{row['requests']:>4} requests, ttft p50 {row['ttft_p50_seconds']}s, latency p50 {row['latency_p50_seconds']}s")
+        if summary.get("first_error"):
+            print(f"First error: {summary['first_error']}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = check_regressions(summary, json.load(baseline_file), args.max_regression)
+        if regressions:
+            print("Regressions against the baseline:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+        print("No regressions against the baseline.", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
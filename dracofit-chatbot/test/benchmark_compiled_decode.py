@@ -0,0 +1,118 @@
+"""
+Measures decode step latency (the inter-token latency every running sequence sees) of the
+scheduler's batch cache against compiled decoding, with its fixed shapes run eagerly
+("slots") and torch.compile'd ("compiled"), and what the compile costs at load time.
+
+Usage: python test/benchmark_compiled_decode.py [--stub | --model NAME_OR_PATH] [--modes eager slots compiled]
+                                                [--concurrency N] [--max-new-tokens N] [--context-paragraphs N] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from benchmark_chat import CONTEXT, QUESTIONS, percentile
+
+def _generate(model_instance, message: str, max_new_tokens: int):
+    for result in model_instance.generate_response_stream([{"role": "user", "content": message}], max_length=max_new_tokens):
+        if result["status"] == "error":
+            raise RuntimeError(result["message"])
+
+def run_mode(model_name: str, mode: str, concurrency: int, max_new_tokens: int, context_paragraphs: int):
+    from model import GemmaModel
+
+    config.COMPILED_DECODE = mode != "eager"
+    config.COMPILED_DECODE_TORCH_COMPILE = mode == "compiled"
+    model_instance = GemmaModel(model_name)
+    load_start = time.perf_counter()
+    if not model_instance.load_model():
+        raise RuntimeError(f"Model failed to load in {mode} mode")
+    load_seconds = time.perf_counter() - load_start
+
+    # Every decode step produces one token for each running sequence, so its duration is their inter-token latency
+    scheduler = model_instance.scheduler
+    step_seconds = []
+    decode_step = scheduler._decode_step
+
+    def timed_decode_step():
+        start_time = time.perf_counter()
+        decode_step()
+        step_seconds.append(time.perf_counter() - start_time)
+    scheduler._decode_step = timed_decode_step
+
+    messages = [CONTEXT * context_paragraphs + QUESTIONS[i % len(QUESTIONS)] for i in range(concurrency)]
+    _generate(model_instance, messages[0], 4) # First request on the loaded model
+    step_seconds.clear()
+    threads = [threading.Thread(target=_generate, args=(model_instance, message, max_new_tokens)) for message in messages]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - start_time
+
+    status = scheduler.get_status()
+    compiled_status = status.get("compiled_decode") or {}
+    milliseconds = [seconds * 1000 for seconds in step_seconds]
+    row = {
+        "mode": mode,
+        "load_seconds": round(load_seconds, 2),
+        "warmup_seconds": compiled_status.get("warmup_seconds"),
+        "decode_steps": len(milliseconds),
+        "step_ms_mean": round(statistics.mean(milliseconds), 2),
+        "step_ms_p50": round(percentile(milliseconds, 0.5), 2),
+        "step_ms_p99": round(percentile(milliseconds, 0.99), 2),
+        "step_ms_stdev": round(statistics.pstdev(milliseconds), 2),
+        "tokens_per_second": round(status["tokens_generated"] / wall_seconds, 1),
+        "kv_cache_mb": compiled_status.get("kv_cache_mb"),
+    }
+    model_instance.unload()
+    return row
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=config.DEFAULT_MODEL_NAME)
+    parser.add_argument("--stub", action="store_true", help="Use a tiny random model with the default model's architecture (see stub_model.py)")
+    parser.add_argument("--modes", nargs="+", choices=["eager", "slots", "compiled"], default=["eager", "slots", "compiled"])
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests decoded together")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--context-paragraphs", type=int, default=4, help="Paragraphs of context sent with each question")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    # Measure decoding itself: no cached answers, no warm-up generation, no draft model
+    config.RESPONSE_CACHE_ENABLED = False
+    config.WARMUP_ON_LOAD = False
+    config.SPECULATIVE_DECODING = None
+    stub_dir = None
+    if args.stub:
+        from stub_model import build_stub_model
+        stub_dir = tempfile.mkdtemp(prefix="stub-gemma-")
+        args.model = build_stub_model(stub_dir)
+        config.QUANTIZED_CHECKPOINT_CACHE = False
+
+    rows = []
+    for mode in args.modes:
+        rows.append(run_mode(args.model, mode, args.concurrency, args.max_new_tokens, args.context_paragraphs))
+        print(f"{mode}: {rows[-1]['step_ms_mean']} ms/step", file=sys.stderr)
+    if stub_dir:
+        import shutil
+        shutil.rmtree(stub_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"\n{'mode':<10}{'steps':>7}{'mean ms':>9}{'p50 ms':>8}{'p99 ms':>8}{'stdev':>7}{'tokens/s':>10}{'load s':>8}{'warm-up s':>10}")
+    for row in rows:
+        print(f"{row['mode']:<10}{row['decode_steps']:>7}{row['step_ms_mean']:>9}{row['step_ms_p50']:>8}{row['step_ms_p99']:>8}"
+              f"{row['step_ms_stdev']:>7}{row['tokens_per_second']:>10}{row['load_seconds']:>8}{row['warmup_seconds'] or '-':>10}")
+
+if __name__ == "__main__":
+    main()
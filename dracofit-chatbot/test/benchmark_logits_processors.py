@@ -0,0 +1,90 @@
+"""
+Measures the per-step cost of the repetition penalty and no-repeat-ngram processors as the
+sequence grows: transformers' processors (given the whole sequence every step) against
+logits_processors.BatchLogitsProcessor (updated with one token per step).
+
+Usage: python test/benchmark_logits_processors.py [--lengths 128 512 2048 8192] [--batch-sizes 1 8]
+                                                  [--vocab-size N] [--steps N] [--device cpu|cuda] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+from transformers import LogitsProcessorList, NoRepeatNGramLogitsProcessor, RepetitionPenaltyLogitsProcessor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from logits_processors import BatchLogitsProcessor
+
+def _synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+def time_transformers(token_ids: torch.Tensor, logits: torch.Tensor, steps: int) -> float:
+    """Seconds per step; the sequences grow by one token per step, like in the decode loop."""
+    processors = LogitsProcessorList([
+        RepetitionPenaltyLogitsProcessor(penalty=config.REPETITION_PENALTY),
+        NoRepeatNGramLogitsProcessor(config.NO_REPEAT_NGRAM_SIZE),
+    ])
+    next_tokens = torch.randint(0, logits.shape[-1], (token_ids.shape[0], steps), device=token_ids.device)
+    processors(token_ids, logits) # Warm-up
+    _synchronize(str(logits.device))
+    start_time = time.perf_counter()
+    for step in range(steps):
+        processors(token_ids, logits)
+        token_ids = torch.cat([token_ids, next_tokens[:, step:step + 1]], dim=1)
+    _synchronize(str(logits.device))
+    return (time.perf_counter() - start_time) / steps
+
+def time_batch(token_ids: torch.Tensor, logits: torch.Tensor, steps: int) -> float:
+    processor = BatchLogitsProcessor(config.REPETITION_PENALTY, config.NO_REPEAT_NGRAM_SIZE)
+    states = [processor.new_state(row) for row in token_ids.tolist()]
+    processor(states, logits) # Copies the prompt ids to the device, done once at admission
+    next_tokens = torch.randint(0, logits.shape[-1], (token_ids.shape[0], steps)).tolist()
+    _synchronize(str(logits.device))
+    start_time = time.perf_counter()
+    for step in range(steps):
+        processor(states, logits)
+        for state, row in zip(states, next_tokens):
+            state.append(row[step])
+    _synchronize(str(logits.device))
+    return (time.perf_counter() - start_time) / steps
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[128, 512, 2048, 8192], help="Sequence lengths (prompt + generated)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--vocab-size", type=int, default=256000, help="Gemma's vocabulary size")
+    parser.add_argument("--steps", type=int, default=20, help="Decode steps timed per configuration")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    results = []
+    for batch_size in args.batch_sizes:
+        logits = torch.randn(batch_size, args.vocab_size, device=args.device)
+        for length in args.lengths:
+            token_ids = torch.randint(0, args.vocab_size, (batch_size, length), device=args.device)
+            before = time_transformers(token_ids, logits, args.steps)
+            after = time_batch(token_ids, logits, args.steps)
+            results.append({
+                "batch_size": batch_size,
+                "sequence_length": length,
+                "transformers_ms_per_step": round(before * 1000, 3),
+                "batch_ms_per_step": round(after * 1000, 3),
+                "speedup": round(before / after, 1),
+            })
+            if not args.json:
+                row = results[-1]
+                print(f"batch {batch_size:>3}  length {length:>6}: transformers {row['transformers_ms_per_step']:>9} ms/step, "
+                      f"batch processor {row['batch_ms_per_step']:>7} ms/step ({row['speedup']}x)")
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares model (re)load times: cold load (quantizing from the original weights),
+cached load (pre-quantized checkpoint), mmap standby and host-RAM standby reactivation.
+
+Usage: python test/benchmark_reload.py [--model NAME_OR_PATH] [--runs N] [--warmup] [--json]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+SCENARIOS = ["cold", "cached", "mmap_standby", "host_standby"]
+
+def _timed_load(model_instance):
+    from model import load_progress
+    start_time = time.perf_counter()
+    if not model_instance.load_model():
+        raise RuntimeError(f"Model failed to load: {load_progress.error}")
+    seconds = time.perf_counter() - start_time
+    phases = {name: phase["seconds"] for name, phase in load_progress.get_status()["phases"].items()}
+    return seconds, model_instance.load_source, phases
+
+def run_benchmark(model_name: str, runs: int):
+    from model import GemmaModel
+
+    model_instance = GemmaModel(model_name)
+    results = {scenario: [] for scenario in SCENARIOS}
+    for run in range(runs):
+        # Cold: nothing cached, the original weights are quantized and the copy is saved
+        shutil.rmtree(model_instance.checkpoint_cache.path_for(model_name, _settings()), ignore_errors=True)
+        results["cold"].append(_timed_load(model_instance))
+
+        model_instance.unload(standby_tier=None)
+        results["cached"].append(_timed_load(model_instance))
+
+        model_instance.unload(standby_tier="mmap")
+        results["mmap_standby"].append(_timed_load(model_instance))
+
+        model_instance.unload(standby_tier="host")
+        results["host_standby"].append(_timed_load(model_instance))
+        model_instance.unload(standby_tier=None)
+        print(f"Run {run + 1}/{runs}: " + ", ".join(f"{scenario} {results[scenario][-1][0]:.2f}s" for scenario in SCENARIOS))
+    return results
+
+def _settings():
+    from checkpoint_cache import quantization_settings
+    return quantization_settings()
+
+def summarize(results):
+    summary = {}
+    for scenario, samples in results.items():
+        seconds = [sample[0] for sample in samples]
+        summary[scenario] = {
+            "median_seconds": round(statistics.median(seconds), 3),
+            "min_seconds": round(min(seconds), 3),
+            "load_source": samples[-1][1],
+            "phases": samples[-1][2],
+        }
+    cold = summary["cold"]["median_seconds"]
+    for scenario in summary:
+        summary[scenario]["speedup_vs_cold"] = round(cold / summary[scenario]["median_seconds"], 2) if summary[scenario]["median_seconds"] else None
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=config.DEFAULT_MODEL_NAME)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--warmup", action="store_true", help="Include the warm-up generation in every load")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    config.WARMUP_ON_LOAD = args.warmup
+    config.QUANTIZED_CHECKPOINT_CACHE = True
+    # Keep benchmark checkpoints away from the service's cache
+    config.QUANTIZED_CHECKPOINT_DIR = tempfile.mkdtemp(prefix="reload-benchmark-")
+    try:
+        summary = summarize(run_benchmark(args.model, args.runs))
+    finally:
+        shutil.rmtree(config.QUANTIZED_CHECKPOINT_DIR, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"\n{'scenario':<14}{'median s':>10}{'min s':>9}{'speedup':>9}  source")
+    for scenario, row in summary.items():
+        print(f"{scenario:<14}{row['median_seconds']:>10.3f}{row['min_seconds']:>9.3f}{row['speedup_vs_cold']:>8.2f}x  {row['load_source']}")
+
+if __name__ == "__main__":
+    main()
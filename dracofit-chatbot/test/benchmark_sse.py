@@ -0,0 +1,178 @@
+"""
+Measures the cost of the /chat SSE output stage: bytes on the wire, socket writes (one send
+syscall each) and CPU time per generated token, with one frame per decoded fragment
+("before") and with coalescing (see sse.py, "after").
+
+A token stream is recorded once, either synthetic (fixed inter-token interval) or from the
+model, and replayed with its original timing through both stages into a local socket.
+
+Usage: python test/benchmark_sse.py [--source synthetic|model] [--stub | --model NAME_OR_PATH]
+                                    [--tokens N] [--token-interval-ms MS] [--requests N]
+                                    [--flush-interval-ms MS] [--flush-max-bytes N] [--json]
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from sse import coalesce_stream, format_event
+
+WORDS = ("Aim for 10-20 hard sets per muscle each week, spread over two or three sessions. Rest 2-3 minutes "
+         "between heavy compound sets and keep 1-2 reps in reserve. Eat enough protein — about 1.6 g/kg — "
+         "and sleep 7-9 hours 💪").split(" ")
+QUESTIONS = [
+    "How many sets should I do for hypertrophy?",
+    "What should I eat before a morning workout?",
+    "How long should I rest between heavy squat sets?",
+]
+
+# Trace: (seconds since the request started, chunk) per streamed fragment, plus the token count
+Trace = Tuple[List[Tuple[float, str]], int]
+
+# --- Traces ---
+def synthetic_traces(num_requests: int, num_tokens: int, token_interval_ms: float, seed=0) -> List[Trace]:
+    """One word-piece per token, evenly spaced, like a steady decode loop."""
+    rng = random.Random(seed)
+    traces = []
+    for _ in range(num_requests):
+        events = [((i + 1) * token_interval_ms / 1000, (" " if i else "") + rng.choice(WORDS)) for i in range(num_tokens)]
+        traces.append((events, num_tokens))
+    return traces
+
+def model_traces(model_name: str, num_requests: int, num_tokens: int) -> List[Trace]:
+    """Records the fragments the model actually streams, one request at a time."""
+    config.DEFAULT_MODEL_NAME = model_name
+    config.MAX_OUTPUT_LENGTH = num_tokens
+    config.RESPONSE_CACHE_ENABLED = False
+    from model import GemmaModelSingleton
+    model_instance = GemmaModelSingleton.get_instance(model_name)
+    if not model_instance.load_model():
+        raise SystemExit("Model failed to load")
+    traces = []
+    for i in range(num_requests):
+        start_time = time.perf_counter()
+        events = []
+        conversation = [{"role": "user", "content": QUESTIONS[i % len(QUESTIONS)]}]
+        for result in model_instance.generate_response_stream(conversation, max_length=num_tokens):
+            if result["status"] == "streaming":
+                events.append((time.perf_counter() - start_time, result["chunk"]))
+            elif result["status"] == "error":
+                raise RuntimeError(result["message"])
+        text = "".join(chunk for _, chunk in events)
+        traces.append((events, len(model_instance.tokenizer(text, add_special_tokens=False).input_ids)))
+    return traces
+
+def replay(events: List[Tuple[float, str]]):
+    """Yields the trace's results at their recorded times, then the final success result."""
+    start_time = time.perf_counter()
+    for offset, chunk in events:
+        delay = offset - (time.perf_counter() - start_time)
+        if delay > 0:
+            time.sleep(delay)
+        yield {"status": "streaming", "chunk": chunk}
+    yield {"status": "success", "full_response": "".join(chunk for _, chunk in events)}
+
+# --- Output Stages ---
+def frames_before(events):
+    """The output stage before coalescing: one json.dumps'd frame per fragment."""
+    for result in replay(events):
+        yield f"data: {json.dumps(result)}\n\n"
+
+def frames_after(events, flush_interval_ms, max_bytes):
+    for result in coalesce_stream(replay(events), flush_interval_ms, max_bytes):
+        yield format_event(result)
+
+def measure(frames) -> Dict[str, Any]:
+    """Sends every frame like the server would (encode, then one send each) and counts the cost."""
+    writer, reader = socket.socketpair()
+    received = [0]
+
+    def drain():
+        while True:
+            data = reader.recv(65536)
+            if not data:
+                break
+            received[0] += len(data)
+
+    drain_thread = threading.Thread(target=drain, daemon=True)
+    drain_thread.start()
+    sends = 0
+    cpu_start = time.thread_time() # User and system time of this thread only, sleeps excluded
+    wall_start = time.perf_counter()
+    for frame in frames:
+        writer.sendall(frame.encode("utf-8"))
+        sends += 1
+    cpu_seconds = time.thread_time() - cpu_start
+    wall_seconds = time.perf_counter() - wall_start
+    writer.close()
+    drain_thread.join()
+    reader.close()
+    return {"bytes": received[0], "sends": sends, "cpu_seconds": cpu_seconds, "wall_seconds": wall_seconds}
+
+def run_stage(name: str, make_frames, traces: List[Trace]) -> Dict[str, Any]:
+    totals = {"bytes": 0, "sends": 0, "cpu_seconds": 0.0, "wall_seconds": 0.0}
+    tokens = 0
+    for events, num_tokens in traces:
+        for key, value in measure(make_frames(events)).items():
+            totals[key] += value
+        tokens += num_tokens
+    return {
+        "stage": name,
+        "tokens": tokens,
+        "frames": totals["sends"],
+        "bytes_per_token": round(totals["bytes"] / tokens, 2),
+        "sends_per_token": round(totals["sends"] / tokens, 3),
+        "cpu_us_per_token": round(totals["cpu_seconds"] / tokens * 1e6, 2),
+        "wall_seconds": round(totals["wall_seconds"], 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--source", choices=["synthetic", "model"], default="synthetic")
+    parser.add_argument("--model", default=config.DEFAULT_MODEL_NAME, help="Model for --source model")
+    parser.add_argument("--stub", action="store_true", help="With --source model, use a tiny random Gemma (see stub_model.py)")
+    parser.add_argument("--tokens", type=int, default=200, help="Tokens per request")
+    parser.add_argument("--token-interval-ms", type=float, default=20, help="Inter-token interval of the synthetic source")
+    parser.add_argument("--requests", type=int, default=3)
+    parser.add_argument("--flush-interval-ms", type=float, default=config.STREAM_FLUSH_INTERVAL_MS)
+    parser.add_argument("--flush-max-bytes", type=int, default=config.STREAM_FLUSH_MAX_BYTES)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    if args.source == "model":
+        stub_dir = None
+        if args.stub:
+            from stub_model import build_stub_model
+            stub_dir = tempfile.mkdtemp(prefix="stub-gemma-")
+            args.model = build_stub_model(stub_dir)
+        traces = model_traces(args.model, args.requests, args.tokens)
+        if stub_dir:
+            import shutil
+            shutil.rmtree(stub_dir, ignore_errors=True)
+    else:
+        traces = synthetic_traces(args.requests, args.tokens, args.token_interval_ms)
+
+    results = [
+        run_stage("before", frames_before, traces),
+        run_stage("after", lambda events: frames_after(events, args.flush_interval_ms, args.flush_max_bytes), traces),
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{sum(len(events) for events, _ in traces)} fragments, {results[0]['tokens']} tokens; "
+          f"flush interval {args.flush_interval_ms} ms, max {args.flush_max_bytes} bytes")
+    print(f"{'stage':<8}{'frames':>8}{'bytes/token':>13}{'sends/token':>13}{'cpu us/token':>14}")
+    for row in results:
+        print(f"{row['stage']:<8}{row['frames']:>8}{row['bytes_per_token']:>13}{row['sends_per_token']:>13}{row['cpu_us_per_token']:>14}")
+
+if __name__ == "__main__":
+    main()
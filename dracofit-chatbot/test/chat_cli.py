@@ -1,16 +1,19 @@
 import json
 import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import necessary components from model.py and config.py
 try:
     import config
+    import model
     from model import (
-        get_chatbot_response,
-        get_health_check,
+        get_chatbot_response_stream,
+        fit_conversation_to_context,
         GemmaModelSingleton,
         logger, # Use the logger configured in model.py
-        TRANSFORMERS_AVAILABLE, # Check if dependencies are met
-        torch # Needed for device check in health status fallback
     )
 except ImportError as e:
     print(f"Error importing required modules: {e}")
@@ -24,7 +27,8 @@ def run_chat():
     print("--- Interactive Chatbot Test ---")
     print("Type 'quit' or 'exit' to end the chat.")
 
-    if not TRANSFORMERS_AVAILABLE:
+    # torch/transformers are imported on first use, not when model.py is imported
+    if not model._load_dependencies():
         print("\nError: Required libraries (transformers, torch, bitsandbytes) not found or login failed.")
         print("Please install them: pip install transformers torch bitsandbytes huggingface_hub")
         return
@@ -52,25 +56,24 @@ def run_chat():
             # Add user message to history
             conversation_history.append({"role": "user", "content": user_input})
 
-            # Get response from the model
-            print("Bot: Thinking...")
-            result = get_chatbot_response(conversation_history) # Pass the history
-
-            if result['status'] == 'success':
-                bot_response = result['response']
-                print(f"Bot: {bot_response}")
-                # Add bot response to history
-                conversation_history.append({"role": "model", "content": bot_response})
-            else:
-                print(f"Error: {result['message']}")
-                # Optionally remove the last user message if the bot failed
-                conversation_history.pop()
-
-            # Optional: Limit history length
-            if len(conversation_history) > 8:
-                 conversation_history = conversation_history[-8:]
-                 logger.debug("Trimmed conversation history to last 8 messages.")
-
+            # Stream the response from the model
+            print("Bot: ", end="", flush=True)
+            for result in get_chatbot_response_stream(conversation_history):
+                if result['status'] == 'streaming':
+                    print(result['chunk'], end="", flush=True)
+                elif result['status'] == 'success':
+                    print()
+                    # Add bot response to history
+                    conversation_history.append({"role": "model", "content": result['full_response']})
+                    break
+                else:
+                    print(f"\nError: {result['message']}")
+                    # Optionally remove the last user message if the bot failed
+                    conversation_history.pop()
+                    break
+
+            # Drop the oldest turns once the history no longer fits the context window
+            conversation_history = fit_conversation_to_context(conversation_history)
 
     except RuntimeError as e:
         print(f"\nRuntime Error: {e}")
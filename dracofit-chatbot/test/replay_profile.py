@@ -0,0 +1,194 @@
+"""
+Replays recorded conversation transcripts through GemmaModel in-process and profiles the
+prefill/decode hot paths, for a repeatable breakdown that can be compared across commits.
+
+Each user turn of a transcript is sent with the turns before it (the recorded model replies,
+or the generated ones where the transcript has none) under one conversation id, so the
+conversation KV cache is exercised as in a live chat. Turns run one at a time and greedily,
+so the phases of one request aren't mixed with others'. Writes to --output-dir:
+
+    summary.json    per-phase timings (see profiling.py) and throughput; diff it or pass it as --baseline
+    phases.folded   self time per phase stack, for flamegraph.pl or speedscope
+    trace.json      with --torch-profiler: the torch.profiler trace, phases included as named
+                    ranges (chrome://tracing, Perfetto or speedscope)
+
+A transcript file has one JSON object per line, with "messages" ({"role", "content"} dicts)
+and optionally an "id"; without one, a few built-in fitness chats are replayed.
+
+Usage: python test/replay_profile.py [--stub | --model NAME_OR_PATH] [--transcripts FILE.jsonl] [--repeat N]
+                                     [--max-new-tokens N] [--sample] [--torch-profiler]
+                                     [--output-dir DIR] [--baseline summary.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import profiling
+from batch_generate import parse_conversation
+from benchmark_chat import CONTEXT, QUESTIONS
+
+def builtin_transcripts() -> List[Dict[str, Any]]:
+    """Short and long multi-turn chats built from the chat benchmark's questions."""
+    return [
+        {"id": "short", "messages": [{"role": "user", "content": question} for question in QUESTIONS[:3]]},
+        {"id": "long-context", "messages": [
+            {"role": "user", "content": CONTEXT * 6 + QUESTIONS[3]},
+            {"role": "model", "content": "Around 1.6 to 2.2 grams of protein per kilogram of body weight a day."},
+            {"role": "user", "content": QUESTIONS[4]},
+            {"role": "user", "content": QUESTIONS[5]},
+        ]},
+    ]
+
+def load_transcripts(path: str) -> List[Dict[str, Any]]:
+    transcripts = []
+    with open(path, encoding="utf-8") as transcript_file:
+        for number, line in enumerate(transcript_file):
+            if line.strip():
+                item = json.loads(line)
+                transcripts.append({"id": str(item.get("id", number)), "messages": parse_conversation(item)})
+    return transcripts
+
+def replay(model_instance, transcripts: List[Dict[str, Any]], max_new_tokens: int, repeat: int) -> int:
+    """Sends every user turn of every transcript, `repeat` times over. Returns the turns sent."""
+    turns = 0
+    for round_number in range(repeat):
+        for transcript in transcripts:
+            # A fresh conversation id per round, so each round starts with only the system prompt cached
+            conversation_id = f"replay-{round_number}-{transcript['id']}"
+            history = []
+            messages = transcript["messages"]
+            for position, message in enumerate(messages):
+                if message["role"] != "user":
+                    continue
+                history.append(message)
+                reply = None
+                for result in model_instance.generate_response_stream(list(history), max_length=max_new_tokens, conversation_id=conversation_id):
+                    if result["status"] == "success":
+                        reply = result["full_response"]
+                    elif result["status"] != "streaming":
+                        raise RuntimeError(f"Turn {position} of transcript {transcript['id']} failed: {result.get('message')}")
+                turns += 1
+                recorded = messages[position + 1] if position + 1 < len(messages) and messages[position + 1]["role"] != "user" else None
+                history.append(recorded or {"role": "model", "content": reply})
+    return turns
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def print_comparison(summary: Dict[str, Any], baseline: Dict[str, Any]):
+    print(f"\nvs. baseline {baseline.get('git_commit', '?')}:", file=sys.stderr)
+    print(f"{'phase':<20}{'count':>8}{'mean ms':>10}{'base ms':>10}{'change':>9}", file=sys.stderr)
+    for name, timing in summary["phases"].items():
+        base = baseline.get("phases", {}).get(name)
+        if not base or not base["mean_ms"]:
+            print(f"{name:<20}{timing['count']:>8}{timing['mean_ms']:>10.3f}{'-':>10}{'new':>9}", file=sys.stderr)
+            continue
+        change = timing["mean_ms"] / base["mean_ms"] - 1
+        print(f"{name:<20}{timing['count']:>8}{timing['mean_ms']:>10.3f}{base['mean_ms']:>10.3f}{change:>+9.1%}", file=sys.stderr)
+    if baseline.get("tokens_per_second"):
+        change = summary["tokens_per_second"] / baseline["tokens_per_second"] - 1
+        print(f"tokens/s: {summary['tokens_per_second']} (baseline {baseline['tokens_per_second']}, {change:+.1%})", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=config.DEFAULT_MODEL_NAME)
+    parser.add_argument("--stub", action="store_true", help="Use a tiny random model with the default model's architecture (see stub_model.py)")
+    parser.add_argument("--transcripts", help="JSONL file of transcripts; defaults to a few built-in chats")
+    parser.add_argument("--repeat", type=int, default=3, help="Times the transcripts are replayed")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--sample", action="store_true", help="Sample as configured instead of decoding greedily")
+    parser.add_argument("--torch-profiler", action="store_true", help="Also record a torch.profiler trace (slower)")
+    parser.add_argument("--output-dir", default="profile", help="Where summary.json, phases.folded and trace.json are written")
+    parser.add_argument("--baseline", help="A previous summary.json to compare the phase timings with")
+    args = parser.parse_args()
+
+    from model import GemmaModel
+
+    # Greedy decoding makes the generated lengths, and so the work profiled, the same on every run
+    config.DO_SAMPLE = config.DO_SAMPLE and args.sample
+    config.SPECULATIVE_DECODING = None
+    stub_dir = None
+    if args.stub:
+        from stub_model import build_stub_model
+        stub_dir = tempfile.mkdtemp(prefix="stub-gemma-")
+        args.model = build_stub_model(stub_dir)
+        config.QUANTIZED_CHECKPOINT_CACHE = False
+    transcripts = load_transcripts(args.transcripts) if args.transcripts else builtin_transcripts()
+
+    model_instance = GemmaModel(args.model)
+    load_start = time.perf_counter()
+    if not model_instance.load_model():
+        raise RuntimeError("Model failed to load")
+    load_seconds = time.perf_counter() - load_start
+    scheduler = model_instance.scheduler
+    stats_before = dict(scheduler.stats)
+
+    # Loading (and its warm-up generation) isn't profiled
+    profiler = profiling.PhaseProfiler(record_functions=args.torch_profiler)
+    profiling.enable(profiler)
+    torch_profiler = None
+    if args.torch_profiler:
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        torch_profiler = torch.profiler.profile(activities=activities)
+        torch_profiler.start()
+    start_time = time.perf_counter()
+    try:
+        turns = replay(model_instance, transcripts, args.max_new_tokens, args.repeat)
+    finally:
+        wall_seconds = time.perf_counter() - start_time
+        if torch_profiler:
+            torch_profiler.stop()
+        profiling.disable()
+
+    stats = {name: scheduler.stats[name] - stats_before[name] for name in ("tokens_generated", "prefill_tokens", "prefill_tokens_reused", "decode_steps")}
+    summary = {
+        "git_commit": _git_commit(),
+        "model": os.path.basename(args.model.rstrip("/")) if args.stub else args.model,
+        "backend": model_instance.backend.name if model_instance.backend else None,
+        "device": model_instance.device,
+        "settings": {"max_new_tokens": args.max_new_tokens, "repeat": args.repeat, "sample": config.DO_SAMPLE, "transcripts": len(transcripts)},
+        "load_seconds": round(load_seconds, 2),
+        "turns": turns,
+        "wall_seconds": round(wall_seconds, 3),
+        "tokens_per_second": round(stats["tokens_generated"] / wall_seconds, 2),
+        **stats,
+        "phases": profiler.summary(),
+    }
+    model_instance.unload()
+    if stub_dir:
+        import shutil
+        shutil.rmtree(stub_dir, ignore_errors=True)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as summary_file:
+        json.dump(summary, summary_file, indent=2, sort_keys=True)
+    with open(os.path.join(args.output_dir, "phases.folded"), "w") as folded_file:
+        folded_file.write(profiler.folded_stacks())
+    if torch_profiler:
+        torch_profiler.export_chrome_trace(os.path.join(args.output_dir, "trace.json"))
+
+    print(f"{'phase':<20}{'count':>8}{'total ms':>11}{'mean ms':>10}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, timing in summary["phases"].items():
+        print(f"{name:<20}{timing['count']:>8}{timing['total_ms']:>11.1f}{timing['mean_ms']:>10.3f}{timing['p50_ms']:>9.3f}{timing['p99_ms']:>9.3f}")
+    print(f"\n{turns} turns, {stats['tokens_generated']} tokens in {wall_seconds:.2f}s ({summary['tokens_per_second']} tokens/s). Written to {args.output_dir}/")
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            print_comparison(summary, json.load(baseline_file))
+
+if __name__ == "__main__":
+    main()
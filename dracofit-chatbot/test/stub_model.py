@@ -0,0 +1,100 @@
+"""
+Builds a tiny, randomly initialized Gemma (and a matching tokenizer) that runs offline on a
+CPU-only machine, for benchmarks and profiling that shouldn't need the real weights.
+
+The architecture comes from a reference config in models/, scaled down: by default Gemma 2,
+the architecture of config.DEFAULT_MODEL_NAME, or Gemma with --architecture gemma. Its output
+is gibberish, but it exercises the same code paths (prompt template, prefix and session KV
+caches, batching, streaming) as the real model.
+
+Usage: python test/stub_model.py OUTPUT_DIR [--architecture gemma2|gemma] [--layers N] [--hidden-size N]
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+REFERENCE_CONFIGS = {
+    "gemma2": os.path.join(MODELS_DIR, "gemma-2-2b-it", "config.json"), # google/gemma-2-2b-it, the default model
+    "gemma": os.path.join(MODELS_DIR, "gemma-2b", "config.json"),
+}
+DEFAULT_ARCHITECTURE = "gemma2"
+SPECIAL_TOKENS = ["<pad>", "<eos>", "<bos>", "<unk>", "<start_of_turn>", "<end_of_turn>"]
+TOKENIZER_VOCAB_SIZE = 2048
+
+# Text the stub tokenizer is trained on, so prompts don't fall apart into single bytes
+TRAINING_TEXT = [
+    config.SYSTEM_PROMPT,
+    "How many sets should I do for hypertrophy? Aim for 10 to 20 hard sets per muscle group each week.",
+    "What should I eat before a morning workout? A small meal with carbohydrates and some protein.",
+    "Give me a 3-day full body beginner routine with squats, presses, rows and deadlifts.",
+    "How much protein do I need to build muscle? Around 1.6 to 2.2 grams per kilogram of body weight.",
+    "Rest two to three minutes between heavy sets, and sleep well to recover.",
+]
+
+def build_tokenizer():
+    """A byte-level BPE tokenizer with Gemma's special tokens, trained on a few fitness sentences."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=TOKENIZER_VOCAB_SIZE, special_tokens=SPECIAL_TOKENS,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(TRAINING_TEXT, trainer=trainer)
+    # Like Gemma's tokenizer, prepend <bos> to every encoded text
+    tokenizer.post_processor = processors.TemplateProcessing(single="<bos> $A", special_tokens=[("<bos>", tokenizer.token_to_id("<bos>"))])
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<bos>", eos_token="<eos>", pad_token="<pad>", unk_token="<unk>",
+        additional_special_tokens=["<start_of_turn>", "<end_of_turn>"],
+    )
+
+def build_stub_model(output_dir: str, num_hidden_layers=2, hidden_size=256, seed=0, architecture=DEFAULT_ARCHITECTURE) -> str:
+    """Saves a tiny random model with the reference architecture (see REFERENCE_CONFIGS) to `output_dir` and returns the path."""
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    with open(REFERENCE_CONFIGS[architecture]) as config_file:
+        reference = json.load(config_file)
+    scale = hidden_size / reference["hidden_size"]
+    head_dim = max(8, int(reference["head_dim"] * scale))
+    tokenizer = build_tokenizer()
+
+    if "query_pre_attn_scalar" in reference:
+        # Gemma 2 scales attention scores by this instead of head_dim; the reference sets it to head_dim
+        reference["query_pre_attn_scalar"] = head_dim
+    model_config = AutoConfig.for_model(**{
+        **{key: value for key, value in reference.items() if key not in ("architectures", "transformers_version", "torch_dtype")},
+        "hidden_size": hidden_size,
+        "intermediate_size": max(1, int(reference["intermediate_size"] * scale)),
+        "head_dim": head_dim,
+        "num_hidden_layers": num_hidden_layers,
+        "vocab_size": len(tokenizer),
+        "bos_token_id": tokenizer.bos_token_id,
+        "eos_token_id": [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")],
+        "pad_token_id": tokenizer.pad_token_id,
+    })
+    torch.manual_seed(seed)
+    model = AutoModelForCausalLM.from_config(model_config, torch_dtype=torch.float32)
+    model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    return output_dir
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("output_dir")
+    parser.add_argument("--architecture", choices=sorted(REFERENCE_CONFIGS), default=DEFAULT_ARCHITECTURE)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    args = parser.parse_args()
+    print(build_stub_model(args.output_dir, args.layers, args.hidden_size, architecture=args.architecture))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from admission import AdmissionController, AdmissionRejected, create_batch_admission
+
+def _controller(**overrides):
+    settings = dict(max_in_flight=1, max_in_flight_per_user=1, max_queue=4, max_queued_per_user=2, queue_timeout=5)
+    settings.update(overrides)
+    return AdmissionController(**settings)
+
+def _acquire_in_thread(controller, user_key, admitted):
+    thread = threading.Thread(target=lambda: admitted.append((user_key, controller.acquire(user_key))), daemon=True)
+    thread.start()
+    return thread
+
+def _wait_for_queue(controller, depth):
+    deadline = time.monotonic() + 5
+    while controller.get_status()["queued"] != depth:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def test_waiting_users_are_served_round_robin():
+    controller = _controller()
+    running = controller.acquire("heavy")
+    admitted = []
+    threads = []
+    # The heavy user queues two requests before the light user's one
+    for user_key in ("heavy", "heavy", "light"):
+        threads.append(_acquire_in_thread(controller, user_key, admitted))
+        _wait_for_queue(controller, len(threads))
+
+    running.release()
+    for _ in range(3):
+        deadline = time.monotonic() + 5
+        while not admitted or admitted[-1][1].released:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+        admitted[-1][1].release()
+    for thread in threads:
+        thread.join()
+
+    assert [user_key for user_key, _ in admitted] == ["heavy", "light", "heavy"]
+    assert controller.get_status()["in_flight"] == 0
+
+def test_rejections_carry_status_and_retry_after():
+    controller = _controller(max_queue=2)
+    running = controller.acquire("a")
+    admitted = []
+    threads = [_acquire_in_thread(controller, "b", admitted) for _ in range(2)]
+    try:
+        _wait_for_queue(controller, 2)
+
+        with pytest.raises(AdmissionRejected) as user_rejection:
+            controller.acquire("b")
+        assert user_rejection.value.status_code == 429
+        with pytest.raises(AdmissionRejected) as queue_rejection:
+            controller.acquire("c")
+        assert queue_rejection.value.status_code == 503
+        assert int(queue_rejection.value.retry_after_header) >= 1
+    finally:
+        # Let the queued requests through one at a time, so none is left to time out in a later test
+        running.release()
+        for thread in threads:
+            deadline = time.monotonic() + 5
+            while not admitted or admitted[-1][1].released:
+                assert time.monotonic() < deadline
+                time.sleep(0.001)
+            admitted[-1][1].release()
+        for thread in threads:
+            thread.join()
+    assert controller.get_status()["in_flight"] == 0
+
+def test_queue_timeout_and_per_user_limit():
+    controller = _controller(max_in_flight=2, queue_timeout=0.05)
+    controller.acquire("a")
+    # A free slot, but "a" is at its per-user limit
+    with pytest.raises(AdmissionRejected) as rejection:
+        controller.acquire("a")
+    assert rejection.value.reason == "queue_timeout"
+    assert controller.acquire("b").user_key == "b"
+    assert controller.get_status()["queued"] == 0
+
+def test_async_acquire_waits_for_a_release():
+    controller = _controller()
+
+    async def scenario():
+        first = await controller.acquire_async("a")
+        waiting = asyncio.ensure_future(controller.acquire_async("b"))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        first.release()
+        second = await asyncio.wait_for(waiting, 1)
+        second.release()
+        second.release() # Releasing twice is fine
+        return second
+
+    assert asyncio.run(scenario()).user_key == "b"
+    assert controller.get_status()["in_flight"] == 0
+
+def test_batch_jobs_have_their_own_slots_and_hold_times():
+    chat, batch = _controller(max_in_flight=1, initial_hold_seconds=10), create_batch_admission()
+    job = batch.acquire("a")
+    # The running job doesn't take the /chat slot, but the next job waits for it
+    message = chat.acquire("a")
+    admitted = []
+    thread = _acquire_in_thread(batch, "b", admitted)
+    _wait_for_queue(batch, 1)
+    job.release()
+    thread.join()
+    admitted[0][1].release()
+
+    # Only the jobs' own hold times moved
+    assert chat.get_status()["average_generation_seconds"] == 10
+    assert batch.get_status()["average_generation_seconds"] < config.BATCH_ADMISSION_INITIAL_HOLD_SECONDS
+    message.release()
+    assert batch.get_status()["in_flight"] == chat.get_status()["in_flight"] == 0
@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from batch_generate import parse_batch_request
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+import model as model_module
+
+PREFIX = [2, 5, 6, 7]
+
+def _tiny_model(model_type="gemma"):
+    model_config = transformers.AutoConfig.for_model(
+        model_type, vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=1, head_dim=16, max_position_embeddings=512,
+        eos_token_id=1, pad_token_id=0,
+    )
+    torch.manual_seed(0)
+    return transformers.AutoModelForCausalLM.from_config(model_config).eval()
+
+class _Tokenizer:
+    eos_token_id = None
+
+class _Streamer:
+    def put(self, value):
+        pass
+
+    def end(self):
+        pass
+
+def _generate(model, prompts, max_new_tokens, batched):
+    scheduler = model_module.GenerationScheduler(model, _Tokenizer(), "cpu")
+    # The system prompt prefix every prompt starts with, as the scheduler caches it
+    scheduler.prefix_cache.input_ids = torch.tensor(PREFIX)
+    scheduler.prefix_cache.past_key_values = model(torch.tensor([PREFIX]), past_key_values=transformers.DynamicCache()).past_key_values.to_legacy_cache()
+    requests = [model_module.GenerationRequest(torch.tensor(prompt), _Streamer(), max_new_tokens=tokens) for prompt, tokens in zip(prompts, max_new_tokens)]
+    if batched:
+        scheduler.submit_batch(requests)
+    else:
+        for request in requests:
+            scheduler.submit(request)
+    for request in requests:
+        assert request.done.wait(60)
+        assert request.error is None
+    stats = dict(scheduler.stats)
+    scheduler.stop()
+    return [request.generated_ids for request in requests], stats
+
+def test_length_buckets_group_similar_lengths():
+    buckets = model_module._length_buckets([30, 5, 12, 6, 29, 11, 4], 3)
+    assert buckets == [[6, 1, 3], [5, 2, 4], [0]]
+
+def test_batch_request_validation():
+    batch = parse_batch_request({"conversations": ["Hi", [{"role": "user", "content": "Squats?"}], {"message": "Rows?"}], "max_new_tokens": 10**6})
+    assert batch["conversations"][0] == [{"role": "user", "content": "Hi"}]
+    assert batch["conversations"][2] == [{"role": "user", "content": "Rows?"}]
+    assert batch["max_new_tokens"] == config.MAX_OUTPUT_LENGTH
+    for data in (None, {"conversations": []}, {"conversations": [[]]}, {"conversations": [[{"role": "user"}]]}, {"conversations": ["Hi"], "max_new_tokens": 0}):
+        with pytest.raises(ValueError):
+            parse_batch_request(data)
+
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+@pytest.mark.parametrize("with_prefix", [True, False])
+def test_batched_prefill_generates_the_same_tokens(monkeypatch, with_prefix, model_type):
+    assert model_module._load_dependencies()
+    monkeypatch.setattr(config, "DO_SAMPLE", False)
+    model = _tiny_model(model_type)
+    prompts = [[40, 41, 42, 43, 44, 45], [90, 91], [10, 11, 12], [60]]
+    prompts = [PREFIX + prompt if with_prefix else [3] + prompt for prompt in prompts]
+    # The second request finishes with its first token, so it never joins the batch
+    max_new_tokens = [12, 1, 12, 8]
+
+    with torch.inference_mode():
+        one_by_one, _ = _generate(model, prompts, max_new_tokens, batched=False)
+        batched, stats = _generate(model, prompts, max_new_tokens, batched=True)
+
+    assert batched == one_by_one
+    assert stats["prefill_tokens_reused"] == (len(PREFIX) * len(prompts) if with_prefix else 0)
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from compaction import ConversationCompactor
+from context_manager import ContextWindowManager
+from conversation_store import InMemoryConversationStore, StoredMessage, messages_from_dicts, messages_to_dicts, save_user_turn
+
+CONVERSATION = [
+    {"role": "user", "content": "I want to squat 140 kg by summer."},
+    {"role": "model", "content": "Squat twice a week and add 2.5 kg a week."},
+    {"role": "user", "content": "My left knee hurts on deep squats."},
+    {"role": "model", "content": "Box squats to parallel until it settles."},
+    {"role": "user", "content": "What about deadlifts?"},
+    {"role": "model", "content": "Keep them, with a slower eccentric."},
+]
+MEMORY = {"role": "memory", "content": "Goal: 140 kg squat by summer. Left knee pain on deep squats."}
+
+class _FakeModel:
+    """Stands in for GemmaModel in compact_conversation: one token per word, a fixed summary."""
+    is_loaded = True
+    special_token_count = 0
+    system_prompt = "You are DracoBot."
+
+    def __init__(self, max_context_tokens=4096):
+        self.prompts = []
+        self.prompt_tokenizer = self
+        self.context_manager = ContextWindowManager(self, max_context_tokens, reserved_new_tokens=20)
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+    def generate_response_stream(self, conversation, max_length, background=False):
+        assert background # Summaries never hold up live requests
+        self.prompts.append(conversation[0]["content"])
+        yield {"status": "streaming", "chunk": "Goal: 140 kg squat."}
+        yield {"status": "success", "full_response": " Goal: 140 kg squat. "}
+
+def test_compactor_replaces_the_older_turns():
+    store = InMemoryConversationStore()
+    store.save("a", messages_from_dicts(CONVERSATION))
+    invalidated = []
+    compactor = ConversationCompactor(store, lambda conversation: {"compacted_messages": 4, "memory": MEMORY}, invalidated.append)
+
+    assert compactor.compact("a")
+    assert messages_to_dicts(store.load("a")) == [MEMORY] + CONVERSATION[4:]
+    assert invalidated == ["a"]
+    assert compactor.get_status()["messages_compacted"] == 4
+
+def test_compactor_skips_a_history_that_changed_meanwhile():
+    store = InMemoryConversationStore()
+    store.save("a", messages_from_dicts(CONVERSATION))
+
+    def compact_fn(conversation):
+        # A /chat request saves its own view of the history while the summary is generated
+        store.save("a", messages_from_dicts(CONVERSATION[2:]) + [StoredMessage("user", "Thanks!")])
+        return {"compacted_messages": 4, "memory": MEMORY}
+    compactor = ConversationCompactor(store, compact_fn)
+
+    assert not compactor.compact("a")
+    assert messages_to_dicts(store.load("a"))[-1] == {"role": "user", "content": "Thanks!"}
+    assert compactor.get_status()["conflicts"] == 1
+
+def test_a_new_turn_does_not_undo_a_compaction_that_finished_meanwhile():
+    store = InMemoryConversationStore()
+    store.save("a", messages_from_dicts(CONVERSATION))
+    compactor = ConversationCompactor(store, lambda conversation: {"compacted_messages": 4, "memory": MEMORY})
+    fitted = []
+
+    def fit_fn(history):
+        if not fitted:
+            # The /chat request loaded the history, then the compaction finished before it saved
+            assert compactor.compact("a")
+        fitted.append(history)
+        return history
+
+    history = save_user_turn(store, "a", "Thanks!", fit_fn)
+    assert len(fitted) == 2
+    assert history == [MEMORY] + CONVERSATION[4:] + [{"role": "user", "content": "Thanks!"}]
+    assert messages_to_dicts(store.load("a")) == history
+
+def test_scheduled_conversations_are_compacted_in_the_background():
+    store = InMemoryConversationStore()
+    store.save("a", messages_from_dicts(CONVERSATION))
+    compactor = ConversationCompactor(store, lambda conversation: None if conversation[0] == MEMORY else {"compacted_messages": 4, "memory": MEMORY})
+    compactor.schedule("a")
+    compactor.schedule("unknown")
+
+    deadline = time.monotonic() + 10
+    while compactor.get_status()["compactions"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store.load("a")[0].to_dict() == MEMORY
+    assert compactor.get_status()["failures"] == 0
+
+def test_model_summarizes_all_but_the_recent_turns(monkeypatch):
+    pytest.importorskip("torch")
+    import model as model_module
+    assert model_module._load_dependencies()
+    monkeypatch.setattr(config, "COMPACTION_KEEP_RECENT_MESSAGES", 3)
+    fake_model = _FakeModel()
+
+    monkeypatch.setattr(config, "COMPACTION_THRESHOLD_TOKENS", 1000)
+    assert model_module.GemmaModel.compact_conversation(fake_model, CONVERSATION) is None
+
+    monkeypatch.setattr(config, "COMPACTION_THRESHOLD_TOKENS", 10)
+    result = model_module.GemmaModel.compact_conversation(fake_model, [MEMORY] + CONVERSATION)
+    # Keeping 3 messages would start them with a model reply, so the last 4 are kept
+    assert result == {"compacted_messages": 3, "memory": {"role": "memory", "content": "Goal: 140 kg squat."}}
+    assert fake_model.prompts[0].startswith(config.COMPACTION_PROMPT)
+    assert f"Earlier summary: {MEMORY['content']}" in fake_model.prompts[0]
+    assert "DracoBot: Squat twice a week" in fake_model.prompts[0]
+    assert "What about deadlifts?" not in fake_model.prompts[0]
+
+def test_model_summarizes_fewer_turns_when_the_transcript_is_over_the_budget(monkeypatch):
+    pytest.importorskip("torch")
+    import model as model_module
+    assert model_module._load_dependencies()
+    monkeypatch.setattr(config, "COMPACTION_THRESHOLD_TOKENS", 10)
+    monkeypatch.setattr(config, "COMPACTION_KEEP_RECENT_MESSAGES", 2)
+
+    # 75 tokens for the request: the 5 older messages need 89, the first 3 need 73
+    fake_model = _FakeModel(max_context_tokens=100)
+    result = model_module.GemmaModel.compact_conversation(fake_model, [MEMORY] + CONVERSATION)
+    assert result["compacted_messages"] == 3
+    # Not truncated: the instruction is still there, with whole turns after it
+    assert fake_model.prompts[0].startswith(config.COMPACTION_PROMPT)
+    assert fake_model.prompts[0].endswith("DracoBot: Squat twice a week and add 2.5 kg a week.")
+
+    # Not even the first turns fit: nothing is summarized
+    fake_model = _FakeModel(max_context_tokens=85)
+    assert model_module.GemmaModel.compact_conversation(fake_model, [MEMORY] + CONVERSATION) is None
+    assert fake_model.prompts == []
@@ -0,0 +1,131 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import model as model_module
+from compiled_decode import CompiledDecoder
+from kv_cache import PrefixKVCache
+
+def _tiny_model(model_type="gemma"):
+    model_config = transformers.AutoConfig.for_model(
+        model_type, vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=1, head_dim=16, max_position_embeddings=512,
+        eos_token_id=1, pad_token_id=0,
+    )
+    torch.manual_seed(0)
+    return transformers.AutoModelForCausalLM.from_config(model_config).eval()
+
+class _Tokenizer:
+    eos_token_id = None
+
+    def __init__(self, token_ids=None):
+        self.token_ids = token_ids
+
+    def __call__(self, text, return_tensors=None):
+        return transformers.BatchEncoding({"input_ids": torch.tensor([self.token_ids])})
+
+def _prefill(model, token_ids):
+    """The legacy cache of a prompt, built by the scheduler's own prefix cache code."""
+    prefix_cache = PrefixKVCache()
+    prefix_cache.build(model, _Tokenizer(token_ids), "", "cpu")
+    return prefix_cache.past_key_values
+
+class _Streamer:
+    def put(self, value):
+        pass
+
+    def end(self):
+        pass
+
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+def test_decode_matches_the_eager_model(model_type):
+    model = _tiny_model(model_type)
+    decoder = CompiledDecoder(model, "cpu", max_length=64, num_slots=4, length_buckets=(16, 32), batch_buckets=(1, 2), compile=False)
+    prompts = [torch.randint(2, 128, (length,)) for length in (5, 20, 9)]
+    with torch.inference_mode():
+        slots = [decoder.insert(_prefill(model, prompt.tolist())) for prompt in prompts]
+        sequences = [prompt.tolist() for prompt in prompts]
+        for step in range(20):
+            tokens = [(step * 7 + row) % 128 for row in range(len(prompts))]
+            logits = decoder.decode(slots, tokens, [len(sequence) for sequence in sequences])
+            for row, sequence in enumerate(sequences):
+                sequence.append(tokens[row])
+                expected = model(torch.tensor([sequence])).logits[0, -1]
+                torch.testing.assert_close(logits[row], expected, rtol=1e-4, atol=1e-4)
+            if step == 10:
+                # A freed slot is reused by a new sequence while the others keep decoding
+                decoder.release(slots[1])
+                slots[1] = decoder.insert(_prefill(model, [3, 4, 5]))
+                sequences[1] = [3, 4, 5]
+
+        exported = decoder.export(slots[0], len(sequences[0]) - 1)
+        expected_cache = _prefill(model, sequences[0][:-1])
+        torch.testing.assert_close(exported[1][0], expected_cache[1][0], rtol=1e-4, atol=1e-4)
+
+def _generate(model, prompts, compiled_decoder=None):
+    scheduler = model_module.GenerationScheduler(model, _Tokenizer(), "cpu", compiled_decoder=compiled_decoder)
+    requests = [model_module.GenerationRequest(torch.tensor(prompt), _Streamer(), max_new_tokens=12) for prompt in prompts]
+    if compiled_decoder:
+        scheduler.start()
+    for request in requests:
+        scheduler.submit(request)
+    for request in requests:
+        assert request.done.wait(60)
+        assert request.error is None
+    scheduler.stop()
+    return [request.generated_ids for request in requests]
+
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+def test_scheduler_generates_the_same_tokens(monkeypatch, model_type):
+    assert model_module._load_dependencies()
+    monkeypatch.setattr(config, "DO_SAMPLE", False)
+    model = _tiny_model(model_type)
+    prompts = [[2, 10, 11, 12], [2, 40, 41, 42, 43, 44, 45], [2, 7], [2, 90, 91]]
+
+    eager = _generate(model, prompts)
+    decoder = CompiledDecoder(model, "cpu", max_length=16, num_slots=config.MAX_BATCH_SIZE, length_buckets=(8,), compile=False)
+    compiled = _generate(model, prompts, decoder)
+
+    # The 7 token prompt only has room for 16 - 7 new tokens in the compiled cache
+    assert [len(token_ids) for token_ids in compiled] == [min(len(eager_ids), 16 - len(prompt)) for eager_ids, prompt in zip(eager, prompts)]
+    assert compiled == [eager_ids[:len(compiled_ids)] for eager_ids, compiled_ids in zip(eager, compiled)]
+
+def test_gemma_model_generates_the_same_text(monkeypatch, tmp_path):
+    pytest.importorskip("tokenizers")
+    from stub_model import build_stub_model
+    assert model_module._load_dependencies()
+    # The stub has the default model's (Gemma 2) architecture; loading includes the warm-up generation
+    model_path = build_stub_model(str(tmp_path / "stub"))
+    monkeypatch.setattr(config, "DO_SAMPLE", False)
+    monkeypatch.setattr(config, "QUANTIZED_CHECKPOINT_CACHE", False)
+    monkeypatch.setattr(config, "CPU_WEIGHT_DTYPE", "float32")
+    monkeypatch.setattr(config, "COMPILED_DECODE_TORCH_COMPILE", False)
+    monkeypatch.setattr(config, "COMPILED_MAX_CACHE_LENGTH", 1280)
+    monkeypatch.setattr(config, "COMPILED_LENGTH_BUCKETS", (256,))
+    conversation = [
+        {"role": "user", "content": "How many sets should I do for hypertrophy?"},
+        {"role": "model", "content": "Aim for 10 to 20 hard sets per muscle group each week."},
+        {"role": "user", "content": "How much protein do I need?"},
+    ]
+
+    responses = []
+    for compiled in (False, True):
+        monkeypatch.setattr(config, "COMPILED_DECODE", compiled)
+        gemma_model = model_module.GemmaModel(model_path)
+        assert gemma_model.load_model()
+        assert (gemma_model.scheduler.compiled_decoder is not None) == compiled
+        # The second turn of a conversation reuses its stored cache
+        for _ in range(2):
+            results = list(gemma_model.generate_response_stream(conversation, max_length=12, conversation_id="a"))
+            assert results[-1]["status"] == "success"
+            responses.append(results[-1]["full_response"])
+        gemma_model.unload()
+
+    assert len(set(responses)) == 1
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from conversation_store import (InMemoryConversationStore, SQLiteConversationStore, StoredMessage, _decode_messages,
+                                create_conversation_store, messages_from_dicts, messages_to_dicts)
+
+CONVERSATION = [
+    {"role": "user", "content": "How many sets for hypertrophy?"},
+    {"role": "model", "content": "Usually 10-20 hard sets per muscle per week 💪"},
+    {"role": "user", "content": "And reps?"},
+]
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryConversationStore(max_bytes=1024**2)
+    return SQLiteConversationStore(str(tmp_path / "conversations.sqlite3"))
+
+def test_save_load_round_trip(store):
+    store.save("a", messages_from_dicts(CONVERSATION))
+
+    assert messages_to_dicts(store.load("a")) == CONVERSATION
+    assert store.load("unknown") == []
+
+def test_append_adds_the_reply(store):
+    store.save("a", messages_from_dicts(CONVERSATION))
+    store.append("a", StoredMessage("model", "6-12 reps."))
+    store.append("b", StoredMessage("user", "Hi"))
+
+    assert messages_to_dicts(store.load("a")) == CONVERSATION + [{"role": "model", "content": "6-12 reps."}]
+    assert messages_to_dicts(store.load("b")) == [{"role": "user", "content": "Hi"}]
+
+def test_replace_prefix_only_if_unchanged(store):
+    store.save("a", messages_from_dicts(CONVERSATION))
+    old_messages = store.load("a")[:2]
+    summary = StoredMessage("memory", "The user trains for hypertrophy.")
+
+    assert not store.replace_prefix("a", [StoredMessage("user", "Something else")], [summary])
+    assert not store.replace_prefix("unknown", old_messages, [summary])
+    assert store.replace_prefix("a", old_messages, [summary])
+    assert messages_to_dicts(store.load("a")) == [summary.to_dict(), CONVERSATION[2]]
+
+def test_save_checks_the_expected_version(store):
+    assert store.load_versioned("a") == ([], 0)
+    assert store.save("a", messages_from_dicts(CONVERSATION[:1]), expected_version=0)
+    messages, version = store.load_versioned("a")
+    store.append("a", StoredMessage("model", "10-20 sets."))
+
+    # Written since it was loaded: the stale history isn't saved over the reply
+    assert not store.save("a", messages + [StoredMessage("user", "And reps?")], expected_version=version)
+    assert store.load_versioned("a")[1] == version + 1
+    assert store.save("a", messages_from_dicts(CONVERSATION), expected_version=version + 1)
+    assert store.save("a", messages_from_dicts(CONVERSATION)) # Unconditional
+    assert store.load_versioned("a")[1] == version + 3
+
+def test_sqlite_files_without_versions_are_upgraded(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE conversations (conversation_id TEXT PRIMARY KEY, messages BLOB NOT NULL, updated_time REAL NOT NULL)")
+    connection.execute("INSERT INTO conversations VALUES (?, ?, ?)", ("a", b'[["user","Hi"]]', time.time()))
+    connection.commit()
+    connection.close()
+    store = SQLiteConversationStore(path)
+
+    assert messages_to_dicts(store.load("a")) == [{"role": "user", "content": "Hi"}]
+    assert store.save("a", messages_from_dicts(CONVERSATION), expected_version=0)
+    messages, version = store.load_versioned("a")
+    assert (messages_to_dicts(messages), version) == (CONVERSATION, 1)
+
+def test_rows_with_token_ids_still_load():
+    # Earlier versions stored an unused token ids item with every message
+    messages = _decode_messages(b'[["user","Hi","BAAAAA=="],["model","Hello",null]]')
+
+    assert messages_to_dicts(messages) == [{"role": "user", "content": "Hi"}, {"role": "model", "content": "Hello"}]
+
+def test_auto_store_is_shared_with_the_model_server(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "CONVERSATION_STORE", "auto")
+    monkeypatch.chdir(tmp_path) # The SQLite store's default path is relative
+    monkeypatch.setattr(config, "MODEL_SERVER_ENABLED", False)
+    assert isinstance(create_conversation_store(), InMemoryConversationStore)
+    monkeypatch.setattr(config, "MODEL_SERVER_ENABLED", True)
+    assert isinstance(create_conversation_store(), SQLiteConversationStore)
+
+def test_delete_and_expiry(store):
+    store.save("a", messages_from_dicts(CONVERSATION))
+    store.delete("a")
+    assert store.load("a") == []
+
+    store.ttl_seconds = 1e-9
+    store.save("b", messages_from_dicts(CONVERSATION))
+    assert store.load("b") == []
+
+def test_memory_store_evicts_least_recently_used():
+    store = InMemoryConversationStore(max_bytes=1200) # Room for three of these messages
+    for conversation_id in ("a", "b", "c"):
+        store.save(conversation_id, [StoredMessage("user", "x" * 300)])
+    store.load("a") # "b" is now the least recently used
+    store.save("d", [StoredMessage("user", "x" * 300)])
+
+    assert store.load("b") == []
+    assert store.load("a") and store.load("c") and store.load("d")
+    assert store.total_bytes <= store.max_bytes
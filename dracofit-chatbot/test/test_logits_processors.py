@@ -0,0 +1,63 @@
+import os
+import random
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logits_processors import BatchLogitsProcessor
+
+VOCAB_SIZE = 50
+
+def _reference(penalty, ngram_size):
+    processors = transformers.LogitsProcessorList()
+    if penalty:
+        processors.append(transformers.RepetitionPenaltyLogitsProcessor(penalty=penalty))
+    if ngram_size:
+        processors.append(transformers.NoRepeatNGramLogitsProcessor(ngram_size))
+    return processors
+
+@pytest.mark.parametrize("penalty,ngram_size", [(1.2, 3), (1.2, 0), (None, 2), (1.5, 1)])
+def test_matches_transformers_while_decoding_a_batch(penalty, ngram_size):
+    rng = random.Random(0)
+    torch.manual_seed(0)
+    # Small vocabulary and repetitive prompts, so n-grams actually recur
+    sequences = [[rng.randrange(8) for _ in range(length)] for length in (1, 5, 12)]
+    processor = BatchLogitsProcessor(penalty, ngram_size)
+    reference = _reference(penalty, ngram_size)
+    states = [processor.new_state(token_ids) for token_ids in sequences]
+
+    for _ in range(30):
+        logits = torch.randn(len(sequences), VOCAB_SIZE) * 3
+        scores = processor(states, logits.clone())
+        for row, token_ids in enumerate(sequences):
+            expected = reference(torch.tensor([token_ids]), logits[row:row + 1].clone())
+            assert torch.equal(scores[row:row + 1], expected)
+        # Keep the sequences repetitive by mostly picking already seen tokens
+        for token_ids, state in zip(sequences, states):
+            token_id = rng.randrange(8) if rng.random() < 0.8 else rng.randrange(VOCAB_SIZE)
+            token_ids.append(token_id)
+            state.append(token_id)
+
+def test_rows_can_join_and_leave_the_batch():
+    processor = BatchLogitsProcessor(1.2, 2)
+    reference = _reference(1.2, 2)
+    first, second = processor.new_state([1, 2, 1]), processor.new_state([3, 3])
+    processor([first, second], torch.randn(2, VOCAB_SIZE))
+    first.append(2)
+
+    logits = torch.randn(1, VOCAB_SIZE)
+    assert torch.equal(processor([first], logits.clone()), reference(torch.tensor([[1, 2, 1, 2]]), logits.clone()))
+
+def test_logits_are_not_modified_in_place():
+    processor = BatchLogitsProcessor(1.2, 2)
+    state = processor.new_state([4, 5, 4])
+    logits = torch.randn(1, VOCAB_SIZE)
+    original = logits.clone()
+    processor([state], logits)
+
+    assert torch.equal(logits, original)
@@ -0,0 +1,40 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import profiling
+
+def test_phases_are_no_ops_until_enabled():
+    assert profiling.phase("prefill") is profiling.phase("decode_step")
+    with profiling.phase("prefill"):
+        pass
+
+def test_nested_phases_and_folded_stacks():
+    profiler = profiling.PhaseProfiler()
+    profiling.enable(profiler)
+    try:
+        def run_step():
+            with profiling.phase("decode_step"):
+                with profiling.phase("decode_forward"):
+                    time.sleep(0.02)
+                with profiling.phase("sample"):
+                    pass
+        # Another thread's phases have their own stack
+        thread = threading.Thread(target=run_step)
+        thread.start()
+        run_step()
+        thread.join()
+    finally:
+        profiling.disable()
+
+    summary = profiler.summary()
+    assert list(summary) == ["decode_forward", "decode_step", "sample"]
+    assert summary["decode_step"]["count"] == 2
+    assert summary["decode_step"]["total_ms"] >= summary["decode_forward"]["total_ms"] >= 40
+    stacks = dict(line.rsplit(" ", 1) for line in profiler.folded_stacks().splitlines())
+    assert set(stacks) == {"decode_step", "decode_step;decode_forward", "decode_step;sample"}
+    # The parent's self time leaves out its children
+    assert int(stacks["decode_step"]) < int(stacks["decode_step;decode_forward"])
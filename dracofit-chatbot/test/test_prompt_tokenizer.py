@@ -0,0 +1,90 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from prompt_tokenizer import MEMORY_ROLE, PromptTokenizer, conversation_turns, format_turn
+
+CONVERSATIONS = [
+    [{"role": "user", "content": "How many sets for hypertrophy?"}],
+    [
+        {"role": "user", "content": "What should I eat before a workout?"},
+        {"role": "model", "content": "A mix of carbs and protein 1-2 hours before.\n\nFor example: oats & whey."},
+        {"role": "user", "content": "  And after?  "},
+    ],
+    [
+        {"role": "user", "content": "Plan a 3-day split 💪"},
+        {"role": "model", "content": ""},
+        {"role": "user", "content": "Día 1: sentadillas\nDay 2: bench\tpress\r\nDay 3: deadlifts"},
+    ],
+]
+
+def _build_test_tokenizer():
+    """Small BPE tokenizer with Gemma's special tokens, for when the real one isn't available offline."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+
+    special_tokens = ["<pad>", "<eos>", "<bos>", "<unk>", "<start_of_turn>", "<end_of_turn>"]
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=500, special_tokens=special_tokens,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    corpus = [config.SYSTEM_PROMPT] + [message["content"] for conversation in CONVERSATIONS for message in conversation]
+    tokenizer.train_from_iterator(corpus * 20, trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(single="<bos> $A", special_tokens=[("<bos>", 2)])
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<bos>", eos_token="<eos>", pad_token="<pad>", unk_token="<unk>",
+        additional_special_tokens=["<start_of_turn>", "<end_of_turn>"],
+    )
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    try:
+        return transformers.AutoTokenizer.from_pretrained(config.DEFAULT_MODEL_NAME, local_files_only=True)
+    except Exception:
+        return _build_test_tokenizer()
+
+@pytest.mark.parametrize("conversation", CONVERSATIONS)
+def test_incremental_ids_match_full_prompt_tokenization(tokenizer, conversation):
+    prompt_tokenizer = PromptTokenizer(tokenizer)
+    turns = conversation_turns(config.SYSTEM_PROMPT, conversation)
+
+    expected = tokenizer("".join(turns), return_tensors="pt").input_ids[0]
+
+    assert prompt_tokenizer.encode(turns).tolist() == expected.tolist()
+    # A second pass is served entirely from the cache and must not change the result
+    assert prompt_tokenizer.encode(turns).tolist() == expected.tolist()
+
+def test_new_turn_only_tokenizes_new_messages(tokenizer):
+    prompt_tokenizer = PromptTokenizer(tokenizer)
+    conversation = [{"role": "user", "content": "How many sets for hypertrophy?"}]
+    prompt_tokenizer.encode(conversation_turns(config.SYSTEM_PROMPT, conversation))
+    misses = prompt_tokenizer.cache_misses
+
+    conversation = conversation + [
+        {"role": "model", "content": "Usually 3-5 sets of 6-12 reps."},
+        {"role": "user", "content": "Per muscle per week?"},
+    ]
+    prompt_tokenizer.encode(conversation_turns(config.SYSTEM_PROMPT, conversation))
+
+    assert prompt_tokenizer.cache_misses - misses == 2
+
+def test_empty_conversation_raises():
+    with pytest.raises(IndexError):
+        conversation_turns(config.SYSTEM_PROMPT, [])
+
+def test_memory_turn_is_templated_as_a_summary():
+    conversation = [
+        {"role": MEMORY_ROLE, "content": "The user trains 3 days a week and has a sore knee."},
+        {"role": "user", "content": "Leg day ideas?"},
+    ]
+    turns = conversation_turns(config.SYSTEM_PROMPT, conversation)
+
+    assert turns[1] == "<start_of_turn>system\nSummary of the conversation so far:\nThe user trains 3 days a week and has a sore knee.<end_of_turn>\n\n"
+    assert turns[2] == format_turn("user", "Leg day ideas?")
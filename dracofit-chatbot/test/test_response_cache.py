@@ -0,0 +1,110 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import response_cache
+from response_cache import ResponseCache
+
+FINGERPRINT = ["model", "system prompt"]
+
+def _conversation(*messages):
+    return [{"role": "user" if index % 2 == 0 else "model", "content": content} for index, content in enumerate(messages)]
+
+class _Embedder:
+    """Fixed unit vectors per normalized message; unknown messages get their own direction."""
+    def __init__(self, vectors):
+        self.vectors = {text: torch.tensor(vector, dtype=torch.float32) for text, vector in vectors.items()}
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        vector = self.vectors.get(response_cache.normalize_text(text), torch.tensor([0.0, 0.0, 1.0]))
+        return vector / vector.norm()
+
+def test_exact_match_ignores_case_whitespace_and_trailing_punctuation():
+    cache = ResponseCache()
+    cache.put(FINGERPRINT, _conversation("How many sets for hypertrophy?"), ["data: 1\n\n", "data: 2\n\n"])
+
+    assert cache.get(FINGERPRINT, _conversation("  how many SETS for   hypertrophy")) == ["data: 1\n\n", "data: 2\n\n"]
+    assert cache.get(["other model", "system prompt"], _conversation("How many sets for hypertrophy?")) is None
+    assert cache.get(FINGERPRINT, _conversation("Hi", "Hello!", "How many sets for hypertrophy?")) is None
+    status = cache.get_status()
+    assert (status["exact_hits"], status["misses"], status["hit_rate"]) == (1, 2, 0.3333)
+
+def test_semantic_match_above_and_below_the_threshold():
+    embedder = _Embedder({
+        "how many sets for hypertrophy": [1.0, 0.0, 0.0],
+        "how many sets should i do to build muscle": [0.95, 0.31, 0.0], # cos 0.95
+        "what should i eat before training": [0.5, 0.87, 0.0], # cos 0.5
+    })
+    cache = ResponseCache(embedder=embedder, similarity_threshold=0.9)
+    cache.put(FINGERPRINT, _conversation("How many sets for hypertrophy?"), ["sets"])
+
+    assert cache.get(FINGERPRINT, _conversation("How many sets should I do to build muscle?")) == ["sets"]
+    assert cache.get(FINGERPRINT, _conversation("What should I eat before training?")) is None
+    # Same wording after a different earlier history: another bucket
+    assert cache.get(FINGERPRINT, _conversation("Hi", "Hello!", "How many sets should I do to build muscle?")) is None
+    status = cache.get_status()
+    assert (status["semantic_hits"], status["misses"]) == (1, 2)
+
+def test_entries_expire_when_looked_up(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    embedder = _Embedder({"how many sets for hypertrophy": [1.0, 0.0, 0.0], "sets for hypertrophy": [1.0, 0.1, 0.0]})
+    cache = ResponseCache(ttl_seconds=60, embedder=embedder)
+    cache.put(FINGERPRINT, _conversation("How many sets for hypertrophy?"), ["sets"])
+    # After other turns: not a semantic candidate for the first message
+    cache.put(FINGERPRINT, _conversation("Hi", "Hello!", "What is a deload?"), ["deload"])
+
+    now[0] += 59
+    assert cache.get(FINGERPRINT, _conversation("How many sets for hypertrophy?")) == ["sets"]
+    now[0] += 2
+    # Only the entries a lookup touches are checked
+    assert cache.get(FINGERPRINT, _conversation("Sets for hypertrophy")) is None
+    assert cache.get_status()["expirations"] == 1
+    assert cache.get_status()["entries"] == 1
+    assert cache.get(FINGERPRINT, _conversation("Hi", "Hello!", "What is a deload?")) is None
+    assert cache.get_status()["expirations"] == 2
+    assert cache.get_status()["entries"] == 0
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put(FINGERPRINT, _conversation("a"), ["a"])
+    cache.put(FINGERPRINT, _conversation("b"), ["b"])
+    assert cache.get(FINGERPRINT, _conversation("a")) == ["a"]
+    cache.put(FINGERPRINT, _conversation("c"), ["c"])
+
+    assert cache.get(FINGERPRINT, _conversation("b")) is None
+    assert cache.get(FINGERPRINT, _conversation("a")) == ["a"]
+    assert cache.get_status()["evictions"] == 1
+
+def test_personalized_messages_are_only_matched_exactly():
+    embedder = _Embedder({
+        "i weigh 80 kg, how much protein do i need": [1.0, 0.0, 0.0],
+        "i weigh 60 kg, how much protein do i need": [0.99, 0.14, 0.0],
+        "how much protein does my knee injury need": [0.99, 0.14, 0.0],
+    })
+    cache = ResponseCache(embedder=embedder, similarity_threshold=0.9)
+    cache.put(FINGERPRINT, _conversation("I weigh 80 kg, how much protein do I need?"), ["160 g"])
+
+    assert cache.get(FINGERPRINT, _conversation("I weigh 60 kg, how much protein do I need?")) is None
+    assert cache.get(FINGERPRINT, _conversation("How much protein does my knee injury need?")) is None
+    assert cache.get(FINGERPRINT, _conversation("I weigh 80 kg, how much protein do I need?")) == ["160 g"]
+    # Never embedded: neither stored for nor looked up by similarity
+    assert embedder.calls == 0
+    assert response_cache.is_personalized("I'm 40 and new to lifting")
+    assert not response_cache.is_personalized("How many sets should I do for hypertrophy?")
+
+def test_conversations_with_a_memory_turn_bypass_the_cache():
+    cache = ResponseCache()
+    conversation = [{"role": "memory", "content": "Trains 4x a week, recovering from a knee injury."}] + _conversation("What should I train today?")
+    cache.put(FINGERPRINT, conversation, ["legs"])
+
+    assert cache.get(FINGERPRINT, conversation) is None
+    status = cache.get_status()
+    assert (status["entries"], status["stores"], status["bypasses"], status["misses"]) == (0, 0, 1, 0)
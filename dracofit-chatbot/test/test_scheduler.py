@@ -0,0 +1,151 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import metrics
+import model as model_module
+
+PREFIX = [2, 5, 6, 7]
+PROMPTS = [PREFIX + [10, 11, 12], PREFIX + [40, 41, 42, 43, 44, 45], PREFIX + [8]]
+
+def _tiny_model(model_type):
+    # Gemma 2 is the configured default; left to itself it prefills into a HybridCache
+    extra = {"sliding_window": 64} if model_type == "gemma2" else {}
+    model_config = transformers.AutoConfig.for_model(
+        model_type, vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=1, head_dim=16, max_position_embeddings=512,
+        eos_token_id=1, pad_token_id=0, **extra,
+    )
+    torch.manual_seed(0)
+    return transformers.AutoModelForCausalLM.from_config(model_config).eval()
+
+def _greedy(model, prompt, max_new_tokens):
+    """Greedy decoding with full forward passes and no cache, as the reference."""
+    sequence = list(prompt)
+    with torch.inference_mode():
+        for _ in range(max_new_tokens):
+            sequence.append(int(model(torch.tensor([sequence]), use_cache=False).logits[0, -1].argmax()))
+    return sequence[len(prompt):]
+
+class _Tokenizer:
+    eos_token_id = None
+
+    def __call__(self, text, return_tensors=None):
+        # The system prompt prefix, whatever the text
+        return transformers.BatchEncoding({"input_ids": torch.tensor([PREFIX])})
+
+class _Streamer:
+    def put(self, value):
+        pass
+
+    def end(self):
+        pass
+
+def _observations(histogram):
+    return sum(histogram._counts.get((), []))
+
+def _run(scheduler, prompts, max_new_tokens, conversation_id=None):
+    requests = [model_module.GenerationRequest(torch.tensor(prompt), _Streamer(), max_new_tokens=max_new_tokens, conversation_id=conversation_id)
+                for prompt in prompts]
+    for request in requests:
+        scheduler.submit(request)
+    for request in requests:
+        assert request.done.wait(60)
+        assert request.error is None
+    return [request.generated_ids for request in requests]
+
+@pytest.fixture(autouse=True)
+def greedy_settings(monkeypatch):
+    assert model_module._load_dependencies()
+    monkeypatch.setattr(config, "DO_SAMPLE", False)
+    monkeypatch.setattr(config, "REPETITION_PENALTY", 1.0)
+    monkeypatch.setattr(config, "NO_REPEAT_NGRAM_SIZE", 0)
+
+@pytest.mark.parametrize("static_kv_cache", [False, True])
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+def test_batch_decoding_matches_greedy_decoding(model_type, static_kv_cache):
+    model = _tiny_model(model_type)
+    scheduler = model_module.GenerationScheduler(model, _Tokenizer(), "cpu", static_kv_cache=static_kv_cache)
+    # Submitted together, so they decode as one left-padded batch
+    generated = _run(scheduler, PROMPTS, 10)
+    scheduler.stop()
+
+    assert generated == [_greedy(model, prompt, 10) for prompt in PROMPTS]
+
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+def test_prefix_cache_is_built_and_reused(model_type):
+    model = _tiny_model(model_type)
+    scheduler = model_module.GenerationScheduler(model, _Tokenizer(), "cpu")
+    scheduler.set_prefix("<start_of_turn>system")
+    scheduler.build_prefix()
+
+    assert len(scheduler.prefix_cache.past_key_values) == model.config.num_hidden_layers
+    generated = _run(scheduler, PROMPTS, 8)
+    stats, prefix_hits = dict(scheduler.stats), scheduler.prefix_cache.hits
+    scheduler.stop()
+
+    assert generated == [_greedy(model, prompt, 8) for prompt in PROMPTS]
+    assert prefix_hits == len(PROMPTS)
+    assert stats["prefill_tokens_reused"] == len(PREFIX) * len(PROMPTS)
+
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+def test_next_turn_reuses_the_conversation_cache(model_type):
+    model = _tiny_model(model_type)
+    scheduler = model_module.GenerationScheduler(model, _Tokenizer(), "cpu")
+    first_reply = _run(scheduler, PROMPTS[:1], 6, conversation_id="a")[0]
+    next_turn = PROMPTS[0] + first_reply + [20, 21, 22]
+    second_reply = _run(scheduler, [next_turn], 6, conversation_id="a")[0]
+    stats, session_hits = dict(scheduler.stats), scheduler.session_store.hits
+    scheduler.stop()
+
+    assert second_reply == _greedy(model, next_turn, 6)
+    assert session_hits == 1
+    # The last reply token was never fed through the model, so it is prefilled with the new turn
+    assert stats["prefill_tokens_reused"] == len(PROMPTS[0]) + len(first_reply) - 1
+
+def test_context_is_capped_at_the_sliding_window(monkeypatch):
+    monkeypatch.setattr(config, "CONTEXT_TOKEN_BUDGET", None)
+    assert model_module._max_context_tokens(_tiny_model("gemma").config) == 512
+    assert model_module._max_context_tokens(_tiny_model("gemma2").config) == 64
+
+def test_background_requests_wait_until_the_scheduler_is_idle():
+    model = _tiny_model("gemma")
+    scheduler = model_module.GenerationScheduler(model, _Tokenizer(), "cpu")
+    events = []
+
+    class _Recorder(_Streamer):
+        def __init__(self, name):
+            self.name = name
+
+        def put(self, value):
+            events.append((self.name, "put"))
+
+        def end(self):
+            events.append((self.name, "end"))
+
+    background = model_module.GenerationRequest(torch.tensor(PROMPTS[2]), _Recorder("background"), max_new_tokens=4, background=True)
+    live = [model_module.GenerationRequest(torch.tensor(prompt), _Recorder(f"live{index}"), max_new_tokens=6)
+            for index, prompt in enumerate(PROMPTS[:2])]
+    observed = [_observations(histogram) for histogram in (metrics.QUEUE_WAIT_SECONDS, metrics.PREFILL_SECONDS)]
+    # Queued first, but admitted only once the live requests have finished. Holding the
+    # scheduler's lock keeps its thread from admitting anything before all three are queued
+    with scheduler._cond:
+        for request in [background] + live:
+            scheduler.submit(request)
+    for request in live + [background]:
+        assert request.done.wait(60)
+        assert request.error is None
+    scheduler.stop()
+
+    first_background_event = events.index(("background", "put"))
+    assert all(events.index((f"live{index}", "end")) < first_background_event for index in range(2))
+    assert background.generated_ids == _greedy(model, PROMPTS[2], 4)
+    # Only the live requests count towards the latency metrics
+    assert [_observations(histogram) for histogram in (metrics.QUEUE_WAIT_SECONDS, metrics.PREFILL_SECONDS)] == [count + 2 for count in observed]
@@ -0,0 +1,128 @@
+import copy
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import model as model_module
+from speculative import DraftModelDrafter, PromptLookupDrafter, verify_draft_token
+
+# Repeated n-grams give prompt lookup something to draft from
+PROMPTS = [[2, 10, 11, 12, 13, 10, 11, 12, 13, 10, 11], [2, 40, 41, 40, 41, 40], [2, 7]]
+
+def _tiny_model(model_type):
+    model_config = transformers.AutoConfig.for_model(
+        model_type, vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=1, head_dim=16, max_position_embeddings=512,
+        eos_token_id=1, pad_token_id=0,
+    )
+    torch.manual_seed(0)
+    return transformers.AutoModelForCausalLM.from_config(model_config).eval()
+
+def _perturbed(model, scale):
+    """A copy of the model with noise added to its weights, as a draft model that mostly agrees with it."""
+    draft_model = copy.deepcopy(model)
+    torch.manual_seed(1)
+    with torch.no_grad():
+        for parameter in draft_model.parameters():
+            parameter.add_(torch.randn_like(parameter) * scale)
+    return draft_model
+
+class _Tokenizer:
+    eos_token_id = None
+
+class _Streamer:
+    def put(self, value):
+        pass
+
+    def end(self):
+        pass
+
+def _generate(model, drafter=None, max_new_tokens=16):
+    scheduler = model_module.GenerationScheduler(model, _Tokenizer(), "cpu", drafter=drafter)
+    requests = [model_module.GenerationRequest(torch.tensor(prompt), _Streamer(), max_new_tokens=max_new_tokens) for prompt in PROMPTS]
+    for request in requests:
+        scheduler.submit(request)
+    for request in requests:
+        assert request.done.wait(60)
+        assert request.error is None
+    status = scheduler.get_status()
+    scheduler.stop()
+    return [request.generated_ids for request in requests], status
+
+@pytest.fixture(autouse=True)
+def greedy(monkeypatch):
+    assert model_module._load_dependencies()
+    monkeypatch.setattr(config, "DO_SAMPLE", False)
+
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+def test_prompt_lookup_matches_plain_decoding(model_type):
+    model = _tiny_model(model_type)
+    plain, _ = _generate(model)
+    speculative, status = _generate(model, PromptLookupDrafter())
+
+    assert speculative == plain
+    assert status["speculative_mode"] == "prompt_lookup"
+    assert status["draft_tokens_proposed"] > 0
+
+@pytest.mark.parametrize("model_type", ["gemma", "gemma2"])
+def test_draft_model_matches_plain_decoding(model_type):
+    model = _tiny_model(model_type)
+    # Close to the target model, so some drafts are accepted and some rejected
+    drafter = DraftModelDrafter(_perturbed(model, 0.05), model_module._build_logits_processor(), "cpu")
+    plain, _ = _generate(model)
+    speculative, status = _generate(model, drafter)
+
+    assert speculative == plain
+    assert status["speculative_mode"] == "draft_model"
+    assert 0 < status["draft_tokens_accepted"] < status["draft_tokens_proposed"]
+
+def test_acceptance_rate_is_reported():
+    model = _tiny_model("gemma")
+    # Drafting with the target model itself: every draft is accepted
+    drafter = DraftModelDrafter(model, model_module._build_logits_processor(), "cpu")
+    _, status = _generate(model, drafter)
+
+    assert status["draft_tokens_proposed"] > 0
+    assert status["draft_tokens_accepted"] == status["draft_tokens_proposed"]
+    assert status["draft_acceptance_rate"] == 1.0
+
+    _, status = _generate(model, DraftModelDrafter(_perturbed(model, 0.05), model_module._build_logits_processor(), "cpu"))
+    assert 0 < status["draft_acceptance_rate"] < 1
+    assert status["draft_acceptance_rate"] == round(status["draft_tokens_accepted"] / status["draft_tokens_proposed"], 4)
+
+@pytest.mark.parametrize("deterministic_draft", [False, True])
+def test_sampled_verification_preserves_the_target_distribution(deterministic_draft):
+    target_probs = torch.tensor([0.5, 0.3, 0.15, 0.05])
+    draft_probs = torch.tensor([0.1, 0.2, 0.3, 0.4])
+    scores = target_probs.log()
+    generator = torch.manual_seed(1234)
+    counts = torch.zeros(4)
+    trials = 20000
+    for _ in range(trials):
+        if deterministic_draft:
+            # Prompt lookup: always proposes token 3, with no distribution
+            token, _ = verify_draft_token(scores, 3, None, do_sample=True)
+        else:
+            draft_token = int(torch.multinomial(draft_probs, 1, generator=generator))
+            token, _ = verify_draft_token(scores, draft_token, draft_probs, do_sample=True)
+        counts[token] += 1
+
+    torch.testing.assert_close(counts / trials, target_probs, atol=0.015, rtol=0)
+
+def test_sampled_verification_accepts_when_the_target_is_more_likely():
+    torch.manual_seed(0)
+    scores = torch.tensor([0.7, 0.2, 0.1]).log()
+    draft_probs = torch.tensor([0.5, 0.25, 0.25])
+    # p / q >= 1 for token 0: always accepted
+    assert all(verify_draft_token(scores, 0, draft_probs, do_sample=True) == (0, True) for _ in range(100))
+    # q(2) = 0.25 > p(2) = 0.1: rejected often, and a rejection never returns the draft token
+    results = [verify_draft_token(scores, 2, draft_probs, do_sample=True) for _ in range(200)]
+    assert 0 < sum(accepted for _, accepted in results) < 200
+    assert all(token != 2 for token, accepted in results if not accepted)
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse import coalesce_stream, coalesce_stream_async, format_chunk, format_event
+
+def _stream(chunks, delay=0.0):
+    for chunk in chunks:
+        if delay:
+            time.sleep(delay)
+        yield {"status": "streaming", "chunk": chunk}
+    yield {"status": "success", "full_response": "".join(chunks)}
+
+async def _stream_async(chunks, delay=0.0):
+    for chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        yield {"status": "streaming", "chunk": chunk}
+    yield {"status": "success", "full_response": "".join(chunks)}
+
+def _parse(frame):
+    assert frame.startswith("data: ") and frame.endswith("\n\n")
+    return json.loads(frame[len("data: "):])
+
+def test_frames_parse_like_json_dumps():
+    for chunk in ["Hi", ' "quoted"\n\tnew line', "Día 1 💪", " \\"]:
+        assert _parse(format_chunk(chunk)) == {"status": "streaming", "chunk": chunk}
+    result = {"status": "error", "message": "Model not loaded"}
+    assert _parse(format_event(result)) == result
+
+def test_coalesce_merges_chunks_within_the_interval():
+    chunks = ["Aim", " for", " 10", "-20", " sets", "."]
+    results = list(coalesce_stream(_stream(chunks), flush_interval_ms=60_000, max_bytes=1024))
+
+    # The first chunk goes out at once, the rest is flushed before the terminal result
+    assert results == [
+        {"status": "streaming", "chunk": "Aim"},
+        {"status": "streaming", "chunk": " for 10-20 sets."},
+        {"status": "success", "full_response": "".join(chunks)},
+    ]
+
+def test_coalesce_flushes_on_size_and_time():
+    chunks = ["x" * 10] * 6
+    by_size = list(coalesce_stream(_stream(chunks), flush_interval_ms=60_000, max_bytes=20))
+    assert [result["chunk"] for result in by_size[:-1]] == ["x" * 10, "x" * 20, "x" * 20, "x" * 10]
+
+    by_time = list(coalesce_stream(_stream(chunks, delay=0.01), flush_interval_ms=1, max_bytes=1024))
+    assert len(by_time) == len(chunks) + 1
+
+    unbuffered = list(coalesce_stream(_stream(chunks), flush_interval_ms=0))
+    assert len(unbuffered) == len(chunks) + 1
+
+def test_async_coalesce_flushes_pending_text_on_timer():
+    async def collect():
+        results = []
+        async for result in coalesce_stream_async(_stream_async(["a", "b", "c"], delay=0.05), flush_interval_ms=10, max_bytes=1024):
+            results.append(result)
+        return results
+
+    results = asyncio.run(collect())
+    # Each chunk waits at most the interval, so none are merged across the 50 ms gaps
+    assert [result.get("chunk") for result in results] == ["a", "b", "c", None]
+    assert results[-1]["status"] == "success"